@@ -0,0 +1,425 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Benchmarks of merging, on synthetic branches and a fake Launchpad.
+
+Run it with e.g.:
+
+  python -m tarmac.benchmark --depth 500 --files 1000 --proposals 20
+
+With --startup, it times how long starting `tarmac` takes instead.
+
+Each run is appended to a results file, and compared with the last run
+with the same parameters, so regressions between versions show up.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import bzrlib
+from bzrlib.bzrdir import BzrDir
+from bzrlib.directory_service import directories
+from bzrlib.transport import register_urlparse_netloc_protocol
+
+from tarmac import __version__
+from tarmac.bin.commands import cmd_merge
+from tarmac.bin.registry import CommandRegistry
+from tarmac.branch import Branch
+from tarmac.config import TarmacConfig
+from tarmac.trace import tracer
+
+# The phases of a run which are reported, by the name of their trace span.
+PHASES = ('land_proposal', 'cleanup', 'merge', 'commit', 'merge_tags')
+
+# The code timed by --startup, each run in a fresh interpreter: Python
+# itself, loading the commands, and `tarmac help`.
+STARTUP = (
+    ('python', 'pass'),
+    ('import', 'import tarmac.bin.commands'),
+    ('help', 'import sys; sys.argv[1:] = ["help"]; '
+     'from tarmac.bin import main; main()'),
+    )
+
+
+class FakeObject(object):
+    '''A stand-in for a Launchpad object, with the given attributes.'''
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeBugs(object):
+    '''Stand-in for launchpad.bugs, with a task for %series on every bug.'''
+
+    def __init__(self, series):
+        self.series = series
+
+    def __getitem__(self, bug_id):
+        return FakeObject(id=bug_id, bug_tasks=[FakeObject(
+                    target=self.series, status=u'Triaged',
+                    lp_save=lambda: None)])
+
+
+class LocalDirectory(object):
+    '''Resolve lp: URLs to the branches in a local directory.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def look_up(self, name, url):
+        return 'file://%s/%s' % (self.path, name)
+
+
+class SyntheticProject(object):
+    '''A target branch, and source branches proposed for merging into it.
+
+    The target has %depth revisions, changing %files files between them,
+    and %tags tags.  Each of the %proposals source branches adds a revision
+    with its own author and fixed bug, and a tag.
+    '''
+
+    def __init__(self, path, depth=100, files=100, tags=10, proposals=10):
+        self.path = path
+        self.depth = depth
+        self.files = files
+        self.tags = tags
+        self.proposals = proposals
+        self.branches_dir = os.path.join(path, 'branches')
+
+    def _write(self, tree, name, content):
+        with open(tree.abspath(name), 'w') as f:
+            f.write(content)
+
+    def build(self):
+        '''Create the branches, returning the fake Launchpad target.'''
+        target_dir = os.path.join(self.branches_dir, 'target')
+        os.makedirs(target_dir)
+        tree = BzrDir.create_standalone_workingtree(target_dir)
+        names = ['file-%d.txt' % index for index in range(self.files)]
+        for name in names:
+            self._write(tree, name, '%s\n' % name)
+        tree.add(names)
+        revids = [tree.commit('Add the files.', committer='Developer',
+                              timestamp=0, timezone=0)]
+        for index in range(1, self.depth):
+            name = names[index % len(names)]
+            self._write(tree, name, '%s\n%d\n' % (name, index))
+            revids.append(tree.commit(
+                    'Revision %d.' % index, committer='Developer',
+                    timestamp=index, timezone=0))
+        if self.tags:
+            for index, revid in enumerate(revids[-self.tags:]):
+                tree.branch.tags.set_tag('tag-%d' % index, revid)
+
+        series = FakeObject(name='trunk')
+        lp_target = FakeObject(
+            bzr_identity='lp:target', display_name='lp:target',
+            web_link='lp:target', name='target', unique_name='target',
+            revision_count=len(revids), landing_candidates=[],
+            project=FakeObject(name='target', development_focus=series))
+        for index in range(self.proposals):
+            lp_target.landing_candidates.append(
+                self._build_proposal(tree, lp_target, index))
+        return lp_target
+
+    def _build_proposal(self, target_tree, lp_target, index):
+        name = 'source-%d' % index
+        source_dir = os.path.join(self.branches_dir, name)
+        tree = target_tree.bzrdir.sprout(source_dir).open_workingtree()
+        path = 'proposal-%d.txt' % index
+        self._write(tree, path, 'Proposal %d.\n' % index)
+        tree.add([path])
+        revid = tree.commit(
+            'Proposal %d.' % index, committer='Developer',
+            authors=['Author %d <author%d@example.com>' % (index, index)],
+            revprops={'bugs': 'https://launchpad.net/bugs/%d fixed' % (
+                    index + 1)},
+            timestamp=self.depth + index, timezone=0)
+        tree.branch.tags.set_tag(name, revid)
+
+        lp_source = FakeObject(
+            bzr_identity='lp:' + name, display_name='lp:' + name,
+            web_link='lp:' + name, name=name, unique_name=name,
+            revision_count=self.depth + 1, landing_targets=[])
+        proposal = FakeObject(
+            self_link=u'https://api.launchpad.net/1.0/proposal%d' % index,
+            web_link=u'https://code.launchpad.net/proposal%d' % index,
+            queue_status=u'Approved',
+            commit_message=u'Proposal %d.' % index,
+            description=None,
+            source_branch=lp_source,
+            target_branch=lp_target,
+            prerequisite_branch=None,
+            reviewed_revid=revid,
+            votes=[FakeObject(
+                    comment=FakeObject(vote=u'Approve'),
+                    reviewer=FakeObject(display_name=u'Reviewer'))],
+            createComment=lambda *args, **kwargs: None,
+            setStatus=lambda *args, **kwargs: None,
+            lp_save=lambda *args, **kwargs: None)
+        lp_source.landing_targets.append(proposal)
+        return proposal
+
+
+def summarize(durations):
+    '''Return the count, total and mean of a list of %durations.'''
+    total = sum(durations)
+    return {'count': len(durations), 'total': total,
+            'mean': total / len(durations) if durations else 0.0}
+
+
+def run_benchmark(path, depth=100, files=100, tags=10, proposals=10):
+    '''Land the proposals of a SyntheticProject built in %path.
+
+    Returns the timings: seconds per proposal, the phases traced during the
+    run, and Branch.authors and Branch.fixed_bugs.
+    '''
+    project = SyntheticProject(path, depth, files, tags, proposals)
+    lp_target = project.build()
+    launchpad = FakeObject(
+        branches=FakeObject(getByUrl=lambda url: (
+                lp_target if url == lp_target.bzr_identity else None)),
+        bugs=FakeBugs(lp_target.project.development_focus),
+        me=FakeObject(display_name=u'Tarmac'))
+
+    for name in ('config', 'cache'):
+        os.makedirs(os.path.join(path, name))
+    environ = dict(os.environ)
+    os.environ['TARMAC_CONFIG_HOME'] = os.path.join(path, 'config')
+    os.environ['TARMAC_CACHE_HOME'] = os.path.join(path, 'cache')
+    os.environ['TARMAC_PID_FILE'] = os.path.join(path, 'cache', 'tarmac.pid')
+    os.environ['TARMAC_CREDENTIALS'] = os.path.join(path, 'credentials')
+    try:
+        previous = directories.get('lp:')
+    except KeyError:
+        previous = None
+    register_urlparse_netloc_protocol('lp')
+    directories.register(
+        'lp:', lambda: LocalDirectory(project.branches_dir),
+        'Synthetic branches', override_existing=True)
+    trace_file = os.path.join(path, 'trace.jsonl')
+    try:
+        config = TarmacConfig()
+        config.add_section(lp_target.bzr_identity)
+        config.set(lp_target.bzr_identity, 'tree_dir',
+                   os.path.join(path, 'tree'))
+        config.set('Tarmac', 'trace_file', trace_file)
+        config.set('Tarmac', 'log_file', os.path.join(path, 'tarmac.log'))
+
+        # Time the history walks before landing, while the sources still
+        # have revisions the target doesn't.
+        target = Branch.create(lp_target, config)
+        authors = []
+        for proposal in lp_target.landing_candidates:
+            source = Branch.create(proposal.source_branch, config,
+                                   target=target)
+            started = time.time()
+            source.authors
+            authors.append(time.time() - started)
+
+        registry = CommandRegistry(config=config)
+        registry.register_command('merge', cmd_merge)
+        command = registry._get_command(cmd_merge, 'merge')
+        started = time.time()
+        command.run(launchpad=launchpad)
+        elapsed = time.time() - started
+        tracer.configure(None)
+
+        # The bugs fixed by everything landed since the run started.
+        target = Branch.create(lp_target, config)
+        started = time.time()
+        fixed_bugs = len(target.fixed_bugs)
+        fixed_bugs_time = time.time() - started
+    finally:
+        tracer.configure(None)
+        if previous is None:
+            directories.remove('lp:')
+        else:
+            directories.register('lp:', previous, override_existing=True)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    spans = {}
+    with open(trace_file) as trace:
+        for line in trace:
+            span = json.loads(line)
+            spans.setdefault(span['name'], []).append(span['duration'])
+    landed = len(spans.get('commit', []))
+    timings = {
+        'elapsed': elapsed,
+        'landed': landed,
+        'per_proposal': elapsed / landed if landed else None,
+        'authors': summarize(authors),
+        'fixed_bugs': {'count': fixed_bugs, 'total': fixed_bugs_time},
+        }
+    for phase in PHASES:
+        timings[phase] = summarize(spans.get(phase, []))
+    return timings
+
+
+def run_startup_benchmark(path, repeat=5):
+    '''Time each of STARTUP %repeat times, with the config in %path.
+
+    Returns the timings of each, with the fastest as 'min'.
+    '''
+    environ = dict(os.environ)
+    environ['TARMAC_CONFIG_HOME'] = os.path.join(path, 'config')
+    environ['TARMAC_CACHE_HOME'] = os.path.join(path, 'cache')
+    environ['TARMAC_PID_FILE'] = os.path.join(path, 'cache', 'tarmac.pid')
+    environ['TARMAC_CREDENTIALS'] = os.path.join(path, 'credentials')
+    # The fresh interpreters must import this copy of Tarmac.
+    environ['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [entry for entry in [environ.get('PYTHONPATH')] if entry])
+    timings = {}
+    with open(os.devnull, 'w') as devnull:
+        for name, code in STARTUP:
+            durations = []
+            for run in range(repeat):
+                started = time.time()
+                subprocess.check_call(
+                    [sys.executable, '-c', code], env=environ,
+                    stdout=devnull, stderr=devnull)
+                durations.append(time.time() - started)
+            timings[name] = dict(summarize(durations), min=min(durations))
+    return timings
+
+
+def record(path, params, timings):
+    '''Append the %timings to the results file at %path.
+
+    Returns the last record in the file with the same %params, or None.
+    '''
+    previous = None
+    if os.path.exists(path):
+        with open(path) as results:
+            for line in results:
+                old = json.loads(line)
+                if old['params'] == params:
+                    previous = old
+    with open(path, 'a') as results:
+        results.write(json.dumps({
+                    'time': time.time(), 'version': __version__,
+                    'bzr_version': bzrlib.__version__,
+                    'python': platform.python_version(),
+                    'params': params, 'timings': timings},
+                                 sort_keys=True) + '\n')
+    return previous
+
+
+def compare(previous, current):
+    '''Return lines comparing the %current timings with the %previous.'''
+    lines = []
+    for name in sorted(current):
+        if name == 'landed':
+            continue
+        old, new = previous.get(name), current[name]
+        if isinstance(new, dict):
+            old = (old or {}).get('total')
+            new = new['total']
+        if not old or new is None:
+            continue
+        lines.append('%-15s %10.4fs %10.4fs %+7.1f%%' % (
+                name, old, new, (new - old) * 100.0 / old))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark merging synthetic proposals.')
+    parser.add_argument('--depth', type=int, default=100,
+                        help='Revisions in the target branch.')
+    parser.add_argument('--files', type=int, default=100,
+                        help='Files in the target branch.')
+    parser.add_argument('--tags', type=int, default=10,
+                        help='Tags in the target branch.')
+    parser.add_argument('--proposals', type=int, default=10,
+                        help='Proposals to land.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs to make, reporting the fastest.')
+    parser.add_argument('--results', default='benchmark-results.jsonl',
+                        help='File to append the results to.')
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't remove the synthetic branches.")
+    parser.add_argument('--startup', action='store_true',
+                        help='Time starting tarmac instead of merging.')
+    options = parser.parse_args(argv)
+    logging.getLogger('tarmac').addHandler(logging.NullHandler())
+
+    if options.startup:
+        return startup_main(options)
+
+    params = {'depth': options.depth, 'files': options.files,
+              'tags': options.tags, 'proposals': options.proposals}
+    runs = []
+    for repeat in range(options.repeat):
+        path = tempfile.mkdtemp(prefix='tarmac-benchmark.')
+        try:
+            runs.append(run_benchmark(path, **params))
+        finally:
+            if options.keep:
+                print('Branches kept in %s' % path)
+            else:
+                shutil.rmtree(path)
+    timings = min(runs, key=lambda run: run['elapsed'])
+    previous = record(options.results, params, timings)
+
+    print('Landed %d proposals in %.2fs, %.3fs each' % (
+            timings['landed'], timings['elapsed'],
+            timings['per_proposal'] or 0))
+    for phase in PHASES + ('authors',):
+        print('%-15s %4d calls %10.4fs total %10.4fs mean' % (
+                phase, timings[phase]['count'], timings[phase]['total'],
+                timings[phase]['mean']))
+    print('%-15s %4d bugs  %10.4fs total' % (
+            'fixed_bugs', timings['fixed_bugs']['count'],
+            timings['fixed_bugs']['total']))
+    if previous is not None:
+        print('\nCompared with version %s:' % previous['version'])
+        for line in compare(previous['timings'], timings):
+            print(line)
+    return 0
+
+
+def startup_main(options):
+    '''Run and report the startup benchmark for the parsed %options.'''
+    params = {'startup': True, 'repeat': options.repeat}
+    path = tempfile.mkdtemp(prefix='tarmac-benchmark.')
+    try:
+        timings = run_startup_benchmark(path, options.repeat)
+    finally:
+        shutil.rmtree(path)
+    previous = record(options.results, params, timings)
+
+    for name, code in STARTUP:
+        print('%-15s %4d runs %10.4fs fastest %10.4fs mean' % (
+                name, timings[name]['count'], timings[name]['min'],
+                timings[name]['mean']))
+    if previous is not None:
+        print('\nCompared with version %s:' % previous['version'])
+        for line in compare(previous['timings'], timings):
+            print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
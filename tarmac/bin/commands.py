@@ -14,41 +14,180 @@
 # You should have received a copy of the GNU General Public License
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 '''Command handling for Tarmac.'''
-import httplib2
+import json
 import logging
 import os
 import re
+import time
 
 from bzrlib.commands import Command
 from bzrlib.errors import PointlessMerge, LockContention
-from bzrlib.help import help_commands
-from launchpadlib.launchpad import Launchpad
-from launchpadlib.uris import (LPNET_SERVICE_ROOT,
-    STAGING_SERVICE_ROOT)
+
+# Head off lint warnings.
+Branch = None
+BranchMirror = None
+Launchpad = None
+ProposalGraph = None
+ThreadPool = None
+help_commands = None
+httplib2 = None
+load_plugins = None
+multiprocessing = None
+uris = None
+
+# Every command is registered whenever tarmac starts, so what only some
+# commands need is imported when they first use it.
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), '''
+    import httplib2
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    from bzrlib.help import help_commands
+    from launchpadlib.launchpad import Launchpad
+    from launchpadlib import uris
+
+    from tarmac.branch import Branch
+    from tarmac.mirror import BranchMirror
+    from tarmac.plugin import load_plugins
+    from tarmac.scheduler import ProposalGraph
+    ''')
 
 from tarmac.bin import options
-from tarmac.branch import Branch
+from tarmac.cache import PersistentCache
 from tarmac.config import BranchConfig
+from tarmac.connection import api_calls, parse_budget, share_between_threads
 from tarmac.hooks import tarmac_hooks
-from tarmac.log import set_up_debug_logging, set_up_logging
+from tarmac.log import (
+    set_up_debug_logging,
+    set_up_logging,
+    set_up_target_logging,
+)
 from tarmac.exceptions import (
     TarmacCommandError,
     TarmacMergeError,
     TarmacMergeSkipError,
     UnapprovedChanges,
 )
-from tarmac.plugin import load_plugins
-
+from tarmac.trace import tracer
+
+
+# The cmd_merge instance driving a parallel run.  Pool workers are forked
+# from the parent, so they inherit it (plugins and all) through this global.
+_worker_command = None
+
+
+def _merge_target_worker(branch_url):
+    """Merge the proposals for one target in a pool worker process.
+
+    Returns a (branch_url, status, detail) tuple for the parent to report,
+    where status is one of 'done', 'locked' or 'error'.
+    """
+    command = _worker_command
+    log_file = set_up_target_logging(command.config, branch_url)
+    try:
+        if command.launchpad is None:
+            command.launchpad = command.get_launchpad_object()
+        command.logger.debug(
+            'Merging approved branches against %(branch)s' % {
+                'branch': branch_url})
+        command._do_merges(branch_url)
+    except LockContention:
+        return (branch_url, 'locked', log_file)
+    except Exception, error:
+        command.logger.exception(
+            'An error occurred trying to merge %s: %s', branch_url, error)
+        return (branch_url, 'error', u'%s (see %s)' % (error, log_file))
+    return (branch_url, 'done', log_file)
+
+
+class _Speculation(object):
+    """Merge the next proposal in a scratch tree, in a background thread.
+
+    Once the current proposal has been merged, the background thread merges
+    it again in a second tree, then opens the next proposal's source branch,
+    checks its approved revision and merges it on top.  Only that work
+    overlaps with the current proposal's tarmac_pre_commit hooks: the
+    current proposal isn't committed until the thread has finished, and the
+    prepared source is taken up when the next proposal is landed.  If the
+    current proposal doesn't land, the speculative work is thrown away and
+    the next proposal is prepared from scratch as usual.
+
+    bzrlib branches can't be shared between threads, so the thread opens
+    its own Branch for each source, and doesn't touch the ones the hooks
+    are given.
+    """
+
+    def __init__(self, command, target, scratch):
+        self.command = command
+        self.target = target
+        self.scratch = scratch
+        self.logger = command.logger
+        self._pool = ThreadPool(1)
+        self._proposal = None
+        self._result = None
+
+    def start(self, source, proposal, next_proposal):
+        """Start merging %next_proposal on top of %proposal from %source."""
+        self.wait()
+        self._proposal = next_proposal
+        try:
+            # Launchpad objects aren't safe to share between threads, so the
+            # Launchpad checks are done here, and only bzr work is put in the
+            # background.
+            self.command._check_proposal(self.target, next_proposal)
+            next_lp_branch = next_proposal.source_branch
+            next_lp_branch.bzr_identity
+        except TarmacMergeError:
+            return
+        self.logger.debug(
+            'Speculatively merging %s' % next_lp_branch.web_link)
+        self._result = self._pool.apply_async(
+            self._merge, (source.lp_branch, str(proposal.reviewed_revid),
+                          next_lp_branch, next_proposal))
+
+    def _merge(self, lp_branch, revid, next_lp_branch, proposal):
+        self.scratch.cleanup()
+        source = Branch.create(lp_branch, self.command.config,
+                               target=self.scratch, mirror=self.target.mirror)
+        self.scratch.merge(source, revid)
+        next_source = self.command._open_source(
+            self.scratch, proposal, lp_branch=next_lp_branch)
+        self.scratch.merge(
+            next_source, str(proposal.reviewed_revid), force=True)
+        next_source.target = self.target
+        return next_source
+
+    def wait(self):
+        """Wait for any speculative merge to finish."""
+        if self._result is not None:
+            self._result.wait()
+
+    def take(self, proposal, landed):
+        """Return the source prepared for %proposal, or None.
+
+        %landed says whether the proposal merged underneath it landed.
+        """
+        result, self._result = self._result, None
+        if result is None or proposal is not self._proposal:
+            return None
+        try:
+            source = result.get()
+        except Exception, error:
+            # Redo it properly, so any failure is reported as usual.
+            self.logger.debug('Speculative merge failed: %s' % error)
+            return None
+        if not landed:
+            self.logger.debug('Discarding speculative merge of %s' %
+                              proposal.source_branch.web_link)
+            return None
+        return source
 
-def _compare_proposals(a, b):
-    """Helper to sort proposals based on a prerequisite branch"""
-    if a.prerequisite_branch is not None:
-        if a.prerequisite_branch.unique_name == b.source_branch.unique_name:
-            return 1
-    if b.prerequisite_branch is not None:
-        if b.prerequisite_branch.unique_name == a.source_branch.unique_name:
-            return -1
-    return 0
+    def close(self):
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+        self.scratch.cleanup()
 
 
 class TarmacCommand(Command):
@@ -69,6 +208,8 @@ class TarmacCommand(Command):
             name = re.sub(r'-', '_', option.name)
             self.config.set('Tarmac', name, False)
 
+        self._identity_cache = None
+
     def _usage(self):
         """Custom _usage for referencing 'tarmac' instead of 'bzr'."""
         s = 'tarmac ' + self.name() + ' '
@@ -94,13 +235,23 @@ class TarmacCommand(Command):
         # putting the credentials file somewhere other than where the cache
         # goes, and that's kinda nasty (and a security issue according to
         # Kees).
+        standin = getattr(self.config, 'launchpad_standin', None)
+        if standin:
+            # A stand-in, such as tarmac.standin, takes any credentials.
+            self.logger.debug(
+                "Connecting to a stand-in Launchpad API at {0}".format(
+                    standin))
+            return share_between_threads(Launchpad.login_anonymously(
+                    u'Tarmac', service_root=standin,
+                    launchpadlib_dir=self.config.CACHE_HOME))
+
         if not filename:
             filename = self.config.CREDENTIALS
 
         if staging:
-            SERVICE_ROOT = STAGING_SERVICE_ROOT
+            SERVICE_ROOT = uris.STAGING_SERVICE_ROOT
         else:
-            SERVICE_ROOT = LPNET_SERVICE_ROOT
+            SERVICE_ROOT = uris.LPNET_SERVICE_ROOT
 
         self.logger.debug(
             "Connecting to the Launchpad API at {0}".format(SERVICE_ROOT))
@@ -117,7 +268,23 @@ class TarmacCommand(Command):
             launchpadlib_dir=self.config.CACHE_HOME)
 
         self.logger.debug("Connected")
-        return launchpad
+        # Proposals are prefetched in several threads.
+        return share_between_threads(launchpad)
+
+    @property
+    def identity_cache(self):
+        '''The cache of Launchpad people and teams, shared by plugins.
+
+        Entries expire after `identity_cache_ttl` seconds (a day by default),
+        and only the `identity_cache_size` most recently used are kept.
+        '''
+        if self._identity_cache is None:
+            self._identity_cache = PersistentCache(
+                os.path.join(self.config.CACHE_HOME, 'identities.json'),
+                ttl=int(getattr(self.config, 'identity_cache_ttl', 86400)),
+                max_entries=int(
+                    getattr(self.config, 'identity_cache_size', 10000)))
+        return self._identity_cache
 
 
 class cmd_authenticate(TarmacCommand):
@@ -175,10 +342,22 @@ class cmd_merge(TarmacCommand):
         options.imply_commit_message_option,
         options.one_option,
         options.list_approved_option,
+        options.jobs_option,
     ]
 
+    def __init__(self, registry):
+        TarmacCommand.__init__(self, registry)
+
+        # Prefetched prerequisite proposals, by id() of the proposal.
+        self._prerequisites = {}
+
     def _handle_merge_error(self, proposal, failure):
         """Handle TarmacMergeError cases from _do_merges."""
+        with api_calls.attribute('merge_error'):
+            self._report_merge_error(proposal, failure)
+
+    def _report_merge_error(self, proposal, failure):
+        """Comment on %proposal about %failure, and set it back."""
         self.logger.warn(
             u'Merging %(source)s into %(target)s failed: %(msg)s' %
             {'source': proposal.source_branch.web_link,
@@ -204,12 +383,56 @@ class cmd_merge(TarmacCommand):
 
     def _do_merges(self, branch_url):
         """Merge the approved proposals for %branch_url."""
-        lp_branch = self.launchpad.branches.getByUrl(url=branch_url)
-        if lp_branch is None:
-            self.logger.info('Not a valid branch: {0}'.format(branch_url))
+        with tracer.span('merge_target', target=branch_url):
+            api_calls.reset()
+            try:
+                return self._merge_target(branch_url)
+            finally:
+                self._report_api_calls(branch_url)
+
+    def _report_api_calls(self, branch_url):
+        """Log the Launchpad API requests made while merging %branch_url.
+
+        A warning is logged for each part of Tarmac which made more requests
+        than the `api_call_budget` of the target, or of [Tarmac], allows.
+        """
+        summary = api_calls.summary()
+        self.logger.info(
+            'Made %d Launchpad API calls in %.2fs for %s' % (
+                sum(calls['calls'] for calls in summary.values()),
+                sum(calls['time'] for calls in summary.values()),
+                branch_url))
+        for owner, calls in sorted(summary.items()):
+            self.logger.debug('  %s made %d calls in %.2fs' % (
+                    owner, calls['calls'], calls['time']))
+        budget = BranchConfig(branch_url, self.config).get(
+            'api_call_budget', getattr(self.config, 'api_call_budget', None))
+        if not budget:
             return
-
-        proposals = self._get_mergable_proposals_for_branch(lp_branch)
+        try:
+            budget = parse_budget(budget)
+        except ValueError:
+            self.logger.warn('Invalid api_call_budget: %s' % budget)
+            return
+        for owner, count in sorted(api_calls.over_budget(budget).items()):
+            self.logger.warn(
+                '%s made %d Launchpad API calls for %s, over its budget of '
+                '%d' % (owner, count, branch_url, budget[owner]))
+
+    def _merge_target(self, branch_url):
+        """Merge the approved proposals for %branch_url, untraced."""
+        self._prerequisites = {}
+        tarmac_hooks.timings.reset()
+        with tracer.span('launchpad_fetch'):
+            with api_calls.attribute('candidates'):
+                lp_branch = self.launchpad.branches.getByUrl(url=branch_url)
+                if lp_branch is None:
+                    self.logger.info(
+                        'Not a valid branch: {0}'.format(branch_url))
+                    return
+
+                proposals = self._get_mergable_proposals_for_branch(
+                    lp_branch)
 
         if not proposals:
             self.logger.info(
@@ -223,8 +446,7 @@ class cmd_merge(TarmacCommand):
             return
 
         try:
-            target = Branch.create(lp_branch, self.config, create_tree=True,
-                                   launchpad=self.launchpad)
+            target = self._get_target(lp_branch)
         except TarmacMergeError as failure:
             self._handle_merge_error(proposals[0], failure)
             return
@@ -233,79 +455,271 @@ class cmd_merge(TarmacCommand):
         tarmac_hooks.fire('tarmac_pre_merge',
                           self, target)
 
+        batch_size = 1
+        if not self.config.one:
+            batch_size = int(target.config.get('merge_batch_size', 1))
+
         success_count = 0
         try:
-            for proposal in proposals:
-                target.cleanup()
-                self.logger.debug(
-                    u'Preparing to merge %(source_branch)s' % {
-                        'source_branch': proposal.source_branch.web_link})
+            if batch_size > 1:
+                for i in range(0, len(proposals), batch_size):
+                    success_count += self._land_batch(
+                        target, proposals[i:i + batch_size])
+            else:
+                speculation = None
+                if (target.config.get_boolean('speculative_merge') and
+                    not self.config.one and len(proposals) > 1):
+                    speculation = _Speculation(
+                        self, target, self._get_scratch_target(target))
+                landed = None
                 try:
-                    prerequisite = proposal.prerequisite_branch
-                    if prerequisite:
-                        merges = self._get_prerequisite_proposals(proposal)
-                        if len(merges) == 0:
-                            raise TarmacMergeError(
-                                u'No proposals of prerequisite branch.',
-                                u'No proposals found for merge of %s '
-                                u'into %s.' % (
-                                    prerequisite.web_link,
-                                    target.lp_branch.web_link))
-                        elif len(merges) > 1:
-                            raise TarmacMergeError(
-                                u'Too many proposals of prerequisite.',
-                                u'More than one proposal found for merge '
-                                u'of %s into %s, which is not Superseded.' % (
-                                    prerequisite.web_link,
-                                    target.lp_branch.web_link))
-
-                    if not proposal.reviewed_revid:
-                        raise TarmacMergeError(
-                            u'No approved revision specified.')
-
-
-                    source = Branch.create(
-                        proposal.source_branch, self.config, target=target)
-
-                    approved = source.bzr_branch.revision_id_to_revno(
-                        str(proposal.reviewed_revid))
-                    tip = source.bzr_branch.revno()
-
-                    if tip > approved:
-                        message = u'Unapproved changes made after approval'
-                        lp_comment = (
-                            u'There are additional revisions which have not '
-                            u'been approved in review. Please seek review and '
-                            u'approval of these new revisions.')
-                        raise UnapprovedChanges(message, lp_comment)
-
-                    self.logger.debug(
-                        'Merging %(source)s at revision %(revision)s' % {
-                            'source': proposal.source_branch.web_link,
-                            'revision': proposal.reviewed_revid})
+                    for i, proposal in enumerate(proposals):
+                        source = None
+                        if speculation is not None:
+                            source = speculation.take(proposal, landed)
+                        next_proposal = None
+                        if i + 1 < len(proposals):
+                            next_proposal = proposals[i + 1]
+                        landed = self._land_proposal(
+                            target, proposal, source=source,
+                            speculation=speculation,
+                            next_proposal=next_proposal)
+                        if landed:
+                            success_count += 1
+                        # If we've been asked to only merge one branch, then
+                        # exit, unless the proposal was skipped.
+                        if self.config.one and landed is not None:
+                            return True
+                finally:
+                    if speculation is not None:
+                        speculation.close()
 
-                    target.merge(source, str(proposal.reviewed_revid))
+        # This except is here because we need the else and can't have it
+        # without an except as well.
+        except:
+            raise
+        else:
+            self.logger.debug('Firing tarmac_post_merge hook')
+            tarmac_hooks.fire('tarmac_post_merge',
+                              self, target, success_count=success_count)
+        finally:
+            target.cleanup()
+            if self._identity_cache is not None:
+                self._identity_cache.save()
+            self._write_hook_metrics(branch_url)
+
+    def _write_hook_metrics(self, branch_url):
+        """Record the time each plug-in took while merging into %branch_url.
 
-                    self.logger.debug('Firing tarmac_pre_commit hook')
+        A line of JSON is appended to `hook_metrics_file`, which defaults to
+        hook-metrics.jsonl in CACHE_HOME.
+        """
+        path = getattr(self.config, 'hook_metrics_file', None)
+        if not path:
+            path = os.path.join(self.config.CACHE_HOME, 'hook-metrics.jsonl')
+        for hook_name, plugins in sorted(
+                tarmac_hooks.timings.summary().items()):
+            for plugin, timing in sorted(plugins.items()):
+                self.logger.debug(
+                    '%s took %.2fs (%.2fs CPU) in %d calls of %s' % (
+                        plugin, timing['wall'], timing['cpu'],
+                        timing['calls'], hook_name))
+        try:
+            tarmac_hooks.timings.write(path, target=branch_url)
+        except (IOError, OSError), error:
+            self.logger.warn('Could not write hook metrics to %s: %s' % (
+                    path, error))
+
+    def _check_proposal(self, target, proposal):
+        """Check the Launchpad side of %proposal is ready to be merged.
+
+        Raises TarmacMergeError if it is not.
+        """
+        prerequisite = proposal.prerequisite_branch
+        if prerequisite:
+            merges = self._get_prerequisite_proposals(proposal)
+            if len(merges) == 0:
+                raise TarmacMergeError(
+                    u'No proposals of prerequisite branch.',
+                    u'No proposals found for merge of %s '
+                    u'into %s.' % (
+                        prerequisite.web_link,
+                        target.lp_branch.web_link))
+            elif len(merges) > 1:
+                raise TarmacMergeError(
+                    u'Too many proposals of prerequisite.',
+                    u'More than one proposal found for merge '
+                    u'of %s into %s, which is not Superseded.' % (
+                        prerequisite.web_link,
+                        target.lp_branch.web_link))
+
+        if not proposal.reviewed_revid:
+            raise TarmacMergeError(
+                u'No approved revision specified.')
+
+    def _open_source(self, target, proposal, lp_branch=None):
+        """Open the source Branch of %proposal, to be merged into %target.
+
+        %lp_branch is the proposal's source branch, if it has already been
+        looked up on Launchpad.  Raises UnapprovedChanges if it has revisions
+        past the approved one.
+        """
+        if lp_branch is None:
+            lp_branch = proposal.source_branch
+        with tracer.span('open_source'):
+            source = Branch.create(
+                lp_branch, self.config, target=target, mirror=target.mirror)
+
+            with tracer.span('revision_id_to_revno'):
+                approved = source.bzr_branch.revision_id_to_revno(
+                    str(proposal.reviewed_revid))
+                tip = source.bzr_branch.revno()
+
+        if tip > approved:
+            message = u'Unapproved changes made after approval'
+            lp_comment = (
+                u'There are additional revisions which have not '
+                u'been approved in review. Please seek review and '
+                u'approval of these new revisions.')
+            raise UnapprovedChanges(message, lp_comment)
+        return source
+
+    def _merge_proposal(self, target, proposal, force=False, source=None):
+        """Merge the approved revision of %proposal into the target tree.
+
+        Returns the source Branch.  Raises TarmacMergeError if the proposal
+        can not be merged.  Set %force to merge on top of other proposals.
+        A %source already checked and opened by a speculative merge is used
+        as it is.
+        """
+        self.logger.debug(
+            u'Preparing to merge %(source_branch)s' % {
+                'source_branch': proposal.source_branch.web_link})
+        if source is None:
+            self._check_proposal(target, proposal)
+            source = self._open_source(target, proposal)
+
+        self.logger.debug(
+            'Merging %(source)s at revision %(revision)s' % {
+                'source': proposal.source_branch.web_link,
+                'revision': proposal.reviewed_revid})
+
+        target.merge(source, str(proposal.reviewed_revid), force=force)
+        return source
+
+    def _commit_proposal(self, target, source, proposal):
+        """Commit the merged %proposal, and fire the post-commit hooks."""
+        revprops = {'merge_url': proposal.web_link}
+
+        commit_message = proposal.commit_message
+        if commit_message is None and self.config.imply_commit_message:
+            commit_message = proposal.description
+        target.commit(commit_message,
+                     revprops=revprops,
+                     authors=source.authors,
+                     reviews=self._get_reviews(proposal))
+        target.merge_tags(source)
+
+        self.logger.debug('Firing tarmac_post_commit hook')
+        tarmac_hooks.fire('tarmac_post_commit',
+                          self, target, source, proposal)
+
+    def _land_proposal(self, target, proposal, source=None,
+                       speculation=None, next_proposal=None):
+        """Merge, check and commit a single proposal.
+
+        Returns True if the proposal landed, False if it failed and the
+        failure was reported on it, or None if it was skipped.  With a
+        %speculation, %next_proposal is merged in its scratch tree while
+        this one is being checked.
+        """
+        with tracer.span('land_proposal', proposal=proposal.web_link):
+            target.cleanup()
+            try:
+                source = self._merge_proposal(target, proposal, source=source)
+
+                if speculation is not None and next_proposal is not None:
+                    speculation.start(source, proposal, next_proposal)
+
+                self.logger.debug('Firing tarmac_pre_commit hook')
+                tarmac_hooks.fire('tarmac_pre_commit',
+                                  self, target, source, proposal)
+
+            except TarmacMergeError as failure:
+                self._handle_merge_error(proposal, failure)
+                return False
+            except TarmacMergeSkipError as failure:
+                self.logger.warn(
+                    'Skipping merge of %(source)s into %(target)s:'
+                    ' %(msg)s' % {
+                        'source': proposal.source_branch.web_link,
+                        'target': proposal.target_branch.web_link,
+                        'msg': str(failure),
+                    })
+                target.cleanup()
+                return None
+            except PointlessMerge:
+                self.logger.warn(
+                    'Merging %(source)s into %(target)s would be '
+                    'pointless.' % {
+                        'source': proposal.source_branch.web_link,
+                        'target': proposal.target_branch.web_link})
+                return None
+
+            if speculation is not None:
+                # Don't commit while the scratch tree is still merging from the
+                # same branch.
+                speculation.wait()
+            self._commit_proposal(target, source, proposal)
+            target.cleanup()
+            return True
+
+    def _land_batch(self, target, batch):
+        """Land %batch as a merge train, returning how many landed.
+
+        All of the proposals are merged into the tree together, and the
+        tarmac_pre_commit hooks check the combined result.  If that passes,
+        the proposals are merged again one at a time and each gets its own
+        commit.  If anything fails, the batch is split in half and each half
+        is tried in turn, until the failing proposals are found on their own
+        and reported as usual.
+        """
+        if len(batch) == 1:
+            return int(bool(self._land_proposal(target, batch[0])))
+
+        target.cleanup()
+        merged = []
+        try:
+            for proposal in batch:
+                with tracer.span('merge_proposal',
+                                 proposal=proposal.web_link):
+                    merged.append((self._merge_proposal(
+                        target, proposal, force=bool(merged)), proposal))
+
+            self.logger.debug(
+                'Firing tarmac_pre_commit hook for a batch of %d' % len(batch))
+            for source, proposal in merged:
+                with tracer.span('check_proposal',
+                                 proposal=proposal.web_link):
                     tarmac_hooks.fire('tarmac_pre_commit',
                                       self, target, source, proposal)
-
+        except (TarmacMergeError, TarmacMergeSkipError,
+                PointlessMerge) as failure:
+            self.logger.info(
+                'Batch of %(count)d proposals failed (%(msg)s), '
+                'bisecting' % {'count': len(batch), 'msg': failure})
+            half = len(batch) // 2
+            return (self._land_batch(target, batch[:half]) +
+                    self._land_batch(target, batch[half:]))
+
+        landed = 0
+        target.cleanup()
+        for source, proposal in merged:
+            with tracer.span('commit_proposal', proposal=proposal.web_link):
+                try:
+                    target.merge(source, str(proposal.reviewed_revid))
                 except TarmacMergeError as failure:
                     self._handle_merge_error(proposal, failure)
-
-                    # If we've been asked to only merge one branch, then exit.
-                    if self.config.one:
-                        return True
-
-                    continue
-                except TarmacMergeSkipError as failure:
-                    self.logger.warn(
-                        'Skipping merge of %(source)s into %(target)s:'
-                        ' %(msg)s' % {
-                            'source': proposal.source_branch.web_link,
-                            'target': proposal.target_branch.web_link,
-                            'msg': str(failure),
-                        })
                     target.cleanup()
                     continue
                 except PointlessMerge:
@@ -315,36 +729,41 @@ class cmd_merge(TarmacCommand):
                             'source': proposal.source_branch.web_link,
                             'target': proposal.target_branch.web_link})
                     continue
+                self._commit_proposal(target, source, proposal)
+                landed += 1
+        target.cleanup()
+        return landed
+
+    def _get_target(self, lp_branch):
+        """Return the target Branch for %lp_branch, with a clean tree."""
+        config = BranchConfig(lp_branch.bzr_identity, self.config)
+        return Branch.create(lp_branch, self.config, create_tree=True,
+                             launchpad=self.launchpad,
+                             mirror=self._get_mirror(config))
+
+    def _get_mirror(self, config):
+        """Return the BranchMirror to use for a target, or None.
+
+        Targets with `mirror_branches` set share one mirror in CACHE_HOME.
+        """
+        if not config.get_boolean('mirror_branches'):
+            return None
+        return BranchMirror(os.path.join(self.config.CACHE_HOME, 'mirrors'))
 
-                revprops = {'merge_url': proposal.web_link}
-
-                commit_message = proposal.commit_message
-                if commit_message is None and self.config.imply_commit_message:
-                    commit_message = proposal.description
-                target.commit(commit_message,
-                             revprops=revprops,
-                             authors=source.authors,
-                             reviews=self._get_reviews(proposal))
-                target.merge_tags(source)
-
-                self.logger.debug('Firing tarmac_post_commit hook')
-                tarmac_hooks.fire('tarmac_post_commit',
-                                  self, target, source, proposal)
-                success_count += 1
-                target.cleanup()
-                if self.config.one:
-                    return True
+    def _get_scratch_target(self, target):
+        """Return a second Branch and tree for %target's branch.
 
-        # This except is here because we need the else and can't have it
-        # without an except as well.
-        except:
-            raise
-        else:
-            self.logger.debug('Firing tarmac_post_merge hook')
-            tarmac_hooks.fire('tarmac_post_merge',
-                              self, target, success_count=success_count)
-        finally:
-            target.cleanup()
+        Speculative merges happen in this tree, next to the target's own
+        tree_dir, or in a temp dir if the target has none.
+        """
+        scratch = Branch.create(target.lp_branch, self.config,
+                                launchpad=self.launchpad,
+                                mirror=target.mirror)
+        tree_dir = target.config.get('tree_dir')
+        if tree_dir:
+            tree_dir = tree_dir.rstrip('/') + '.speculative'
+        scratch.create_tree(tree_dir)
+        return scratch
 
     def _get_mergable_proposals_for_branch(self, lp_branch):
         """
@@ -353,35 +772,70 @@ class cmd_merge(TarmacCommand):
         """
         proposals = []
         branch_config = BranchConfig(lp_branch.bzr_identity, self.config)
-        sorted_proposals = sorted(
-            lp_branch.landing_candidates, cmp=_compare_proposals)
+        sorted_proposals, cyclic = ProposalGraph(
+            self._prefetch_proposals(lp_branch)).sort()
+        for entry in cyclic:
+            self.logger.warn(
+                'Skipping merge proposal %s: its prerequisites depend on '
+                'it.' % entry.web_link)
         for entry in sorted_proposals:
             self.logger.debug("Considering merge proposal: {0}".format(entry.web_link))
-            prereqs = self._get_prerequisite_proposals(entry)
-
-            if entry.queue_status != u'Approved':
-                self.logger.debug(
-                    "  Skipping proposal: status is {0}, not "
-                    "'Approved'".format(entry.queue_status))
-                continue
-
-            if (not self.config.imply_commit_message and
-                not branch_config.commit_message_template and 
-                not entry.commit_message):
-                self.logger.debug(
-                    "  Skipping proposal: proposal has no commit message")
-                continue
-
-            if len(prereqs) == 1 and prereqs[0].queue_status != u'Merged':
-                # N.B.: The case of a MP with more than one prereq MP open
-                #       will be caught as a merge error.
-                self.logger.debug(
-                    "  Skipping proposal: prerequisite not yet merged")
+            reason = self._get_skip_reason(entry, branch_config)
+            if reason is not None:
+                self.logger.debug("  Skipping proposal: " + reason)
                 continue
 
             proposals.append(entry)
         return proposals
 
+    def _get_skip_reason(self, entry, branch_config):
+        """Return why proposal %entry won't be merged yet, or None."""
+        prereqs = self._get_prerequisite_proposals(entry)
+
+        if entry.queue_status != u'Approved':
+            return "status is {0}, not 'Approved'".format(entry.queue_status)
+
+        if (not self.config.imply_commit_message and
+            not branch_config.get('commit_message_template') and
+            not entry.commit_message):
+            return "proposal has no commit message"
+
+        if len(prereqs) == 1 and prereqs[0].queue_status != u'Merged':
+            # N.B.: The case of a MP with more than one prereq MP open
+            #       will be caught as a merge error.
+            return "prerequisite not yet merged"
+
+        return None
+
+    def _prefetch_proposals(self, lp_branch):
+        """Return the landing candidates for %lp_branch.
+
+        The prerequisite proposals of each candidate are looked up at the
+        same time, in up to `prefetch_threads` threads (8 by default), and
+        remembered by _get_prerequisite_proposals for the rest of the run.
+        """
+        candidates = list(lp_branch.landing_candidates)
+        threads = min(int(getattr(self.config, 'prefetch_threads', 8)),
+                      len(candidates))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                prerequisites = pool.map(
+                    self._prefetch_prerequisite_proposals, candidates)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            prerequisites = map(self._find_prerequisite_proposals, candidates)
+        for candidate, prereqs in zip(candidates, prerequisites):
+            self._prerequisites[id(candidate)] = (candidate, prereqs)
+        return candidates
+
+    def _prefetch_prerequisite_proposals(self, proposal):
+        """Look up the prerequisite proposals of %proposal in a thread."""
+        with api_calls.attribute('candidates'):
+            return self._find_prerequisite_proposals(proposal)
+
     def _get_prerequisite_proposals(self, proposal):
         """
         Given a proposal, return all prerequisite
@@ -389,6 +843,17 @@ class cmd_merge(TarmacCommand):
         should be one and only one here (or zero), but sometimes there
         are not, depending on developer habits
         """
+        try:
+            candidate, prereqs = self._prerequisites[id(proposal)]
+        except KeyError:
+            pass
+        else:
+            if candidate is proposal:
+                return prereqs
+        return self._find_prerequisite_proposals(proposal)
+
+    def _find_prerequisite_proposals(self, proposal):
+        """Look up the prerequisite proposals of %proposal on Launchpad."""
         prerequisite = proposal.prerequisite_branch
         target_branch = proposal.target_branch
         if not prerequisite or not prerequisite.landing_targets:
@@ -412,7 +877,56 @@ class cmd_merge(TarmacCommand):
 
         return reviews
 
-    def run(self, branch_url=None, launchpad=None, **kwargs):
+    def _merge_in_parallel(self, branches, jobs):
+        """Run _do_merges for each of %branches in a pool of %jobs processes.
+
+        Every target is handled by its own worker, using its own tree_dir
+        and log file, so the run takes about as long as the slowest target.
+        """
+        tree_dirs = {}
+        for branch in branches:
+            if not self.config.has_option(branch, 'tree_dir'):
+                # Targets without a tree_dir get their own temp dir.
+                continue
+            tree_dir = os.path.realpath(self.config.get(branch, 'tree_dir'))
+            if tree_dir in tree_dirs:
+                raise TarmacCommandError(
+                    '%s and %s share the tree_dir %s, and can not be merged '
+                    'in parallel.' % (tree_dirs[tree_dir], branch, tree_dir))
+            tree_dirs[tree_dir] = branch
+
+        global _worker_command
+        _worker_command = self
+        pool = multiprocessing.Pool(processes=min(jobs, len(branches)))
+        failed = []
+        try:
+            for branch, status, detail in pool.imap_unordered(
+                    _merge_target_worker, branches):
+                if status == 'error':
+                    self.logger.error(
+                        'An error occurred trying to merge %s: %s',
+                        branch, detail)
+                    failed.append(branch)
+                elif status == 'locked':
+                    self.logger.warn(
+                        'Skipped %s, its branch is locked.' % branch)
+                else:
+                    self.logger.info(
+                        'Finished merging %s, logged to %s' % (branch, detail))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_command = None
+
+        if failed:
+            raise TarmacCommandError(
+                'Merging failed for: %s' % ', '.join(sorted(failed)))
+
+    def _set_up(self, launchpad=None, **kwargs):
+        """Apply the command options, and set up logging and plug-ins."""
         for key, value in kwargs.iteritems():
             self.config.set('Tarmac', key, value)
 
@@ -422,16 +936,63 @@ class cmd_merge(TarmacCommand):
         if self.config.http_debug:
             httplib2.debuglevel = 1
             self.logger.debug('HTTP debugging enabled.')
+        trace_file = getattr(self.config, 'trace_file', None)
+        if trace_file:
+            try:
+                tracer.configure(
+                    trace_file, getattr(self.config, 'trace_format', 'jsonl'))
+            except ValueError, error:
+                raise TarmacCommandError(str(error))
         self.logger.debug('Loading plugins')
-        load_plugins()
+        load_plugins(config=self.config)
         self.logger.debug('Plugins loaded')
 
         self.launchpad = launchpad
+
+    def _connect(self):
+        """Log in to Launchpad, unless a launchpad object was given."""
         if self.launchpad is None:
             self.logger.debug('Loading launchpad object')
             self.launchpad = self.get_launchpad_object()
             self.logger.debug('launchpad object loaded')
 
+    def _merge_branches(self, branches):
+        """Merge the approved proposals for each of %branches in turn."""
+        for branch in branches:
+            self.logger.debug(
+                'Merging approved branches against %(branch)s' % {
+                    'branch': branch})
+            try:
+                merged = self._do_merges(branch)
+
+                # If we've been asked to only merge one branch, then exit.
+                if merged and self.config.one:
+                    break
+            except LockContention:
+                continue
+            except Exception, error:
+                self._handle_branch_error(branch, error)
+
+    def _handle_branch_error(self, branch, error):
+        """Handle an unexpected error merging into %branch.
+
+        The error is logged and re-raised, ending the run.
+        """
+        self.logger.error(
+            'An error occurred trying to merge %s: %s', branch, error)
+        raise
+
+    def run(self, branch_url=None, launchpad=None, **kwargs):
+        self._set_up(launchpad, **kwargs)
+
+        jobs = int(self.config.jobs or 1)
+        parallel = (not branch_url and not self.config.one and jobs > 1 and
+                    len(self.config.branches) > 1)
+        if not parallel:
+            # Parallel workers each open their own connection instead of
+            # sharing one across forked processes.
+            self._connect()
+
         if branch_url:
             self.logger.debug('%(branch_url)s specified as branch_url' % {
                 'branch_url': branch_url})
@@ -439,22 +1000,223 @@ class cmd_merge(TarmacCommand):
                 raise TarmacCommandError('Branch urls must start with lp:')
             self._do_merges(branch_url)
 
+        elif parallel:
+            self._merge_in_parallel(self.config.branches, jobs)
+
         else:
-            for branch in self.config.branches:
-                self.logger.debug(
-                    'Merging approved branches against %(branch)s' % {
-                        'branch': branch})
-                try:
-                    merged = self._do_merges(branch)
+            self._merge_branches(self.config.branches)
 
-                    # If we've been asked to only merge one branch, then exit.
-                    if merged and self.config.one:
-                        break
-                except LockContention:
-                    continue
-                except Exception, error:
-                    self.logger.error(
-                        'An error occurred trying to merge %s: %s',
-                        branch, error)
-                    raise
 
+class cmd_queue(cmd_merge):
+    '''Show the merge proposals queued for every target, as JSON.
+
+    The targets are queried concurrently, in up to `queue_threads` threads
+    (8 by default).  Each landing candidate is listed in the order it would
+    be merged, with its status, why it would be skipped if it would be, and
+    the chain of prerequisite proposals it waits for.
+    '''
+
+    takes_args = []
+    takes_options = [
+        options.http_debug_option,
+        options.debug_option,
+        options.imply_commit_message_option,
+    ]
+
+    def _get_prerequisite_chain(self, proposal):
+        """Return the prerequisites of %proposal, and theirs, in turn."""
+        chain = []
+        seen = set([id(proposal)])
+        prereqs = self._get_prerequisite_proposals(proposal)
+        while prereqs:
+            chain.extend({'proposal': prereq.web_link,
+                          'status': prereq.queue_status}
+                         for prereq in prereqs)
+            # More than one open prerequisite is a merge error, and a merged
+            # one doesn't hold anything up.
+            if (len(prereqs) > 1 or id(prereqs[0]) in seen or
+                    prereqs[0].queue_status == u'Merged'):
+                break
+            seen.add(id(prereqs[0]))
+            prereqs = self._get_prerequisite_proposals(prereqs[0])
+        return chain
+
+    def _get_queue(self, branch_url):
+        """Return the queue of proposals for %branch_url, for JSON."""
+        queue = {'target': branch_url}
+        try:
+            with api_calls.attribute('candidates'):
+                lp_branch = self.launchpad.branches.getByUrl(url=branch_url)
+                if lp_branch is None:
+                    queue['error'] = 'Not a valid branch'
+                    return queue
+
+                branch_config = BranchConfig(
+                    lp_branch.bzr_identity, self.config)
+                sorted_proposals, cyclic = ProposalGraph(
+                    self._prefetch_proposals(lp_branch)).sort()
+                cyclic_ids = set(id(entry) for entry in cyclic)
+                queue['candidates'] = candidates = []
+                for entry in sorted_proposals + cyclic:
+                    if id(entry) in cyclic_ids:
+                        reason = 'its prerequisites depend on it'
+                    else:
+                        reason = self._get_skip_reason(entry, branch_config)
+                    candidates.append({
+                        'proposal': entry.web_link,
+                        'source': entry.source_branch.bzr_identity,
+                        'status': entry.queue_status,
+                        'mergeable': reason is None,
+                        'skip_reason': reason,
+                        'prerequisites': self._get_prerequisite_chain(entry),
+                        })
+        except Exception, error:
+            self.logger.error(
+                'An error occurred listing the queue for %s: %s',
+                branch_url, error)
+            queue['error'] = str(error)
+        return queue
+
+    def run(self, launchpad=None, **kwargs):
+        self._set_up(launchpad, **kwargs)
+        self._connect()
+
+        branches = self.config.branches
+        threads = min(int(getattr(self.config, 'queue_threads', 8)),
+                      len(branches))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                queues = pool.map(self._get_queue, branches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            queues = map(self._get_queue, branches)
+        self.outf.write(json.dumps(queues, indent=2, sort_keys=True) + '\n')
+
+
+class cmd_serve(cmd_merge):
+    '''Keep merging approved merge proposals, polling at an interval.
+
+    Unlike starting `tarmac merge` from cron or a shell loop, the Launchpad
+    session, the loaded plug-ins and the target trees are kept across runs,
+    so each poll only pays for the work it actually has to do.
+    '''
+
+    aliases = ['daemon']
+    takes_args = []
+    takes_options = [
+        options.http_debug_option,
+        options.debug_option,
+        options.imply_commit_message_option,
+        options.interval_option,
+    ]
+
+    # Seconds between runs if neither --interval nor poll_interval is set.
+    DEFAULT_INTERVAL = 300
+
+    def __init__(self, registry):
+        cmd_merge.__init__(self, registry)
+
+        # The merge machinery checks these, but serve always runs them off.
+        for name in ['one', 'list_approved', 'jobs']:
+            self.config.set('Tarmac', name, False)
+        self._targets = {}
+        # The number of runs to make before returning; None runs forever.
+        self._cycles = None
+
+    def _get_target(self, lp_branch):
+        """Return the cached target Branch for %lp_branch, if there is one.
+
+        The cached tree is refreshed against the freshly fetched Launchpad
+        branch and the current config, instead of being checked out again.
+        The bzr branch itself is kept open, as it re-reads its tip whenever
+        it is locked.  A changed tree_dir gets a fresh tree.
+        """
+        config = BranchConfig(lp_branch.bzr_identity, self.config)
+        target = self._targets.get(lp_branch.bzr_identity)
+        if (target is not None and
+            target.config.get('tree_dir') != config.get('tree_dir')):
+            target = None
+
+        if target is None:
+            target = cmd_merge._get_target(self, lp_branch)
+            self._targets[lp_branch.bzr_identity] = target
+        else:
+            target.lp_branch = lp_branch
+            target.config = config
+            target.mirror = self._get_mirror(config)
+            target.update_mirror()
+            target.cleanup()
+        return target
+
+    def _handle_branch_error(self, branch, error):
+        """Log the error and carry on serving the other branches.
+
+        The state of a cached tree can't be trusted after a failure, so all
+        of them are checked out afresh on the next run.
+        """
+        self.logger.exception(
+            'An error occurred trying to merge %s: %s', branch, error)
+        self._targets.clear()
+
+    def _get_interval(self):
+        """Return the number of seconds to wait between merge runs."""
+        if self.config.interval is not False:
+            return int(self.config.interval)
+        if self.config.has_option('Tarmac', 'poll_interval'):
+            return int(self.config.get('Tarmac', 'poll_interval'))
+        return self.DEFAULT_INTERVAL
+
+    def _write_pid_file(self):
+        """Write the PID file, unless another daemon is still running."""
+        try:
+            with open(self.config.PID_FILE) as pid_file:
+                pid = int(pid_file.read().strip())
+        except (IOError, ValueError):
+            pass
+        else:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                self.logger.debug('Removing stale PID file for %d' % pid)
+            else:
+                raise TarmacCommandError(
+                    'tarmac is already running with PID %d (%s)' % (
+                        pid, self.config.PID_FILE))
+
+        with open(self.config.PID_FILE, 'w') as pid_file:
+            pid_file.write('%d\n' % os.getpid())
+
+    def _remove_pid_file(self):
+        try:
+            os.remove(self.config.PID_FILE)
+        except OSError:
+            pass
+
+    def run(self, launchpad=None, **kwargs):
+        self._set_up(launchpad, **kwargs)
+        self._write_pid_file()
+        try:
+            self._connect()
+            interval = self._get_interval()
+            self.logger.info(
+                'Serving %d branches, polling every %d seconds' % (
+                    len(self.config.branches), interval))
+            count = 0
+            while True:
+                self.logger.debug('Starting merge run')
+                self.config.reload()
+                # Targets added to the config may need more plugins.
+                load_plugins(config=self.config)
+                self._merge_branches(self.config.branches)
+
+                count += 1
+                if self._cycles is not None and count >= self._cycles:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            self.logger.info('Interrupted, shutting down')
+        finally:
+            self._remove_pid_file()
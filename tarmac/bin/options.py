@@ -36,3 +36,9 @@ one_option = Option(
 list_approved_option = Option(
     'list-approved', short_name='l',
     help='List Approved merge proposals for the target branch.')
+jobs_option = Option(
+    'jobs', short_name='j', type=int, argname='N',
+    help='Merge up to N target branches in parallel processes.')
+interval_option = Option(
+    'interval', type=int, argname='SECONDS',
+    help='Seconds to wait between merge runs.')
@@ -19,32 +19,60 @@ import logging
 import os
 import shutil
 import tempfile
+from collections import OrderedDict
 
 from bzrlib import branch as bzr_branch
-from bzrlib.errors import NoSuchRevision
+from bzrlib.errors import PointlessMerge
 from bzrlib.workingtree import WorkingTree
 
+from tarmac.cache import PersistentCache
 from tarmac.config import BranchConfig
+from tarmac.trace import traced
 from tarmac.exceptions import (
     BranchHasConflicts,
     InvalidWorkingTree,
     TarmacMergeError,
 )
 
+# How many revisions are read from a repository at once.
+REVISION_BATCH_SIZE = 100
+# How many revisions' fixed bugs are kept in the index in CACHE_HOME.
+BUG_INDEX_SIZE = 10000
+LAUNCHPAD_BUGS = 'https://launchpad.net/bugs/'
+
 
 class Branch(object):
 
-    def __init__(self, lp_branch, config=False, target=None, launchpad=None):
+    def __init__(self, lp_branch, config=False, target=None, launchpad=None,
+                 mirror=None):
         self.lp_branch = lp_branch
         self.bzr_branch = bzr_branch.Branch.open(self.lp_branch.bzr_identity)
+        # With a mirror, history is read from a local copy of the branch.
+        # Source branches are only ever read, so they are used from the
+        # mirror entirely, but targets are committed to directly.
+        self.mirror = mirror
+        self.update_mirror()
+        if target is not None:
+            self.bzr_branch = self.local_branch
         if config:
             self.config = BranchConfig(lp_branch.bzr_identity, config)
         else:
             self.config = None
+        cache_home = getattr(config, 'CACHE_HOME', None)
+        if cache_home:
+            self._bug_index_path = os.path.join(cache_home, 'fixed-bugs.json')
+        else:
+            self._bug_index_path = None
+        self._bug_index = None
 
         self.launchpad = launchpad
         self.target = target
         self.logger = logging.getLogger('tarmac')
+        # Paths changed by merges since the tree was last cleaned up, or
+        # None if they aren't known.
+        self._touched = None
+        # The authors found for each (source tip, target tip) pair.
+        self._authors = {}
 
     def __del__(self):
         """Do some potentially necessary cleanup during deletion."""
@@ -56,22 +84,37 @@ class Branch(object):
             pass
 
     @classmethod
+    @traced('create_branch')
     def create(cls, lp_branch, config, create_tree=False, target=None,
-               launchpad=None):
+               launchpad=None, mirror=None):
         clazz = cls(lp_branch, config=config, target=target,
-                    launchpad=launchpad)
+                    launchpad=launchpad, mirror=mirror)
         if create_tree:
             clazz.create_tree()
         return clazz
 
-    def create_tree(self):
-        '''Create the dir and working tree.'''
+    def update_mirror(self):
+        '''Bring the local copy of the branch up to date, if it has one.'''
+        if self.mirror is None:
+            self.local_branch = self.bzr_branch
+        else:
+            self.local_branch = self.mirror.update(self.bzr_branch)
+
+    @traced('create_tree')
+    def create_tree(self, tree_dir=None):
+        '''Create the dir and working tree.
+
+        The tree goes in the branch's configured `tree_dir`, unless another
+        %tree_dir is given.
+        '''
         try:
+            if tree_dir is None:
+                tree_dir = self.config.tree_dir
             self.logger.debug(
                 'Using tree in %(tree_dir)s' % {
-                    'tree_dir': self.config.tree_dir})
-            if os.path.exists(self.config.tree_dir):
-                self.tree = WorkingTree.open(self.config.tree_dir)
+                    'tree_dir': tree_dir})
+            if os.path.exists(tree_dir):
+                self.tree = WorkingTree.open(tree_dir)
 
                 if self.tree.branch.user_url != self.bzr_branch.user_url:
                     self.logger.debug('Tree URLs do not match: %s - %s' % (
@@ -84,11 +127,11 @@ class Branch(object):
                 self.logger.debug('Tree does not exist.  Creating dir')
                 # Create the path up to but not including tree_dir if it does
                 # not exist.
-                parent_dir = os.path.dirname(self.config.tree_dir)
+                parent_dir = os.path.dirname(tree_dir)
                 if not os.path.exists(parent_dir):
                     os.makedirs(parent_dir)
                 self.tree = self.bzr_branch.create_checkout(
-                    self.config.tree_dir, lightweight=True)
+                    tree_dir, lightweight=True)
         except AttributeError:
             # Store this so we can rmtree later
             self.temp_tree_dir = tempfile.mkdtemp()
@@ -97,10 +140,33 @@ class Branch(object):
                     'tree_dir': self.temp_tree_dir})
             self.tree = self.bzr_branch.create_checkout(self.temp_tree_dir)
 
+        self._touched = None
         self.cleanup()
 
+    @traced('cleanup')
     def cleanup(self):
-        '''Remove the working tree from the temp dir.'''
+        '''Reset the working tree to the tip of the branch.
+
+        With `incremental_cleanup` set for the branch, only the paths changed
+        by merges since the last cleanup are reverted, and the tree is only
+        updated if the branch has moved.  With `verify_cleanup` set too, the
+        result is checked with a full scan of the tree.
+        '''
+        assert self.tree
+        if self._touched is None or not self._config_flag(
+                'incremental_cleanup'):
+            self.full_cleanup()
+            return
+
+        self._reset_touched()
+        if self._config_flag('verify_cleanup') and not self.is_clean():
+            self.logger.warn(
+                'Incremental cleanup of %s left changes behind, doing a full '
+                'cleanup.' % self.tree.basedir)
+            self.full_cleanup()
+
+    def full_cleanup(self):
+        '''Revert the whole tree, remove unmanaged files, and update it.'''
         assert self.tree
         self.tree.revert()
         for filename in [self.tree.abspath(f) for f in self.unmanaged_files]:
@@ -110,12 +176,86 @@ class Branch(object):
                 os.remove(filename)
 
         self.tree.update()
+        self._touched = set()
 
-    def merge(self, branch, revid=None):
-        '''Merge from another tarmac.branch.Branch instance.'''
+    def _reset_touched(self):
+        '''Revert the paths changed by merges, and update if needed.'''
+        touched = sorted(self._touched)
+        self.tree.lock_tree_write()
+        try:
+            basis = self.tree.basis_tree()
+            basis.lock_read()
+            try:
+                versioned = [path for path in touched
+                             if self.tree.path2id(path) is not None or
+                             basis.path2id(path) is not None]
+            finally:
+                basis.unlock()
+            if versioned:
+                self.tree.revert(versioned, backups=False)
+            # Whatever is left unversioned was added by the merges, or is
+            # left over from conflicts.  Children go before their parents.
+            for path in reversed(touched):
+                filename = self.tree.abspath(path)
+                if (not os.path.lexists(filename) or
+                    self.tree.path2id(path) is not None):
+                    continue
+                if os.path.isdir(filename) and not os.path.islink(filename):
+                    shutil.rmtree(filename)
+                else:
+                    os.remove(filename)
+            parent_ids = self.tree.get_parent_ids()
+            if len(parent_ids) > 1:
+                self.tree.set_parent_ids(parent_ids[:1])
+        finally:
+            self.tree.unlock()
+
+        if self.tree.last_revision() != self.bzr_branch.last_revision():
+            self.tree.update()
+        self._touched = set()
+
+    def _changed_paths(self):
+        '''Return the paths which differ from the basis of the tree.'''
+        paths = set()
+        self.tree.lock_read()
+        try:
+            for change in self.tree.iter_changes(self.tree.basis_tree()):
+                paths.update(path for path in change[1] if path is not None)
+            for conflict in self.tree.conflicts():
+                paths.update(conflict.associated_filenames())
+        finally:
+            self.tree.unlock()
+        return paths
+
+    def is_clean(self):
+        '''Check, with a full scan of the tree, that it matches the tip.'''
+        return (self.tree.last_revision() == self.bzr_branch.last_revision()
+                and not self.tree.has_changes()
+                and not self.unmanaged_files)
+
+    def _config_flag(self, name):
+        if self.config is None:
+            return False
+        return self.config.get_boolean(name)
+
+    @traced('merge')
+    def merge(self, branch, revid=None, force=False):
+        '''Merge from another tarmac.branch.Branch instance.
+
+        Set %force to merge on top of uncommitted changes, such as other
+        branches merged earlier.
+        '''
         assert self.tree
-        conflict_list = self.tree.merge_from_branch(
-            branch.bzr_branch, to_revision=revid)
+        # If the merge fails part way, what it changed isn't known.
+        touched, self._touched = self._touched, None
+        try:
+            conflict_list = self.tree.merge_from_branch(
+                branch.bzr_branch, to_revision=revid, force=force)
+        except PointlessMerge:
+            self._touched = touched
+            raise
+        if touched is not None and self._config_flag('incremental_cleanup'):
+            self._touched = touched | self._changed_paths()
         if conflict_list:
             message = u'Conflicts merging branch.'
             lp_comment = (
@@ -125,6 +265,7 @@ class Branch(object):
                     "output": self.conflicts})
             raise BranchHasConflicts(message, lp_comment)
 
+    @traced('merge_tags')
     def merge_tags(self, branch):
         """Merge tags from another branch into this one."""
         branch.tags.merge_to(self.tags, overwrite=True)
@@ -151,6 +292,7 @@ class Branch(object):
                 u'%s in %s' % (conflict.typestring, conflict.path))
         return '\n'.join(conflicts)
 
+    @traced('commit')
     def commit(self, commit_message, revprops=None, **kwargs):
         '''Commit changes.'''
         if not revprops:
@@ -179,6 +321,8 @@ class Branch(object):
                              revprops=revprops, authors=authors)
         except AssertionError as error:
             raise TarmacMergeError(str(error))
+        if self.mirror is not None:
+            self.update_mirror()
 
     @property
     def landing_candidates(self):
@@ -187,62 +331,122 @@ class Branch(object):
 
     @property
     def authors(self):
-        author_list = []
+        """Return the authors of the revisions the branch would land.
+
+        The authors are only worked out once for each pair of source and
+        target tips, as they are asked for by plugins and again on commit.
+        """
+        if self.target:
+            key = (self.bzr_branch.last_revision(),
+                   self.target.local_branch.last_revision())
+        else:
+            key = (self.bzr_branch.last_revision(), None)
+        if key not in self._authors:
+            self._authors[key] = self._find_authors()
+        return list(self._authors[key])
+
+    def _find_authors(self):
+        """Read the authors of the branch's unique revisions.
+
+        The revisions are read in batches, so that long lived branches
+        don't have all of their history in memory at once.
+        """
+        authors = OrderedDict()
 
         if self.target:
             try:
                 self.bzr_branch.lock_read()
-                self.target.bzr_branch.lock_read()
+                self.target.local_branch.lock_read()
 
                 graph = self.bzr_branch.repository.get_graph(
-                    self.target.bzr_branch.repository)
+                    self.target.local_branch.repository)
 
-                unique_ids = graph.find_unique_ancestors(
+                unique_ids = list(graph.find_unique_ancestors(
                     self.bzr_branch.last_revision(),
-                    [self.target.bzr_branch.last_revision()])
+                    [self.target.local_branch.last_revision()]))
 
-                revs = self.bzr_branch.repository.get_revisions(unique_ids)
-                for rev in revs:
-                    apparent_authors = rev.get_apparent_authors()
-                    for author in apparent_authors:
-                        author.replace('\n', '')
-                        if author not in author_list:
-                            author_list.append(author)
+                for rev in self._iter_revisions(
+                        self.bzr_branch.repository, unique_ids):
+                    for author in rev.get_apparent_authors():
+                        authors[author] = None
 
             finally:
-                self.target.bzr_branch.unlock()
+                self.target.local_branch.unlock()
                 self.bzr_branch.unlock()
         else:
             last_rev = self.bzr_branch.last_revision()
             if last_rev != 'null:':
                 rev = self.bzr_branch.repository.get_revision(last_rev)
-                apparent_authors = rev.get_apparent_authors()
-                author_list.extend(
-                    [a.replace('\n', '') for a in apparent_authors])
+                for author in rev.get_apparent_authors():
+                    authors[author.replace('\n', '')] = None
+
+        return authors.keys()
+
+    def _iter_revisions(self, repository, revision_ids):
+        """Read %revision_ids from %repository, REVISION_BATCH_SIZE at a time.
 
-        return author_list
+        The repository must be locked.
+        """
+        for start in range(0, len(revision_ids), REVISION_BATCH_SIZE):
+            for rev in repository.get_revisions(
+                    revision_ids[start:start + REVISION_BATCH_SIZE]):
+                yield rev
+
+    @property
+    def bug_index(self):
+        """The index of the bugs fixed by each revision, or None.
+
+        Revisions never change, so what they fix is kept in CACHE_HOME
+        between runs.
+        """
+        if self._bug_index is None and self._bug_index_path is not None:
+            self._bug_index = PersistentCache(
+                self._bug_index_path, max_entries=BUG_INDEX_SIZE)
+        return self._bug_index
 
     @property
     def fixed_bugs(self):
-        """Return the list of bugs fixed by the branch."""
-        bugs_list = []
+        """Return the list of bugs fixed by the branch.
+
+        The branch's history is read from its mirror, if it has one, and
+        only the revisions which aren't in the bug index are read.
+        """
+        index = self.bug_index
+        fixed = {}
+        branch = self.local_branch
 
         try:
-            self.bzr_branch.lock_read()
-            oldrevid = self.bzr_branch.get_rev_id(self.lp_branch.revision_count)
-            for rev_info in self.bzr_branch.iter_merge_sorted_revisions(
-                stop_revision_id=oldrevid):
-                try:
-                    rev = self.bzr_branch.repository.get_revision(rev_info[0])
-                    for bug in rev.iter_bugs():
-                        if bug[0].startswith('https://launchpad.net/bugs/'):
-                            bugs_list.append(bug[0].replace(
-                                    'https://launchpad.net/bugs/', ''))
-                except NoSuchRevision:
-                    continue
+            branch.lock_read()
+            oldrevid = branch.get_rev_id(self.lp_branch.revision_count)
+            revids = [rev_info[0] for rev_info in
+                      branch.iter_merge_sorted_revisions(
+                          stop_revision_id=oldrevid)]
+            unindexed = []
+            for revid in revids:
+                if index is not None and revid in index:
+                    fixed[revid] = index.get(revid)
+                else:
+                    unindexed.append(revid)
+            # Ghost revisions can't be read, so they fix nothing.
+            present = branch.repository.has_revisions(unindexed)
+            for rev in self._iter_revisions(
+                    branch.repository,
+                    [revid for revid in unindexed if revid in present]):
+                fixed[rev.revision_id] = [
+                    bug[0].replace(LAUNCHPAD_BUGS, '')
+                    for bug in rev.iter_bugs()
+                    if bug[0].startswith(LAUNCHPAD_BUGS)]
+                if index is not None:
+                    index.set(rev.revision_id, fixed[rev.revision_id])
 
         finally:
-            self.bzr_branch.unlock()
+            branch.unlock()
+        if index is not None:
+            index.save()
+
+        bugs_list = []
+        for revid in revids:
+            bugs_list.extend(fixed.get(revid, []))
         return bugs_list
 
     @property
@@ -0,0 +1,134 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''On-disk caches for data which rarely changes between runs.'''
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+
+class PersistentCache(object):
+    '''A mapping kept in a JSON file, with expiry and LRU eviction.
+
+    Entries older than %ttl seconds are dropped when they are looked up, and
+    once there are more than %max_entries, the least recently used ones are
+    evicted.  Keys must be strings and values must be JSON serializable.
+    Changes are only written out by save().
+    '''
+
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.logger = logging.getLogger('tarmac')
+        self._entries = OrderedDict()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        '''Read the entries from disk, dropping any that have expired.'''
+        self._entries = OrderedDict()
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, ValueError), error:
+            if os.path.exists(self.path):
+                self.logger.debug(
+                    'Ignoring unreadable cache %s: %s' % (self.path, error))
+            return
+        # Entries are saved least recently used first.
+        for key, (stamp, value) in entries:
+            if not self._expired(stamp):
+                self._entries[key] = (stamp, value)
+
+    def save(self):
+        '''Write the entries to disk, if they have changed.
+
+        The file is replaced atomically, so concurrent processes sharing a
+        cache can't corrupt it, though the last one to save wins.
+        '''
+        if not self._dirty:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(
+                [[key, list(entry)] for key, entry in self._entries.items()],
+                cache_file)
+        os.rename(temp_path, self.path)
+        self._dirty = False
+
+    def _expired(self, stamp):
+        return self.ttl is not None and time.time() - stamp > self.ttl
+
+    def __contains__(self, key):
+        try:
+            stamp, value = self._entries[key]
+        except KeyError:
+            return False
+        return not self._expired(stamp)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        '''Return the value for %key, or %default if missing or expired.'''
+        try:
+            stamp, value = self._entries.pop(key)
+        except KeyError:
+            return default
+        if self._expired(stamp):
+            self._dirty = True
+            return default
+        # Move it to the most recently used end.
+        self._entries[key] = (stamp, value)
+        return value
+
+    def set(self, key, value):
+        '''Store %value for %key, evicting old entries if needed.'''
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time(), value)
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._dirty = True
+
+    def fetch(self, key, func):
+        '''Return the value for %key, calling %func to get it if needed.'''
+        if key in self:
+            return self.get(key)
+        value = func()
+        self.set(key, value)
+        return value
+
+    def clear(self):
+        '''Drop all the entries.'''
+        self._entries.clear()
+        self._dirty = True
+
+
+def cached(cache, key, func):
+    '''Return %func's result, through %cache if there is one.
+
+    For code which may be given a cache or None.
+    '''
+    if cache is None:
+        return func()
+    return cache.fetch(key, func)
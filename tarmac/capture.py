@@ -0,0 +1,93 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Capture of command output in bounded memory.'''
+from collections import deque
+import gzip
+import os
+
+
+class OutputCapture(object):
+    '''The output of a command on one stream.
+
+    All of the output is written to a gzipped log file, if a path is given,
+    but only its first %head_size and last %tail_size bytes are kept in
+    memory, however much there is.
+    '''
+
+    def __init__(self, log_path=None, head_size=8192, tail_size=32768):
+        self.log_path = log_path
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.size = 0
+        self._head = []
+        self._head_length = 0
+        self._tail = deque()
+        self._tail_length = 0
+        self._log = None
+        if log_path is not None:
+            self._log = gzip.open(log_path, 'wb')
+
+    def write(self, data):
+        '''Add %data to the output.'''
+        self.size += len(data)
+        if self._log is not None:
+            self._log.write(data)
+        if self._head_length < self.head_size:
+            head = data[:self.head_size - self._head_length]
+            self._head.append(head)
+            self._head_length += len(head)
+            data = data[len(head):]
+        if not data:
+            return
+        self._tail.append(data)
+        self._tail_length += len(data)
+        # Drop whole chunks which have fallen out of the tail.
+        while self._tail_length - len(self._tail[0]) >= self.tail_size:
+            self._tail_length -= len(self._tail.popleft())
+
+    @property
+    def truncated(self):
+        '''Whether some of the output isn't kept in memory.'''
+        return self.size > self._head_length + min(
+            self._tail_length, self.tail_size)
+
+    def getvalue(self):
+        '''Return the output, with its middle left out if it's too long.'''
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)
+        if len(tail) > self.tail_size:
+            tail = tail[-self.tail_size:]
+        if not self.truncated:
+            return head + tail
+        omitted = self.size - len(head) - len(tail)
+        if self.log_path is not None:
+            marker = '\n[... %d bytes omitted, see %s ...]\n' % (
+                omitted, self.log_path)
+        else:
+            marker = '\n[... %d bytes omitted ...]\n' % omitted
+        return head + marker + tail
+
+    def close(self):
+        '''Finish writing the log file.'''
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def discard(self):
+        '''Close and remove the log file.'''
+        self.close()
+        if self.log_path is not None and os.path.exists(self.log_path):
+            os.remove(self.log_path)
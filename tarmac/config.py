@@ -20,6 +20,7 @@
 # pylint: disable-msg=C0103
 __metaclass__ = type
 
+import logging
 import os
 from ConfigParser import SafeConfigParser as ConfigParser
 
@@ -30,20 +31,26 @@ class TarmacConfig(ConfigParser):
     '''A class for handling configuration.'''
 
     def __init__(self):
-        DEFAULTS = {
-            'log_file': os.path.join(self.CONFIG_HOME, 'tarmac.log'),
-            }
-
         ConfigParser.__init__(self)
+        # Options set since loading, e.g. from the command line, by
+        # (section, option).
+        self._overrides = {}
 
         self._check_config_dirs()
         self.read(self.CONFIG_FILE)
+        self._set_defaults()
+
+    def _set_defaults(self):
+        """Fill in the defaults, and the attributes for the Tarmac section."""
+        DEFAULTS = {
+            'log_file': os.path.join(self.CONFIG_HOME, 'tarmac.log'),
+            }
 
         if not self.has_section('Tarmac'):
             self.add_section('Tarmac')
 
         if not self.has_option('Tarmac', 'log_file'):
-            self.set('Tarmac', 'log_file', DEFAULTS['log_file'])
+            ConfigParser.set(self, 'Tarmac', 'log_file', DEFAULTS['log_file'])
 
         for key, val in self.items('Tarmac'):
             setattr(self, key, val)
@@ -51,15 +58,51 @@ class TarmacConfig(ConfigParser):
     def set(self, section, option, value):
         """Wrap the set method, so we can tweak our attrs."""
         ConfigParser.set(self, section, option, str(value))
+        self._overrides[(section, option)] = value
         if section == 'Tarmac':
             setattr(self, option, value)
 
     def remove_option(self, section, option):
         """Wrap the remove_option method so we can tweak our attrs."""
         ConfigParser.remove_option(self, section, option)
+        self._overrides.pop((section, option), None)
         if section == 'Tarmac':
             delattr(self, option)
 
+    def remove_section(self, section):
+        """Wrap the remove_section method to forget its options too."""
+        for key in self._overrides.keys():
+            if key[0] == section:
+                del self._overrides[key]
+        return ConfigParser.remove_section(self, section)
+
+    def reload(self):
+        """Re-read the config file, for processes that outlive a single run.
+
+        The sections and options are rebuilt from the file, so ones removed
+        from it are gone.  Options set since loading, e.g. from the command
+        line, are kept and take precedence over the file.
+        """
+        fresh = ConfigParser()
+        fresh.read(self.CONFIG_FILE)
+        for key in self.options('Tarmac'):
+            if key in self.__dict__:
+                delattr(self, key)
+        for section in self.sections():
+            ConfigParser.remove_section(self, section)
+        for section in fresh.sections():
+            self.add_section(section)
+            for key, val in fresh.items(section, raw=True):
+                ConfigParser.set(self, section, key, val)
+        for (section, option), value in self._overrides.items():
+            if not self.has_section(section):
+                self.add_section(section)
+            ConfigParser.set(self, section, option, str(value))
+        self._set_defaults()
+        for (section, option), value in self._overrides.items():
+            if section == 'Tarmac':
+                setattr(self, option, value)
+
     @property
     def CONFIG_HOME(self):
         '''Return the base dir for the config.'''
@@ -132,3 +175,19 @@ class BranchConfig:
         Defaults to None if the key is not set.
         '''
         return getattr(self, attr, default)
+
+    def get_boolean(self, attr, default=False):
+        '''Get a config key which is a flag, like `true` or `off`.
+
+        The values ConfigParser.getboolean accepts are understood; anything
+        else is warned about, and %default is used.
+        '''
+        value = getattr(self, attr, None)
+        if value is None:
+            return default
+        try:
+            return ConfigParser._boolean_states[str(value).lower()]
+        except KeyError:
+            logging.getLogger('tarmac').warning(
+                'Ignoring %s = %s, which is not a boolean.' % (attr, value))
+            return default
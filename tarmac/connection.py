@@ -0,0 +1,155 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Helpers for the connection to the Launchpad API.'''
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+class APICalls(object):
+    '''The requests made to the Launchpad API, by who made them.
+
+    A request is attributed to the innermost `attribute` block it is made
+    in on the same thread, such as the plug-in running, or else to 'tarmac'.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        '''Forget the requests so far.'''
+        with self._lock:
+            self._calls = {}
+
+    def _owners(self):
+        try:
+            return self._local.owners
+        except AttributeError:
+            self._local.owners = []
+            return self._local.owners
+
+    @contextmanager
+    def attribute(self, owner):
+        '''Attribute the requests made in the with statement to %owner.'''
+        owners = self._owners()
+        owners.append(owner)
+        try:
+            yield
+        finally:
+            owners.pop()
+
+    def record(self, method, duration):
+        '''Add a request which took %duration seconds to the counts.'''
+        owners = self._owners()
+        owner = owners[-1] if owners else 'tarmac'
+        with self._lock:
+            calls = self._calls.setdefault(
+                owner, {'calls': 0, 'time': 0.0, 'methods': {}})
+            calls['calls'] += 1
+            calls['time'] += duration
+            calls['methods'][method] = calls['methods'].get(method, 0) + 1
+
+    def summary(self):
+        '''Return a copy of the counts, by owner.'''
+        with self._lock:
+            return json.loads(json.dumps(self._calls))
+
+    def total(self):
+        '''Return the number of requests made.'''
+        with self._lock:
+            return sum(calls['calls'] for calls in self._calls.values())
+
+    def over_budget(self, budget):
+        '''Return the owners which made more requests than %budget allows.
+
+        %budget maps owners, or 'total' for all the requests, to the most
+        requests they may make, as returned by parse_budget.  The result maps
+        each owner over budget to the number of requests it made.
+        '''
+        summary = self.summary()
+        counts = dict((owner, calls['calls'])
+                      for owner, calls in summary.items())
+        counts['total'] = sum(counts.values())
+        return dict((owner, counts.get(owner, 0))
+                    for owner, limit in budget.items()
+                    if counts.get(owner, 0) > limit)
+
+
+def parse_budget(value):
+    '''Parse a budget of API calls, like `100, Votes=5, BugResolver=20`.
+
+    A bare number is the budget for all the requests.
+    '''
+    budget = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        owner, _, limit = item.rpartition('=')
+        budget[owner.strip() or 'total'] = int(limit)
+    return budget
+
+
+api_calls = APICalls()
+
+
+class PerThreadConnection(object):
+    '''Stand in for a launchpadlib HTTP connection, one per thread.
+
+    httplib2 connections can't be used by several threads at once, so each
+    thread other than the one which logged in gets its own connection, with
+    the same credentials and cache.
+    '''
+
+    def __init__(self, launchpad, connection):
+        self._launchpad = launchpad
+        self._connection = connection
+        self._local = threading.local()
+        self._local.connection = connection
+
+    @property
+    def connection(self):
+        '''The connection for the current thread.'''
+        try:
+            return self._local.connection
+        except AttributeError:
+            main = self._connection
+            self._local.connection = self._launchpad.httpFactory(
+                main.authorizer, main.cache, main.timeout, main.proxy_info)
+            return self._local.connection
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        '''Make a request, counting it in api_calls.'''
+        started = time.time()
+        try:
+            return self.connection.request(uri, method, *args, **kwargs)
+        finally:
+            api_calls.record(method, time.time() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def share_between_threads(launchpad):
+    '''Let %launchpad be used from several threads, and return it.'''
+    browser = getattr(launchpad, '_browser', None)
+    if browser is not None and not isinstance(
+            browser._connection, PerThreadConnection):
+        browser._connection = PerThreadConnection(
+            launchpad, browser._connection)
+    return launchpad
@@ -16,10 +16,74 @@
 
 '''Hooks for Tarmac.'''
 
+import json
 import logging
+import os
+import threading
+import time
 
 from bzrlib import hooks
 
+from tarmac.connection import api_calls
+from tarmac.trace import tracer
+
+
+def _cpu_time():
+    '''Return the CPU time used by this process, in seconds.'''
+    times = os.times()
+    return times[0] + times[1]
+
+
+class HookTimings(object):
+    '''The time taken by each plug-in on each hook, over a run.
+
+    CPU time is for the whole process, so it includes any other threads
+    running while the plug-in ran.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forget the timings so far.'''
+        with self._lock:
+            self._timings = {}
+
+    def record(self, hook_name, plugin, wall, cpu, outcome):
+        '''Add one call of %plugin on %hook_name to the timings.
+
+        %outcome is 'ok', or the name of the exception it raised.
+        '''
+        with self._lock:
+            timing = self._timings.setdefault(
+                hook_name, {}).setdefault(plugin, {
+                    'calls': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0,
+                    'outcomes': {}})
+            timing['calls'] += 1
+            timing['wall'] += wall
+            timing['max_wall'] = max(timing['max_wall'], wall)
+            timing['cpu'] += cpu
+            timing['outcomes'][outcome] = (
+                timing['outcomes'].get(outcome, 0) + 1)
+
+    def summary(self):
+        '''Return a copy of the timings, by hook name and then plug-in.'''
+        with self._lock:
+            return json.loads(json.dumps(self._timings))
+
+    def write(self, path, **extra):
+        '''Append the timings to the file at %path, as a line of JSON.
+
+        Any %extra keyword arguments are included in the record.
+        '''
+        record = dict(extra, time=time.time(), hooks=self.summary())
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'a') as metrics:
+            metrics.write(json.dumps(record, sort_keys=True) + '\n')
+
 
 class TarmacHookRegistry(hooks.Hooks):
     '''Hooks for Tarmac.'''
@@ -28,6 +92,7 @@ class TarmacHookRegistry(hooks.Hooks):
         hooks.Hooks.__init__(self)
 
         self.logger = logging.getLogger('tarmac')
+        self.timings = HookTimings()
         self._hooks = [
             ('tarmac_pre_commit',
              'Called right after Tarmac checks out and merges in a new '
@@ -61,10 +126,29 @@ class TarmacHookRegistry(hooks.Hooks):
         This implements a way to fire the hook, which bzrlib.hooks.Hooks
         doesn't have. If this turns out to be helpful, than a patch to Bazaar
         should be made to implement it in Bazaar.
+
+        Each callback is timed, and the time added to self.timings under the
+        name of its class.  The Launchpad API requests it makes are
+        attributed to it in tarmac.connection.api_calls.
         """
         hook_point = self[hook_name]
         for callback in hook_point:
-            callback(*args, **kwargs)
+            plugin = getattr(
+                callback, '__name__', None) or type(callback).__name__
+            outcome = 'ok'
+            started = time.time()
+            cpu_started = _cpu_time()
+            try:
+                with tracer.span(hook_name, plugin=plugin):
+                    with api_calls.attribute(plugin):
+                        callback(*args, **kwargs)
+            except Exception, error:
+                outcome = type(error).__name__
+                raise
+            finally:
+                self.timings.record(
+                    hook_name, plugin, time.time() - started,
+                    _cpu_time() - cpu_started, outcome)
 
 
 tarmac_hooks = TarmacHookRegistry()
@@ -2,6 +2,7 @@
 import errno
 import logging
 import os
+import re
 import sys
 
 from tarmac.config import TarmacConfig
@@ -22,6 +23,17 @@ def ensure_log_dir(log_file):
             sys.stderr.write(err_msg)
 
 
+def _make_file_handler(log_file):
+    """Return an INFO level handler writing to %log_file."""
+    ensure_log_dir(log_file)
+    file_handler = logging.FileHandler(filename=log_file)
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(
+        logging.Formatter('%(asctime)s %(levelname)-8s %(message)s',
+                          '%Y-%m-%d %H:%M:%S'))
+    return file_handler
+
+
 def set_up_logging(config=None):
     if not config:
         config = TarmacConfig()
@@ -31,12 +43,7 @@ def set_up_logging(config=None):
     logger.setLevel(logging.DEBUG)
 
     log_file = config.get('Tarmac', 'log_file')
-    ensure_log_dir(log_file)
-    file_handler = logging.FileHandler(filename=log_file)
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(
-        logging.Formatter('%(asctime)s %(levelname)-8s %(message)s',
-                          '%Y-%m-%d %H:%M:%S'))
+    file_handler = _make_file_handler(log_file)
     logger.addHandler(file_handler)
     logger.debug('Logging to %(logfile)s' % {'logfile': log_file})
 
@@ -51,3 +58,41 @@ def set_up_debug_logging():
     stderr_handler = logging.StreamHandler(sys.stderr)
     stderr_handler.setLevel(logging.DEBUG)
     logger.addHandler(stderr_handler)
+
+
+def target_log_file(config, branch_url):
+    """Return the log file to use for work on a single target branch.
+
+    A ``log_file`` set in the target's own config section wins; otherwise
+    the main log file name gets the sanitized branch url inserted before its
+    extension, so each target in a parallel run writes its own stream.
+    """
+    if config.has_option(branch_url, 'log_file'):
+        return config.get(branch_url, 'log_file')
+    base, ext = os.path.splitext(config.get('Tarmac', 'log_file'))
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '-', branch_url).strip('-')
+    return '%s.%s%s' % (base, name, ext or '.log')
+
+
+def set_up_target_logging(config, branch_url):
+    """Send file logging for this process to the target's own log file.
+
+    Handlers writing to the shared log file are swapped out, while any stream
+    handlers (e.g. the --debug stderr handler) are left in place.
+    """
+    log_file = target_log_file(config, branch_url)
+    file_handler = _make_file_handler(log_file)
+
+    removed = set()
+    for name in ['tarmac', 'bzr']:
+        logger = logging.getLogger(name)
+        for handler in logger.handlers[:]:
+            if isinstance(handler, logging.FileHandler):
+                logger.removeHandler(handler)
+                removed.add(handler)
+        logger.addHandler(file_handler)
+    # The same handler is shared by both loggers, so only close them once
+    # they have been removed from each.
+    for handler in removed:
+        handler.close()
+    return log_file
@@ -0,0 +1,72 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Local mirrors of remote branches.'''
+import logging
+import os
+import re
+import threading
+
+from bzrlib import branch as bzr_branch
+from bzrlib.controldir import ControlDir
+from bzrlib.errors import NotBranchError
+
+
+class BranchMirror(object):
+    '''Local copies of remote branches, sharing one repository.
+
+    Each branch is copied once, and after that only its new revisions are
+    fetched, so history can be read without going over the network.
+    Revisions shared between branches, e.g. a target and the proposals for
+    it, are only stored once.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('tarmac')
+        self._lock = threading.Lock()
+
+    def _ensure_repository(self):
+        '''Create the shared repository, if it doesn't exist yet.'''
+        try:
+            ControlDir.open(self.path).open_repository()
+        except NotBranchError:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            repository = ControlDir.create(self.path).create_repository(
+                shared=True)
+            repository.set_make_working_trees(False)
+
+    def location(self, remote):
+        '''Return the local path of the mirror of the %remote branch.'''
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '-', remote.base).strip('-')
+        return os.path.join(self.path, name)
+
+    def update(self, remote):
+        '''Return the mirror of the %remote branch, brought up to date.'''
+        location = self.location(remote)
+        with self._lock:
+            self._ensure_repository()
+            try:
+                local = bzr_branch.Branch.open(location)
+            except NotBranchError:
+                self.logger.debug('Mirroring %s to %s' % (
+                        remote.base, location))
+                local = remote.bzrdir.sprout(
+                    location, create_tree_if_local=False).open_branch()
+            else:
+                self.logger.debug('Updating the mirror of %s' % remote.base)
+                local.pull(remote, overwrite=True)
+        return local
@@ -15,9 +15,14 @@
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 '''Plugin utilities for Tarmac.'''
 
+import ast
+import hashlib
 import imp
+import json
 import logging
+import marshal
 import os
+import tempfile
 import types
 
 from tarmac import plugins as _mod_plugins
@@ -87,19 +92,142 @@ def find_plugins(load_only=None):
     return plugin_names
 
 
-def load_plugins(load_only=None):
+class PluginCache(object):
+    """Compiled plug-ins, and the config keys they react to, in %directory.
+
+    A plug-in declares the config keys it reacts to in a module level
+    CONFIG_KEYS tuple.  The cached code and keys of a plug-in are used for as
+    long as the mtime and size of its source are unchanged.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self._index = None
+        self._changed = False
+
+    @property
+    def index(self):
+        """The cache entries, by the path of the plug-in source."""
+        if self._index is None:
+            try:
+                with open(self.index_path) as index:
+                    data = json.load(index)
+            except (IOError, ValueError):
+                data = {}
+            # Compiled code is only good for the same version of Python.
+            if data.get('magic') != imp.get_magic().encode('hex'):
+                data = {'magic': imp.get_magic().encode('hex'),
+                        'plugins': {}}
+            self._index = data
+        return self._index['plugins']
+
+    def _entry(self, path):
+        """Return the cache entry for %path, compiling it if it's stale."""
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if (entry is not None and entry['mtime'] == stat.st_mtime and
+                entry['size'] == stat.st_size and
+                os.path.exists(entry['code'])):
+            return entry
+
+        with open(path) as source:
+            tree = ast.parse(source.read(), path)
+        config_keys = None
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and 'CONFIG_KEYS' in [
+                    target.id for target in node.targets
+                    if isinstance(target, ast.Name)]:
+                config_keys = list(ast.literal_eval(node.value))
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        code_path = os.path.join(
+            self.directory, hashlib.sha1(path).hexdigest() + '.code')
+        self._write(code_path, 'wb', lambda code: marshal.dump(
+                compile(tree, path, 'exec'), code))
+        entry = self.index[path] = {
+            'mtime': stat.st_mtime, 'size': stat.st_size,
+            'config_keys': config_keys, 'code': code_path}
+        self._changed = True
+        return entry
+
+    def config_keys(self, path):
+        """Return the config keys the plug-in at %path reacts to.
+
+        None means the plug-in didn't say, so it is always loaded.
+        """
+        return self._entry(path)['config_keys']
+
+    def code(self, path):
+        """Return the compiled code of the plug-in at %path."""
+        with open(self._entry(path)['code'], 'rb') as code:
+            return marshal.load(code)
+
+    def _write(self, path, mode, write):
+        """Replace %path with what %write writes to the file it is given.
+
+        The file is replaced atomically, so a crash or another tarmac
+        process can't leave it half written.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, mode) as temp_file:
+                write(temp_file)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def save(self):
+        """Write the index of the cache, if it has changed."""
+        if self._changed:
+            self._write(self.index_path, 'w',
+                        lambda index: json.dump(self._index, index))
+            self._changed = False
+
+
+def configured_keys(config):
+    """Return the names of the options set in any section of %config."""
+    keys = set()
+    for section in config.sections():
+        keys.update(config.options(section))
+    return keys
+
+
+def load_plugins(load_only=None, config=None):
     """Find the plugins for Tarmac.
 
     %load_only is a string containing the name of a single plug-in to find.
+
+    Given a %config, only the plug-ins which react to a key set in it are
+    loaded, and their compiled code is cached in its CACHE_HOME.
     """
+    cache = keys = None
+    if config is not None:
+        cache = PluginCache(os.path.join(config.CACHE_HOME, 'plugins'))
+        keys = configured_keys(config)
     for plugin_info in find_plugins(load_only=load_only):
         try:
             if getattr(_mod_plugins, plugin_info[0], None) is not None:
                 continue
 
-            logger.debug('Loading plug-in: %s' % plugin_info[1])
             _module = types.ModuleType(plugin_info[0])
-            execfile(plugin_info[1], _module.__dict__)
+            if cache is None:
+                logger.debug('Loading plug-in: %s' % plugin_info[1])
+                execfile(plugin_info[1], _module.__dict__)
+            else:
+                config_keys = cache.config_keys(plugin_info[1])
+                if config_keys is not None and not keys.intersection(
+                        config_keys):
+                    logger.debug('Skipping plug-in %s: it is not '
+                                 'configured' % plugin_info[1])
+                    continue
+                logger.debug('Loading plug-in: %s' % plugin_info[1])
+                exec cache.code(plugin_info[1]) in _module.__dict__
             setattr(_mod_plugins, plugin_info[0], _module)
         except KeyboardInterrupt:
             raise
+    if cache is not None:
+        cache.save()
@@ -15,12 +15,17 @@
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 """Tarmac plug-in for checking for a list of allowable contributors."""
 import re
+import time
 
 from lazr.restfulclient.errors import Unauthorized
+from tarmac.cache import cached
 from tarmac.exceptions import TarmacMergeError
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('allowed_contributors',)
+
 
 class InvalidContributor(TarmacMergeError):
     """Error for when a contributor does not meet validation requirements."""
@@ -36,8 +41,33 @@ class AllowedContributors(TarmacPlugin):
     This plug-in checks for the allowed_contributors setting on the target
     branch, and if found, will cause the branch merge to fail, if the authors
     of the branch, are not in the list, or members of teams in the list.
+
+    The members of each team are remembered for as long as the command
+    runs, or as long as its identity cache keeps them if it has one.
     """
 
+    def __init__(self):
+        super(AllowedContributors, self).__init__()
+        self._command = None
+        self._cache = None
+        self._memo_started = 0
+        # Team names mapped to the names of all their members, expanded as
+        # they are needed.
+        self._teams = {}
+        self._subteams = {}
+
+    def _start_memo(self, command):
+        """Forget the teams expanded for another command, or too long ago."""
+        cache = getattr(command, 'identity_cache', None)
+        ttl = getattr(cache, 'ttl', None)
+        if (command is not self._command or
+            (ttl is not None and time.time() - self._memo_started > ttl)):
+            self._command = command
+            self._memo_started = time.time()
+            self._teams = {}
+            self._subteams = {}
+        self._cache = cache
+
     def run(self, command, target, source, proposal):
         """Check the allowed contributors list."""
         try:
@@ -52,41 +82,32 @@ class AllowedContributors(TarmacPlugin):
                 'target': proposal.target_branch.display_name})
 
         launchpad = command.launchpad
+        self._start_memo(command)
+        cache = self._cache
 
         invalid_contributors = []
         for name in source.authors:
             email = re.sub(r'>$', '', re.sub(r'^.*\<', '', name))
-            author = launchpad.people.getByEmail(email=email)
+            author = cached(cache, u'email:%s' % email,
+                            lambda: self.get_person_name(launchpad, email))
             if author is None:
                 invalid_contributors.append(email)
                 continue
 
-            if author.name in self.allowed_contributors:
+            if author in self.allowed_contributors:
                 continue
             else:
                 in_team = False
                 for team in self.allowed_contributors:
-                    try:
-                        lp_team = launchpad.people[team]
-                        if lp_team.is_team:
-                            in_team = self.is_in_team(author, lp_team)
-                            if in_team:
-                                break
-                    except Unauthorized:
-                        raise InvalidPersonOrTeam(
-                            'Received Unauthorized error while trying to '
-                            'list members of team: %s' % team)
-                    except KeyError:
-                        message = (u'Could not find person or team "%s" on '
-                                   u'Launchpad.' % team)
-                        comment = (u'Merging into %(target) requires that '
-                                   u'contributing authors be a member of an '
-                                   u'acceptable team, or a specified person. '
-                                   u'However, the person or team "%(team)s" '
-                                   u'was not found on Launchpad.' % {
-                                'target': proposal.target_branch.display_name,
-                                'team': team})
-                        raise InvalidPersonOrTeam(message, comment)
+                    if team not in self._teams:
+                        members = cached(
+                            cache, u'team:%s' % team,
+                            lambda: self.get_team_members(
+                                launchpad, team, proposal))
+                        self._teams[team] = frozenset(members or ())
+                    if author in self._teams[team]:
+                        in_team = True
+                        break
 
                 if not in_team and name not in invalid_contributors:
                     invalid_contributors.append(name)
@@ -103,14 +124,83 @@ class AllowedContributors(TarmacPlugin):
                     'authors': '\n    '.join(sorted(invalid_contributors))})
             raise InvalidContributor(message, comment)
 
+    def get_person_name(self, launchpad, email):
+        """Return the name of the person with %email, or None."""
+        person = launchpad.people.getByEmail(email=email)
+        if person is None:
+            return None
+        return person.name
+
+    def get_team_members(self, launchpad, team, proposal):
+        """Return the names of everyone in %team, or None for a person."""
+        try:
+            lp_team = launchpad.people[team]
+            if not lp_team.is_team:
+                return None
+            return sorted(self.expand_team(lp_team))
+        except Unauthorized:
+            raise InvalidPersonOrTeam(
+                'Received Unauthorized error while trying to '
+                'list members of team: %s' % team)
+        except KeyError:
+            message = (u'Could not find person or team "%s" on '
+                       u'Launchpad.' % team)
+            comment = (u'Merging into %(target) requires that '
+                       u'contributing authors be a member of an '
+                       u'acceptable team, or a specified person. '
+                       u'However, the person or team "%(team)s" '
+                       u'was not found on Launchpad.' % {
+                    'target': proposal.target_branch.display_name,
+                    'team': team})
+            raise InvalidPersonOrTeam(message, comment)
+
+    def expand_team(self, team):
+        """Return the names of the people in team, or any of its subteams.
+
+        Each team is only listed once, so nested teams which include each
+        other are fine.  Every subteam expanded on the way is remembered,
+        and kept in the identity cache under its own name.
+        """
+        people, low = self._expand(team, [])
+        return people
+
+    def _expand(self, team, stack):
+        """Return the people in %team, and how far up %stack it refers.
+
+        A team which refers back to one of the teams above it only has part
+        of its members listed, so it isn't remembered.
+        """
+        if team.name in self._subteams:
+            return self._subteams[team.name], len(stack)
+        key = u'team:%s' % team.name
+        if self._cache is not None and key in self._cache:
+            people = set(self._cache.get(key) or ())
+            self._subteams[team.name] = people
+            return people, len(stack)
+
+        depth = len(stack)
+        stack.append(team.name)
+        people = set()
+        low = depth
+        for member in team.members:
+            if not member.is_team:
+                people.add(member.name)
+            elif member.name in stack:
+                low = min(low, stack.index(member.name))
+            else:
+                member_people, member_low = self._expand(member, stack)
+                people.update(member_people)
+                low = min(low, member_low)
+        stack.pop()
+        if low >= depth:
+            self._subteams[team.name] = people
+            if self._cache is not None:
+                self._cache.set(key, sorted(people))
+        return people, low
+
     def is_in_team(self, person, team):
         """Check that a person is a member of team, or one of its subteams."""
-        for subteam in team.members:
-            if str(subteam) == str(person):
-                return True
-            if subteam.is_team and self.is_in_team(person, subteam):
-                return True
-        return False
+        return person.name in self.expand_team(team)
 
 
 tarmac_hooks['tarmac_pre_commit'].hook(
@@ -13,13 +13,48 @@
 # You should have received a copy of the GNU General Public License
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 """Tarmac plug-in for setting a bug status post-commit."""
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+from tarmac.connection import api_calls
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
 
 class BugResolver(TarmacPlugin):
-    """Tarmac plug-in for resolving a bug."""
+    """Tarmac plug-in for resolving a bug.
+
+    The project and series of each target are only looked up once.  The
+    bugs are fetched and marked fixed in up to `bug_resolver_threads`
+    threads (8 by default).
+    """
+
+    def __init__(self):
+        super(BugResolver, self).__init__()
+        self._launchpad = None
+        self._series = {}
+
+    def get_series(self, launchpad, target):
+        """Return (project, series, is development focus) for %target.
+
+        They are looked up once per target; the series is None if there
+        isn't a valid one.
+        """
+        if launchpad is not self._launchpad:
+            self._launchpad = launchpad
+            self._series = {}
+        identity = target.lp_branch.bzr_identity
+        if identity not in self._series:
+            project = target.lp_branch.project
+            focus = project.development_focus
+            try:
+                series_name = identity.split('/')[1]
+            except IndexError:
+                series = focus
+            else:
+                series = project.getSeries(name=series_name)
+            self._series[identity] = (project, series, series == focus)
+        return self._series[identity]
 
     def run(self, command, target, source, proposal):
         """Mark bugs fixed in the bug tracker."""
@@ -27,36 +62,49 @@ class BugResolver(TarmacPlugin):
         if not fixed_bugs:
             return
 
-        project = target.lp_branch.project
-        try:
-            series_name = target.lp_branch.bzr_identity.split('/')[1]
-        except IndexError:
-            series = project.development_focus
-        else:
-            series = project.getSeries(name=series_name)
-
+        project, series, is_focus = self.get_series(
+            command.launchpad, target)
         if not series:
             self.logger.info('Target branch has no valid project series.')
             return
 
-        def find_task_for_target(bug, target):
-            for task in bug.bug_tasks:
+        def find_task_for_target(bug_tasks, target):
+            for task in bug_tasks:
                 if task.target == target:
                     return task
             return None
 
-        for bug_id in fixed_bugs:
-            bug = command.launchpad.bugs[bug_id]
-            task = find_task_for_target(bug, series)
-            if not task and series == project.development_focus:
-                task = find_task_for_target(bug, project)
+        def resolve(bug_id):
+            with api_calls.attribute(type(self).__name__):
+                bug = command.launchpad.bugs[bug_id]
+                bug_tasks = list(bug.bug_tasks)
+                task = find_task_for_target(bug_tasks, series)
+                if not task and is_focus:
+                    task = find_task_for_target(bug_tasks, project)
 
-            if task:
-                task.status = u'Fix Committed'
-                task.lp_save()
-            else:
-                self.logger.info('Target %s/%s not found in bug #%s.',
-                                 project.name, series.name, bug_id)
+                if task:
+                    task.status = u'Fix Committed'
+                    task.lp_save()
+                else:
+                    self.logger.info('Target %s/%s not found in bug #%s.',
+                                     project.name, series.name, bug_id)
+
+        # Several revisions may fix the same bug, but its task must only be
+        # saved once, or the saves race on its etag.
+        fixed_bugs = list(OrderedDict.fromkeys(fixed_bugs))
+        threads = min(
+            int(getattr(getattr(command, 'config', None),
+                        'bug_resolver_threads', 8)),
+            len(fixed_bugs))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(resolve, fixed_bugs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map(resolve, fixed_bugs)
 
 
 tarmac_hooks['tarmac_post_commit'].hook(BugResolver(), 'Bug resolver')
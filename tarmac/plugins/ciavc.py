@@ -35,6 +35,9 @@ from tarmac import __version__ as version_string
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('cia_project', 'cia_server')
+
 
 class CIAVC(TarmacPlugin):
     '''Tarmac plugin for notifying CIA.vc of new commits.'''
@@ -17,7 +17,13 @@
 
 # Head off lint warnings.
 errno = None
+deque = None
+hashlib = None
+json = None
+multiprocessing = None
 os = None
+OutputCapture = None
+PersistentCache = None
 select = None
 shutil = None
 signal = None
@@ -25,6 +31,10 @@ subprocess = None
 sys = None
 tempfile = None
 time = None
+snapshot = None
+
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('verify_command', 'test_command')
 
 # The TIMEOUT setting (expressed in seconds) affects how long a test will run
 # before it is deemed to be hung, and then appropriately terminated.
@@ -38,6 +48,9 @@ from bzrlib.export import export
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), '''
     import errno
+    import hashlib
+    import json
+    import multiprocessing
     import os
     import select
     import shutil
@@ -46,12 +59,29 @@ lazy_import(globals(), '''
     import sys
     import tempfile
     import time
+
+    from collections import deque
+
+    from tarmac import snapshot
+    from tarmac.capture import OutputCapture
+    from tarmac.cache import PersistentCache
     ''')
 
 from tarmac.exceptions import TarmacMergeError
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
+# The size of the reads from the command's output.
+CHUNK_SIZE = 65536
+
+# How much of the start and end of each output stream to report when the
+# command fails.  The full output is kept in a log file.
+OUTPUT_HEAD_SIZE = 8192
+OUTPUT_TAIL_SIZE = 32768
+
+# How much of each output stream to keep with a cached result, in characters.
+MAX_CACHED_OUTPUT = 65536
+
 
 def killem(pid, signal):
     """
@@ -72,6 +102,48 @@ class VerifyCommandFailed(TarmacMergeError):
     """Running the verify_command failed."""
 
 
+class Shard(object):
+    """One of the commands run to verify a tree, and its output."""
+
+    def __init__(self, command, number, total, log_dir):
+        self.command = command
+        self.number = number
+        self.total = total
+        self.proc = None
+        self.return_code = None
+        if total == 1:
+            names = ('stdout.gz', 'stderr.gz')
+        else:
+            names = ('stdout.%d.gz' % number, 'stderr.%d.gz' % number)
+        # Share the space in the comment on a failure between the shards.
+        head_size = OUTPUT_HEAD_SIZE // total
+        tail_size = OUTPUT_TAIL_SIZE // total
+        self.stdout = OutputCapture(
+            os.path.join(log_dir, names[0]), head_size, tail_size)
+        self.stderr = OutputCapture(
+            os.path.join(log_dir, names[1]), head_size, tail_size)
+
+    def start(self):
+        """Start the command, in the current directory."""
+        env = dict(os.environ)
+        if self.total > 1:
+            env['TARMAC_SHARD'] = str(self.number)
+            env['TARMAC_SHARDS'] = str(self.total)
+        self.proc = subprocess.Popen(self.command,
+                                     shell=True,
+                                     env=env,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        self.proc.stdin.close()
+
+    def finish(self):
+        """Wait for the command to exit, and close its logs."""
+        self.return_code = self.proc.wait()
+        self.stdout.close()
+        self.stderr.close()
+
+
 class Command(TarmacPlugin):
     '''Tarmac plugin for running a test command.
 
@@ -80,6 +152,12 @@ class Command(TarmacPlugin):
     do_failed method, and on success, continues.
     '''
 
+    def __init__(self):
+        super(Command, self).__init__()
+        # The verify_command and tree state of the last successful run.
+        self._verified = None
+        self._results = None
+
     def run(self, command, target, source, proposal):
         try:
             self.verify_command = target.config.verify_command
@@ -96,89 +174,306 @@ class Command(TarmacPlugin):
 
         self.proposal = proposal
 
-        self.logger.debug('Running test command: %s' % self.verify_command)
-        cwd = os.getcwd()
-        # Export the changes to a temporary directory, and run the command
-        # there, to prevent possible abuse of running commands in the tree.
-        temp_path = '/tmp/tarmac'
-        if not os.path.exists(temp_path):
-            os.makedirs(temp_path)
-        export_dest = tempfile.mkdtemp(prefix=temp_path + '/branch.')
-        export(target.tree, export_dest, None, None, None, filtered=False,
-               per_file_timestamps=False)
-        os.chdir(export_dest)
+        # A merge train fires this hook for each of its proposals, on the
+        # same combined tree, so only run the command once for it.
+        commands = self.get_commands(target)
+        try:
+            tree_state = (tuple(commands),
+                          tuple(target.tree.get_parent_ids()))
+        except AttributeError:
+            tree_state = None
+        if tree_state is not None and tree_state == self._verified:
+            self.logger.debug(
+                'Test command already passed for this tree: %s' %
+                self.verify_command)
+            return
+
+        cache = self.get_result_cache(command, target)
+        result = None
+        if cache is not None and tree_state is not None:
+            key = self.result_key(tree_state)
+            result = cache.get(key)
+        if result is not None:
+            self.logger.info(
+                'Reusing the result of the test command for this tree: %s' %
+                self.verify_command)
+            return_code, stdout_value, stderr_value = result
+            stdout_value = stdout_value.encode('UTF-8')
+            stderr_value = stderr_value.encode('UTF-8')
+        else:
+            return_code, stdout_value, stderr_value = self.execute(
+                command, target, commands)
+            if cache is not None and tree_state is not None:
+                cache.set(key, [return_code,
+                                self.cached_output(stdout_value),
+                                self.cached_output(stderr_value)])
+                cache.save()
 
-        proc = subprocess.Popen(self.verify_command,
-                                shell=True,
-                                stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        proc.stdin.close()
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
+        if return_code != 0:
+            self.do_failed(stdout_value, stderr_value)
+        self._verified = tree_state
 
-        # Do proc.communicate(), but timeout if there's no activity on stdout or
-        # stderr for too long.
-        open_readers = set([proc.stdout, proc.stderr])
+    def execute(self, command, target, commands):
+        """Run %commands on a copy of the %target tree.
 
-        while open_readers:
-            rlist, wlist, xlist = select.select(open_readers, [], [], TIMEOUT)
+        The commands are the shards of the verify_command, and as many of
+        them are run at once as there are CPUs.  Returns the exit code, and
+        the output on stdout and stderr, of the shards which failed.
+        """
+        self.logger.debug('Running test command: %s' % self.verify_command)
+        cwd = os.getcwd()
+        # Copy the tree to a temporary directory, and run the command there,
+        # to prevent possible abuse of running commands in the tree.
+        method = getattr(target.config, 'verify_snapshot', 'export')
+        export_dest, method = self.snapshot(target.tree, method)
+        if method == 'hardlink':
+            tree_changes = snapshot.changed_paths(target.tree)
+
+        log_dir = self.get_log_dir(command)
+        total = len(commands)
+        shards = [Shard(shard_command, number, total, log_dir)
+                  for number, shard_command in enumerate(commands, 1)]
+        os.chdir(export_dest)
+        jobs = min(total, multiprocessing.cpu_count())
+        pending = deque(shards)
+        running = set()
+        # The capture and echo stream for each open output of a shard.
+        readers = {}
+        started = time.time()
+
+        def start_shards():
+            while pending and len(running) < jobs:
+                shard = pending.popleft()
+                shard.start()
+                running.add(shard)
+                readers[shard.proc.stdout] = (shard, shard.stdout, sys.stdout)
+                readers[shard.proc.stderr] = (shard, shard.stderr, sys.stderr)
+
+        def copy(reader):
+            """Copy a chunk of output, returning False at the end of it."""
+            chunk = os.read(reader.fileno(), CHUNK_SIZE)
+            if chunk == "":
+                return False
+            shard, capture, echo = readers[reader]
+            if command.config.debug:
+                echo.write(chunk)
+            capture.write(chunk)
+            return True
+
+        def close(reader):
+            shard = readers.pop(reader)[0]
+            if not (shard.proc.stdout in readers or
+                    shard.proc.stderr in readers):
+                shard.finish()
+                running.remove(shard)
+
+        start_shards()
+        # Do proc.communicate() for each shard, but timeout if there's no
+        # activity on any stdout or stderr for too long.
+        while readers:
+            rlist, wlist, xlist = select.select(readers.keys(), [], [], TIMEOUT)
 
             if len(rlist) == 0:
-                if proc.poll() is not None:
-                    break
-
-                self.logger.debug(
-                    "Command appears to be hung. There has been no output for"
-                    " %d seconds. Sending SIGTERM." % TIMEOUT)
-                killem(proc.pid, signal.SIGTERM)
+                hung = [shard for shard in running
+                        if shard.proc.poll() is None]
+                if hung:
+                    self.logger.debug(
+                        "Command appears to be hung. There has been no output"
+                        " for %d seconds. Sending SIGTERM." % TIMEOUT)
+                for shard in hung:
+                    killem(shard.proc.pid, signal.SIGTERM)
                 time.sleep(5)
 
-                if proc.poll() is not None:
-                    self.logger.debug("SIGTERM did not work. Sending SIGKILL.")
-                    killem(proc.pid, signal.SIGKILL)
-
-                # Drain the subprocess's stdout and stderr.
-                out_rest = proc.stdout.read()
-                if command.config.debug:
-                    sys.stdout.write(out_rest)
-                stdout.write(out_rest)
-
-                err_rest = proc.stderr.read()
-                if command.config.debug:
-                    sys.stderr.write(err_rest)
-                stderr.write(err_rest)
+                for shard in hung:
+                    if shard.proc.poll() is not None:
+                        self.logger.debug(
+                            "SIGTERM did not work. Sending SIGKILL.")
+                        killem(shard.proc.pid, signal.SIGKILL)
+
+                # Drain the subprocesses' stdout and stderr.
+                for reader in readers.keys():
+                    if readers[reader][0] in hung:
+                        while copy(reader):
+                            pass
+                    close(reader)
                 break
 
-            if proc.stdout in rlist:
-                chunk = os.read(proc.stdout.fileno(), 1024)
-                if chunk == "":
-                    open_readers.remove(proc.stdout)
-                else:
-                    if command.config.debug:
-                        sys.stdout.write(chunk)
-                    stdout.write(chunk)
-                    
-            if proc.stderr in rlist:
-                chunk = os.read(proc.stderr.fileno(), 1024)
-                if chunk == "":
-                    open_readers.remove(proc.stderr)
-                else:
-                    if command.config.debug:
-                        sys.stderr.write(chunk)
-                    stderr.write(chunk)
-
-        return_code = proc.wait()
+            for reader in rlist:
+                if not copy(reader):
+                    close(reader)
+            start_shards()
+
+        for shard in running:
+            shard.finish()
+        self.logger.info(
+            'Captured %d bytes of output from the test command in %.2fs' % (
+                sum(shard.stdout.size + shard.stderr.size
+                    for shard in shards),
+                time.time() - started))
 
         os.chdir(cwd)
         shutil.rmtree(export_dest)
         self.logger.debug('Completed test command: %s' % self.verify_command)
 
-        stdout.seek(0)
-        stderr.seek(0)
+        if (method == 'hardlink' and
+            snapshot.changed_paths(target.tree) != tree_changes):
+            # The changes aren't among the paths the merge touched, so an
+            # incremental cleanup wouldn't undo them.
+            target.full_cleanup()
+            raise VerifyCommandFailed(
+                u'Test command "%s" changed the tree.' % self.verify_command,
+                u'The test command changed files in place in a hard linked '
+                u'copy of the tree, which changed the tree itself.  Use '
+                u'another verify_snapshot method for %s.' %
+                self.proposal.target_branch.display_name)
+
+        # Shards still waiting to start when the command hung never ran.
+        failed = [shard for shard in shards
+                  if shard.return_code not in (0, None)]
+        if not failed:
+            shutil.rmtree(log_dir)
+            return 0, '', ''
+        self.logger.info('The full output is in %s' % log_dir)
+        if total == 1:
+            [shard] = failed
+            return (shard.return_code, shard.stdout.getvalue(),
+                    shard.stderr.getvalue())
+        stdout_value = []
+        stderr_value = []
+        for shard in failed:
+            heading = 'Shard %d of %d exited with %d:\n' % (
+                shard.number, total, shard.return_code)
+            stdout_value.append(heading + shard.stdout.getvalue())
+            stderr_value.append(heading + shard.stderr.getvalue())
+        return (failed[0].return_code, '\n'.join(stdout_value),
+                '\n'.join(stderr_value))
+
+    def get_commands(self, target):
+        """Return the commands to run for the shards of the verify_command.
+
+        With `verify_shards` set, there is one command for each shard, with
+        {shard} replaced by its number, from 1, and {total} by the number of
+        shards.
+        """
+        try:
+            total = int(getattr(target.config, 'verify_shards', 1))
+        except ValueError:
+            self.logger.warn('verify_shards must be a number.')
+            total = 1
+        if total <= 1:
+            return [self.verify_command]
+        return [self.verify_command.replace(
+                    '{shard}', str(number)).replace('{total}', str(total))
+                for number in range(1, total + 1)]
+
+    def get_log_dir(self, command):
+        """Return a new directory for the full output of a command.
+
+        The directories are made in `verify_log_dir`, which defaults to
+        verify-logs in the cache directory, and are removed again if the
+        command succeeds.  Those of failed commands are kept for
+        `verify_log_ttl` seconds (a week by default), and only the
+        `verify_log_count` most recent (100 by default).
+        """
+        config = command.config
+        parent = getattr(config, 'verify_log_dir', None)
+        if not parent:
+            parent = os.path.join(config.CACHE_HOME, 'verify-logs')
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        self.prune_log_dirs(
+            parent, int(getattr(config, 'verify_log_ttl', 7 * 86400)),
+            int(getattr(config, 'verify_log_count', 100)))
+        return tempfile.mkdtemp(
+            prefix=time.strftime('%Y%m%d-%H%M%S-'), dir=parent)
+
+    def prune_log_dirs(self, parent, ttl, count):
+        """Remove the log directories in %parent that are too old or many.
+
+        Those older than %ttl seconds go, and all but the newest %count - 1,
+        to make room for another.
+        """
+        log_dirs = []
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            try:
+                if os.path.isdir(path):
+                    log_dirs.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by another tarmac process.
+                continue
+        log_dirs.sort(reverse=True)
+        now = time.time()
+        for index, (mtime, path) in enumerate(log_dirs):
+            if index >= count - 1 or now - mtime > ttl:
+                self.logger.debug('Removing old verify log %s' % path)
+                shutil.rmtree(path, True)
+
+    def get_result_cache(self, command, target):
+        """Return the cache of results for %target, or None.
+
+        Results are only cached for targets with `verify_cache` set.
+        """
+        enabled = getattr(target.config, 'verify_cache', 'false')
+        if str(enabled).lower() not in ('1', 'yes', 'true', 'on'):
+            return None
+        if self._results is None:
+            config = command.config
+            self._results = PersistentCache(
+                os.path.join(config.CACHE_HOME, 'verify-results.json'),
+                ttl=int(getattr(config, 'verify_cache_ttl', 7 * 86400)),
+                max_entries=int(getattr(config, 'verify_cache_size', 1000)))
+        return self._results
+
+    def cached_output(self, value):
+        """Return the part of an output stream worth keeping in the cache.
+
+        Only the end of a long output is kept, which is where a failure
+        usually shows up.
+        """
+        value = value.decode('UTF-8', 'replace')
+        if len(value) > MAX_CACHED_OUTPUT:
+            value = value[-MAX_CACHED_OUTPUT:]
+        return value
+
+    def result_key(self, tree_state):
+        """Return the key for the result of a command on a tree.
+
+        The key covers the command, the revisions merged into the tree
+        (including the target tip), and the environment it runs in.
+        """
+        verify_command, parent_ids = tree_state
+        environment = sorted(os.environ.items())
+        return hashlib.sha1(json.dumps(
+                [verify_command, list(parent_ids), environment])).hexdigest()
+
+    def snapshot(self, tree, method):
+        """Copy %tree to a new temporary directory, using %method.
+
+        Returns the directory and the method used.  Snapshots go next to the
+        tree, so they can share its files.  When %method is 'export', or
+        the snapshot can't be made, the tree is exported under /tmp/tarmac.
+        """
+        if method != 'export':
+            parent = os.path.dirname(tree.basedir.rstrip('/'))
+            snapshot_dest = tempfile.mkdtemp(
+                prefix='.tarmac-snapshot.', dir=parent)
+            try:
+                method = snapshot.snapshot_tree(tree, snapshot_dest, method)
+            except snapshot.SnapshotUnsupported, error:
+                self.logger.debug('Exporting instead: %s' % error)
+                shutil.rmtree(snapshot_dest)
+            else:
+                self.logger.debug('Copied the tree using %s' % method)
+                return snapshot_dest, method
 
-        if return_code != 0:
-            self.do_failed(stdout.read(), stderr.read())
+        temp_path = '/tmp/tarmac'
+        if not os.path.exists(temp_path):
+            os.makedirs(temp_path)
+        export_dest = tempfile.mkdtemp(prefix=temp_path + '/branch.')
+        export(tree, export_dest, None, None, None, filtered=False,
+               per_file_timestamps=False)
+        return export_dest, 'export'
 
     def do_failed(self, stdout_value, stderr_value):
         '''Perform failure tests.
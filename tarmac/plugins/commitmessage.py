@@ -18,6 +18,9 @@
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('commit_message_template',)
+
 
 class CommitMessageTemplate(TarmacPlugin):
     '''Tarmac plugin for modifying the commit message to adhere to a template.
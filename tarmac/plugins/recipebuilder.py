@@ -18,6 +18,9 @@ from lazr.restfulclient.errors import ResponseError
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
 
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('package_recipe',)
+
 
 class PackageRecipe(TarmacPlugin):
     '''Tarmac plug-in for triggering a package recipe build.
@@ -14,9 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 """Tests for the Allowed Contributors plug-in."""
+import os
 
 from lazr.restfulclient.errors import Unauthorized
 from mock import Mock
+from tarmac.cache import PersistentCache
 from tarmac.plugins.allowedcontributors import (
     InvalidContributor,
     InvalidPersonOrTeam,
@@ -149,3 +151,71 @@ class AllowedContributorTests(TarmacTestCase):
                           self.plugin.run,
                           command=command, target=target, source=source,
                           proposal=self.proposal)
+
+    def test_run_cached(self):
+        """Test that a second run needs no Launchpad lookups."""
+        config = Thing(allowed_contributors=u'person2,team1')
+        source = Thing(authors=[u'person1', u'person2', u'person3'])
+        target = Thing(config=config)
+        launchpad = Thing(people=self.people)
+        cache = PersistentCache(
+            os.path.join(self.config.CACHE_HOME, 'identities.json'))
+        command = Thing(launchpad=launchpad, identity_cache=cache)
+        self.plugin.run(command=command, target=target, source=source,
+                        proposal=self.proposal)
+        cache.save()
+
+        command.launchpad = Thing(people=Mock(spec=dict))
+        command.identity_cache = PersistentCache(cache.path)
+        self.plugin.run(command=command, target=target, source=source,
+                        proposal=self.proposal)
+        self.assertEqual([], command.launchpad.people.mock_calls)
+
+    def test_person_is_in_cyclic_teams(self):
+        """Test that teams which include each other are expanded once."""
+        self.people.team1.members.append(self.people.team2)
+        self.assertEqual(set([u'person1', u'person2', u'person3']),
+                         self.plugin.expand_team(self.people.team1))
+        self.assertTrue(self.plugin.is_in_team(self.people.person2,
+                                               self.people.team1))
+
+    def test_run_expands_teams_once(self):
+        """Test that each team is looked up once for all the authors."""
+        config = Thing(allowed_contributors=u'team1,team2')
+        source = Thing(authors=[u'person1', u'person2', u'person3'])
+        target = Thing(config=config)
+        people = Mock(spec=dict)
+        people.getByEmail = self.getByEmail
+        people.__getitem__ = Mock(
+            side_effect=lambda name: getattr(self.people, name))
+        command = Thing(launchpad=Thing(people=people))
+        self.plugin.run(command=command, target=target, source=source,
+                        proposal=self.proposal)
+        self.assertEqual([((u'team1',), {}), ((u'team2',), {})],
+                         people.__getitem__.call_args_list)
+
+    def test_run_remembers_teams(self):
+        """Test that teams expanded for one proposal are kept for the next."""
+        config = Thing(allowed_contributors=u'team2')
+        source = Thing(authors=[u'person1'])
+        target = Thing(config=config)
+        people = Mock(spec=dict)
+        people.getByEmail = self.getByEmail
+        people.__getitem__ = Mock(
+            side_effect=lambda name: getattr(self.people, name))
+        command = Thing(launchpad=Thing(people=people))
+        for proposal in range(2):
+            self.plugin.run(command=command, target=target, source=source,
+                            proposal=self.proposal)
+        self.assertEqual([((u'team2',), {})],
+                         people.__getitem__.call_args_list)
+
+    def test_expand_team_caches_subteams(self):
+        """Test that each subteam expanded is kept in the identity cache."""
+        cache = PersistentCache(
+            os.path.join(self.config.CACHE_HOME, 'identities.json'))
+        self.plugin._start_memo(Thing(identity_cache=cache))
+        self.plugin.expand_team(self.people.team2)
+        self.assertEqual([u'person1', u'person3'], cache.get(u'team:team1'))
+        self.assertEqual([u'person1', u'person2', u'person3'],
+                         cache.get(u'team:team2'))
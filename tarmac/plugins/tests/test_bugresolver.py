@@ -109,3 +109,49 @@ class BugResolverTests(TarmacTestCase):
         self.assertEqual(self.bugs['0'].bug_tasks[0].status, u'In Progress')
         self.assertEqual(self.bugs['0'].bug_tasks[1].status, u'Incomplete')
         self.assertEqual(self.bugs['1'].bug_tasks[0].status, u'Confirmed')
+
+    def test_run_many_bugs(self):
+        """Test that every bug is resolved when they are done in threads."""
+        bugs = dict(
+            (str(bug_id), Thing(bug_tasks=[Thing(
+                            target=self.targets[0], status=u'In Progress',
+                            lp_save=self.lp_save)]))
+            for bug_id in range(20))
+        target = Thing(fixed_bugs=bugs.keys(),
+                       lp_branch=Thing(project=self.projects[0],
+                                       bzr_identity='lp:target'))
+        command = Thing(launchpad=Thing(bugs=bugs))
+        self.plugin.run(command=command, target=target, source=None,
+                        proposal=self.proposal)
+        self.assertEqual([u'Fix Committed'] * 20,
+                         [bug.bug_tasks[0].status for bug in bugs.values()])
+
+    def test_run_caches_series(self):
+        """Test that the project and series are looked up once per target."""
+        looked_up = []
+
+        def getSeries(name=None):
+            looked_up.append(name)
+            return self.getSeries(name)
+        self.projects[0].getSeries = getSeries
+        target = Thing(fixed_bugs=['1'],
+                       lp_branch=Thing(project=self.projects[0],
+                                       bzr_identity='lp:target/stable'))
+        command = Thing(launchpad=Thing(bugs=self.bugs))
+        for i in range(2):
+            self.plugin.run(command=command, target=target, source=None,
+                            proposal=self.proposal)
+        self.assertEqual(['stable'], looked_up)
+        self.assertEqual(self.bugs['1'].bug_tasks[0].status, u'Fix Committed')
+
+    def test_run_duplicate_bugs(self):
+        """Test that a bug fixed by several revisions is only saved once."""
+        saved = []
+        self.bugs['1'].bug_tasks[0].lp_save = lambda: saved.append('1')
+        target = Thing(fixed_bugs=['1', '1', '1'],
+                       lp_branch=Thing(project=self.projects[0],
+                                       bzr_identity='lp:target/stable'))
+        command = Thing(launchpad=Thing(bugs=self.bugs))
+        self.plugin.run(command=command, target=target, source=None,
+                        proposal=self.proposal)
+        self.assertEqual(['1'], saved)
@@ -13,12 +13,16 @@
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 """Tests for the Command plug-in."""
 
+import gzip
 import os
+import shutil
+import time
 
 from mock import patch
 from tarmac.bin.registry import CommandRegistry
 from tarmac.plugins import command
-from tarmac.tests import TarmacTestCase
+from tarmac.snapshot import SnapshotUnsupported
+from tarmac.tests import BranchTestCase, TarmacTestCase
 from tarmac.tests.test_commands import FakeCommand
 from tarmac.tests import Thing
 
@@ -71,6 +75,19 @@ class TestCommand(TarmacTestCase):
         self.assertTrue(mocked.called_args_list[1].startswith(
             '/tmp/tarmac/branch.'))
 
+    @patch('tarmac.plugins.command.export')
+    def test_run_once_per_tree(self, mocked):
+        """Test that the command only runs once for the same merged tree."""
+        target = Thing(config=Thing(
+                verify_command="/bin/true"),
+                       tree=Thing(abspath=os.path.abspath,
+                                  get_parent_ids=lambda: ['tip', 'a', 'b']))
+        for i in range(2):
+            self.plugin.run(
+                command=self.command, target=target, source=None,
+                proposal=self.proposal)
+        self.assertEqual(1, mocked.call_count)
+
     @patch('tarmac.plugins.command.export')
     def test_run_nonascii_failure(self, mocked):
         """Test that we avoid a UnicodeDecodeError from stdout/stderr.
@@ -94,3 +111,216 @@ class TestCommand(TarmacTestCase):
                          u' Below is the output from the failed tests.'
                          u'\n\nf\xe5\xefl\n',
                          e.comment)
+
+    @patch('tarmac.plugins.command.export')
+    def test_run_snapshot(self, mocked):
+        """Test that the tree is copied with the configured method."""
+        target = Thing(config=Thing(
+                verify_command="/bin/true", verify_snapshot='reflink'),
+                       tree=Thing(basedir=os.path.join(self.tempdir, 'tree')))
+        with patch('tarmac.snapshot.snapshot_tree',
+                   return_value='reflink') as snapshot_tree:
+            self.plugin.run(
+                command=self.command, target=target, source=None,
+                proposal=self.proposal)
+        self.assertFalse(mocked.called)
+        tree, dest, method = snapshot_tree.call_args[0]
+        self.assertEqual('reflink', method)
+        self.assertTrue(dest.startswith(
+                os.path.join(self.tempdir, '.tarmac-snapshot.')))
+        self.assertFalse(os.path.exists(dest))
+
+    @patch('tarmac.plugins.command.export')
+    def test_run_snapshot_unsupported(self, mocked):
+        """Test that the tree is exported if it can't be copied."""
+        target = Thing(config=Thing(
+                verify_command="/bin/true", verify_snapshot='auto'),
+                       tree=Thing(basedir=os.path.join(self.tempdir, 'tree')))
+        with patch('tarmac.snapshot.snapshot_tree',
+                   side_effect=SnapshotUnsupported('No.')):
+            self.plugin.run(
+                command=self.command, target=target, source=None,
+                proposal=self.proposal)
+        self.assertTrue(mocked.called)
+
+
+class TestCommandSnapshot(BranchTestCase):
+    """Test the Command plug-in with snapshots of a real tree."""
+
+    def setUp(self):
+        super(TestCommandSnapshot, self).setUp()
+        self.proposal = Thing(
+            source_branch=Thing(display_name='lp:project/source'),
+            target_branch=Thing(display_name='lp:project'))
+        self.plugin = command.Command()
+        self.command = FakeCommand(CommandRegistry(config=self.config))
+        tree_dir = self.branch1.config.tree_dir
+        with open(os.path.join(tree_dir, 'unchanged'), 'w') as f:
+            f.write('Unchanged.')
+        self.branch1.tree.add(['unchanged'])
+        self.branch1.commit('A file.')
+        self.branch1.merge(self.branch2)
+
+    def test_run_hardlink(self):
+        """Test that the command runs in a hard linked copy."""
+        self.branch1.config.verify_command = 'test -f README'
+        self.branch1.config.verify_snapshot = 'hardlink'
+        self.plugin.run(command=self.command, target=self.branch1,
+                        source=None, proposal=self.proposal)
+
+    def test_run_hardlink_changed_in_place(self):
+        """Test that writing through a hard link fails the command."""
+        self.branch1.config.verify_command = 'echo Changed. >> unchanged'
+        self.branch1.config.verify_snapshot = 'hardlink'
+        self.assertRaises(command.VerifyCommandFailed,
+                          self.plugin.run,
+                          command=self.command, target=self.branch1,
+                          source=None, proposal=self.proposal)
+
+    def test_run_hardlink_changed_in_place_incremental_cleanup(self):
+        """Test that changes written through a hard link are cleaned up."""
+        self.branch1.config.incremental_cleanup = 'true'
+        # Merge again from a clean tree, so what the merge touched is known.
+        self.branch1.cleanup()
+        self.branch1.merge(self.branch2)
+        self.branch1.config.verify_command = 'echo Changed. >> unchanged'
+        self.branch1.config.verify_snapshot = 'hardlink'
+        self.assertRaises(command.VerifyCommandFailed,
+                          self.plugin.run,
+                          command=self.command, target=self.branch1,
+                          source=None, proposal=self.proposal)
+        self.branch1.cleanup()
+        self.assertTrue(self.branch1.is_clean())
+
+
+class TestCommandCache(BranchTestCase):
+    """Test the Command plug-in's cache of results."""
+
+    def setUp(self):
+        super(TestCommandCache, self).setUp()
+        self.config.debug = False
+        self.proposal = Thing(
+            source_branch=Thing(display_name='lp:project/source'),
+            target_branch=Thing(display_name='lp:project'))
+        self.command = FakeCommand(CommandRegistry(config=self.config))
+        self.runs = os.path.join(self.TEST_ROOT, 'runs')
+        self.addCleanup(os.remove, self.runs)
+        self.branch1.config.verify_cache = 'true'
+        self.branch1.merge(self.branch2)
+
+    def run_plugin(self):
+        """Run a new instance of the plug-in, as a new tarmac run would."""
+        command.Command().run(command=self.command, target=self.branch1,
+                              source=None, proposal=self.proposal)
+
+    def test_run_cached(self):
+        """Test that the command isn't run again on the same tree."""
+        self.branch1.config.verify_command = 'echo run >> %s' % self.runs
+        self.run_plugin()
+        self.run_plugin()
+        with open(self.runs) as runs:
+            self.assertEqual('run\n', runs.read())
+
+    def test_run_cached_failure(self):
+        """Test that a cached failure is reported with its output."""
+        self.branch1.config.verify_command = (
+            'echo run >> %s; echo Failed.; false' % self.runs)
+        self.assertRaises(command.VerifyCommandFailed, self.run_plugin)
+        try:
+            self.run_plugin()
+        except command.VerifyCommandFailed, error:
+            self.assertIn(u'Failed.', error.comment)
+        else:
+            self.fail('The cached failure was not reported.')
+        with open(self.runs) as runs:
+            self.assertEqual('run\n', runs.read())
+
+
+class TestCommandOutput(BranchTestCase):
+    """Test the capture of the Command plug-in's output."""
+
+    def setUp(self):
+        super(TestCommandOutput, self).setUp()
+        self.config.debug = False
+        self.proposal = Thing(
+            source_branch=Thing(display_name='lp:project/source'),
+            target_branch=Thing(display_name='lp:project'))
+        self.plugin = command.Command()
+        self.command = FakeCommand(CommandRegistry(config=self.config))
+        self.log_dir = os.path.join(self.TEST_ROOT, 'verify-logs')
+        self.addCleanup(shutil.rmtree, self.log_dir, True)
+        self.config.verify_log_dir = self.log_dir
+        self.branch1.merge(self.branch2)
+
+    def test_run_long_output(self):
+        """Test that only the ends of long output are reported."""
+        self.branch1.config.verify_command = (
+            'echo First; seq 100000; echo Last; false')
+        try:
+            self.plugin.run(command=self.command, target=self.branch1,
+                            source=None, proposal=self.proposal)
+        except command.VerifyCommandFailed, error:
+            self.assertIn(u'First', error.comment)
+            self.assertIn(u'bytes omitted', error.comment)
+            self.assertIn(u'Last', error.comment)
+            self.assertTrue(len(error.comment) < 50000)
+        else:
+            self.fail('The command did not fail.')
+        [log_dir] = os.listdir(self.log_dir)
+        output = gzip.open(
+            os.path.join(self.log_dir, log_dir, 'stdout.gz')).read()
+        self.assertEqual(100002, len(output.splitlines()))
+
+    def test_run_log_removed(self):
+        """Test that the log of a successful command is removed."""
+        self.branch1.config.verify_command = 'seq 10'
+        self.plugin.run(command=self.command, target=self.branch1,
+                        source=None, proposal=self.proposal)
+        self.assertEqual([], os.listdir(self.log_dir))
+
+    def test_run_logs_pruned(self):
+        """Test that old logs and all but the newest few are removed."""
+        self.config.verify_log_count = '3'
+        os.makedirs(self.log_dir)
+        now = time.time()
+        for name, age in [('expired', 8 * 86400), ('oldest', 300),
+                          ('older', 200), ('newest', 100)]:
+            os.mkdir(os.path.join(self.log_dir, name))
+            os.utime(os.path.join(self.log_dir, name),
+                     (now - age, now - age))
+        self.branch1.config.verify_command = 'false'
+        self.assertRaises(command.VerifyCommandFailed,
+                          self.plugin.run, command=self.command,
+                          target=self.branch1, source=None,
+                          proposal=self.proposal)
+        log_dirs = sorted(os.listdir(self.log_dir))
+        self.assertEqual(3, len(log_dirs))
+        self.assertEqual(['newest', 'older'], log_dirs[1:])
+
+    def test_run_shards(self):
+        """Test that each shard of the command is run."""
+        runs = os.path.join(self.TEST_ROOT, 'runs')
+        self.addCleanup(os.remove, runs)
+        self.branch1.config.verify_command = (
+            'echo {shard}/{total} $TARMAC_SHARD >> %s' % runs)
+        self.branch1.config.verify_shards = '3'
+        self.plugin.run(command=self.command, target=self.branch1,
+                        source=None, proposal=self.proposal)
+        with open(runs) as f:
+            self.assertEqual(['1/3 1', '2/3 2', '3/3 3'],
+                             sorted(f.read().splitlines()))
+
+    def test_run_shard_failed(self):
+        """Test that the output of a failed shard is reported."""
+        self.branch1.config.verify_command = (
+            'echo Shard {shard}.; test {shard} != 2')
+        self.branch1.config.verify_shards = '3'
+        try:
+            self.plugin.run(command=self.command, target=self.branch1,
+                            source=None, proposal=self.proposal)
+        except command.VerifyCommandFailed, error:
+            self.assertIn(u'Shard 2 of 3 exited with 1:\nShard 2.',
+                          error.comment)
+            self.assertNotIn(u'Shard 1.', error.comment)
+        else:
+            self.fail('The command did not fail.')
@@ -16,7 +16,9 @@
 """Tests for the votes plugin."""
 
 import operator
+import os
 
+from tarmac.cache import PersistentCache
 from tarmac.plugins.votes import InvalidCriterion, Votes, VotingViolation
 from tarmac.tests import TarmacTestCase
 from tarmac.tests import Thing
@@ -181,3 +183,23 @@ class TestVotes(TarmacTestCase):
                   is_pending=False,
                   reviewer=Thing(display_name=u'Reviewer'))]
         self.assertEqual(expected, self.plugin.count_votes(self.proposal))
+
+    def test_count_votes_cached(self):
+        """Test that trusted reviewers are looked up once per cache."""
+        cache = PersistentCache(
+            os.path.join(self.config.CACHE_HOME, 'identities.json'))
+        self.proposal.target_branch.unique_name = u'~user/project/trunk'
+        for vote in self.proposal.votes:
+            vote.reviewer.name = vote.reviewer.display_name.lower()
+        calls = []
+
+        def isReviewer(reviewer=None):
+            calls.append(reviewer.name)
+            return self.isReviewer(reviewer=reviewer)
+
+        self.proposal.target_branch.isPersonTrustedReviewer = isReviewer
+        self.plugin.identity_cache = cache
+        expected = {u"Approve": 2, u"Needs Information": 1}
+        self.assertEqual(expected, self.plugin.count_votes(self.proposal))
+        self.assertEqual(expected, self.plugin.count_votes(self.proposal))
+        self.assertEqual([u'reviewer', u'community'], calls)
@@ -18,6 +18,7 @@
 import operator
 import re
 
+from tarmac.cache import cached
 from tarmac.exceptions import TarmacMergeError
 from tarmac.hooks import tarmac_hooks
 from tarmac.plugins import TarmacPlugin
@@ -42,6 +43,9 @@ criteria_expr = re.compile(
         "|".join(re.escape(op) for op in operator_map)),
     re.VERBOSE | re.MULTILINE)
 
+# The config keys which this plug-in reacts to.
+CONFIG_KEYS = ('voting_criteria',)
+
 
 class InvalidCriterion(Exception):
     """A voting criterion is not understood."""
@@ -61,6 +65,8 @@ class VoteCounter(dict):
 class Votes(TarmacPlugin):
     """Plugin to enforce a voting policy."""
 
+    identity_cache = None
+
     def run(self, command, target, source, proposal):
         """See L{TarmacPlugin.run}."""
         try:
@@ -71,6 +77,7 @@ class Votes(TarmacPlugin):
             except AttributeError:
                 return
 
+        self.identity_cache = getattr(command, 'identity_cache', None)
         votes = self.count_votes(proposal)
         criteria = self.parse_criteria(criteria)
 
@@ -94,7 +101,7 @@ class Votes(TarmacPlugin):
         counter = VoteCounter()
         target = proposal.target_branch
         for vote in proposal.votes:
-            if not target.isPersonTrustedReviewer(reviewer=vote.reviewer):
+            if not self.is_trusted(target, vote.reviewer):
                 continue
             if vote.is_pending:
                 counter[u'Pending'] += 1
@@ -104,6 +111,21 @@ class Votes(TarmacPlugin):
                     counter[comment.vote] += 1
         return counter
 
+    def is_trusted(self, target, reviewer):
+        """Is %reviewer a trusted reviewer for the %target branch?
+
+        The answer is remembered in the command's identity cache, if the
+        plugin was given one.
+        """
+        def check():
+            return target.isPersonTrustedReviewer(reviewer=reviewer)
+        target_name = getattr(target, 'unique_name', None)
+        reviewer_name = getattr(reviewer, 'name', None)
+        if target_name is None or reviewer_name is None:
+            return check()
+        return cached(self.identity_cache,
+                      u'trusted:%s:%s' % (target_name, reviewer_name), check)
+
     def parse_criteria(self, criteria):
         """Parse a given criteria string.
 
@@ -0,0 +1,105 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Ordering of merge proposals by their prerequisite branches.'''
+import heapq
+
+
+class ProposalGraph(object):
+    '''The dependencies between a set of merge proposals.
+
+    A proposal depends on the proposals whose source branch is its
+    prerequisite branch.  Proposals for prerequisites outside the set are
+    not part of the graph, so don't hold anything up.
+    '''
+
+    def __init__(self, proposals):
+        self.proposals = list(proposals)
+        sources = {}
+        for index, proposal in enumerate(self.proposals):
+            sources.setdefault(
+                proposal.source_branch.unique_name, []).append(index)
+
+        # The indexes of the proposals each proposal depends on, and of
+        # those depending on it.
+        self._depends = [[] for proposal in self.proposals]
+        self._dependents = [[] for proposal in self.proposals]
+        for index, proposal in enumerate(self.proposals):
+            prerequisite = proposal.prerequisite_branch
+            if prerequisite is None:
+                continue
+            for other in sources.get(prerequisite.unique_name, []):
+                if other != index:
+                    self._depends[index].append(other)
+                    self._dependents[other].append(index)
+
+    def sort(self):
+        '''Return the proposals in dependency order, and any in cycles.
+
+        Returns a (sorted, cyclic) tuple of lists.  Every proposal in sorted
+        comes after the ones it depends on, and otherwise keeps its original
+        order.  Proposals in, or depending on, a dependency cycle can't be
+        ordered and are returned in cyclic instead.
+        '''
+        waiting = [len(depends) for depends in self._depends]
+        # The ready proposals are taken in their original order, so one
+        # which only just became ready doesn't go after later ones.
+        ready = [index for index, count in enumerate(waiting) if count == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            current = heapq.heappop(ready)
+            order.append(current)
+            for dependent in self._dependents[current]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+        cyclic = [self.proposals[index]
+                  for index, count in enumerate(waiting) if count > 0]
+        return [self.proposals[index] for index in order], cyclic
+
+    def chains(self):
+        '''Return the independent chains of proposals, each sorted.
+
+        Proposals in different chains don't depend on each other, directly
+        or indirectly, so the chains can be landed concurrently.  Proposals
+        in cycles are left out, as in sort().
+        '''
+        ordered, cyclic = self.sort()
+        position = dict(
+            (id(proposal), index)
+            for index, proposal in enumerate(self.proposals))
+        # Union-find over the dependency edges.
+        parents = range(len(self.proposals))
+
+        def find(index):
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        for index, depends in enumerate(self._depends):
+            for other in depends:
+                parents[find(index)] = find(other)
+
+        chains = {}
+        roots = []
+        for proposal in ordered:
+            chain = find(position[id(proposal)])
+            if chain not in chains:
+                chains[chain] = []
+                roots.append(chain)
+            chains[chain].append(proposal)
+        return [chains[root] for root in roots]
@@ -0,0 +1,106 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Cheap copies of working trees, for running commands in.'''
+import errno
+import fcntl
+import os
+import shutil
+
+# The Linux ioctl for cloning a file's extents, as in cp --reflink.
+FICLONE = 0x40049409
+
+SNAPSHOT_METHODS = ('auto', 'reflink', 'hardlink')
+
+
+class SnapshotUnsupported(Exception):
+    """The tree can't be copied that way, e.g. on this filesystem."""
+
+
+def reflink(source, dest):
+    '''Copy %source to %dest, sharing its data until either is changed.'''
+    with open(source, 'rb') as source_file:
+        with open(dest, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copymode(source, dest)
+
+
+def changed_paths(tree):
+    '''Return the paths in %tree which differ from its basis.'''
+    paths = set()
+    tree.lock_read()
+    try:
+        for change in tree.iter_changes(tree.basis_tree()):
+            paths.update(path for path in change[1] if path is not None)
+    finally:
+        tree.unlock()
+    return paths
+
+
+def snapshot_tree(tree, dest, method='auto'):
+    '''Copy the versioned files of %tree into the empty directory %dest.
+
+    With the 'reflink' method, files share their data with the tree until
+    they are written to.  The 'hardlink' method hard links files which are
+    unchanged from the basis of the tree, and copies the others; anything
+    writing to the copy must then replace files rather than change them in
+    place.  'auto' uses reflinks if the filesystem supports them, and hard
+    links if not.
+
+    Returns the method used.  Raises SnapshotUnsupported if it can't be
+    done, e.g. because %dest is on another filesystem.
+    '''
+    if method not in SNAPSHOT_METHODS:
+        raise SnapshotUnsupported('Unknown snapshot method: %s' % method)
+    changed = None
+    tree.lock_read()
+    try:
+        for path, entry in tree.iter_entries_by_dir():
+            source = tree.abspath(path)
+            target = os.path.join(dest, path)
+            if not path or not os.path.lexists(source):
+                continue
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            elif os.path.isdir(source):
+                os.mkdir(target)
+            else:
+                if method in ('auto', 'reflink'):
+                    try:
+                        reflink(source, target)
+                        method = 'reflink'
+                        continue
+                    except (IOError, OSError), error:
+                        if os.path.exists(target):
+                            os.remove(target)
+                        if method == 'reflink':
+                            raise SnapshotUnsupported(
+                                'Can not reflink %s: %s' % (source, error))
+                        method = 'hardlink'
+                if changed is None:
+                    changed = changed_paths(tree)
+                if path in changed:
+                    shutil.copy2(source, target)
+                    continue
+                try:
+                    os.link(source, target)
+                except OSError, error:
+                    if error.errno in (errno.EXDEV, errno.EPERM):
+                        raise SnapshotUnsupported(
+                            'Can not hard link %s: %s' % (source, error))
+                    raise
+    finally:
+        tree.unlock()
+    return method
@@ -0,0 +1,439 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''A local stand-in for the Launchpad API, for testing runs offline.
+
+The stand-in serves the objects in a JSON fixture to launchpadlib, with a
+configurable latency and failure rate for each request.  Start it with e.g.:
+
+  python -m tarmac.standin fixture.json --port 8080 --latency 0.2
+
+and point Tarmac at it with `launchpad_standin = http://localhost:8080/` in
+the [Tarmac] section of the config.
+
+A fixture maps the path of each object below the service root to its
+resource type and fields, and names the object launchpad.me is:
+
+  {"me": "~tarmac",
+   "entries": {
+     "~tarmac": {"resource_type": "person", "name": "tarmac"},
+     "~tarmac/project/trunk": {
+       "resource_type": "branch", "bzr_identity": "lp:project",
+       "landing_candidates": ["~tarmac/project/fix/+merge/1"]},
+     ...}}
+
+A field named after a link, such as "owner" for owner_link, holds the path
+of the object linked to, and a field named after a collection, such as
+"landing_candidates", holds the list of their paths.  People are also found
+by the list of their "emails".
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from SocketServer import ThreadingMixIn
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as ElementTree
+
+import launchpadlib
+
+WADL_PATH = os.path.join(
+    os.path.dirname(launchpadlib.__file__), 'testing', 'launchpad-wadl.xml')
+WADL_BASE = 'https://api.launchpad.test/1.0/'
+WADL_MEDIA_TYPE = 'application/vnd.sun.wadl+xml'
+WADL_NAMESPACE = '{http://research.sun.com/wadl/2006/10}'
+
+# The collections below the service root, by the resource type they hold.
+TOP_LEVEL_COLLECTIONS = {
+    'branches': ('branch',),
+    'bugs': ('bug',),
+    'people': ('person', 'team'),
+    'projects': ('project',),
+    }
+
+PAGE_SIZE = 75
+
+
+class StandinError(Exception):
+    '''A request which the stand-in answers with an HTTP error.'''
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Model(object):
+    '''The Launchpad objects served by the stand-in, by their path.'''
+
+    def __init__(self, entries=None, me=None):
+        self.entries = entries or {}
+        self.me = me
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path):
+        '''Return the model in the JSON fixture at %path.'''
+        with open(path) as fixture:
+            data = json.load(fixture)
+        return cls(data.get('entries'), data.get('me'))
+
+    def add(self, path, resource_type, **fields):
+        '''Add the object at %path, and return %path.'''
+        with self.lock:
+            fields['resource_type'] = resource_type
+            self.entries[path] = fields
+        return path
+
+    def get(self, path):
+        '''Return the fields of the object at %path.'''
+        try:
+            return self.entries[path]
+        except KeyError:
+            raise StandinError(404, 'Object not found: %s' % path)
+
+    def etag(self, path):
+        '''Return the entity tag of the object at %path.'''
+        return '"%s"' % hashlib.sha1(
+            json.dumps(self.get(path), sort_keys=True)).hexdigest()
+
+    # The named operations Tarmac uses, which return either a path to
+    # represent, a path which was created, or a plain value.
+
+    def getByUrl(self, path, url):
+        for branch, entry in sorted(self.entries.items()):
+            if entry['resource_type'] == 'branch' and url in (
+                    entry.get('bzr_identity'), entry.get('url'),
+                    'lp:' + branch):
+                return 'entry', branch
+        return 'value', None
+
+    def getByEmail(self, path, email):
+        for person, entry in sorted(self.entries.items()):
+            if email in entry.get('emails', ()):
+                return 'entry', person
+        return 'value', None
+
+    def getSeries(self, path, name):
+        for series in self.get(path).get('series', ()):
+            if self.get(series).get('name') == name:
+                return 'entry', series
+        return 'value', None
+
+    def setStatus(self, path, status, revid=None):
+        entry = self.get(path)
+        entry['queue_status'] = status
+        if revid is not None:
+            entry['reviewed_revid'] = revid
+        return 'value', None
+
+    def createComment(self, path, subject=None, content=None, vote=None,
+                      review_type=None):
+        entry = self.get(path)
+        comments = entry.setdefault('all_comments', [])
+        comment = self.add(
+            '%s/comments/%d' % (path, len(comments) + 1),
+            'code_review_comment', title=subject, message_body=content,
+            vote=vote, vote_tag=review_type, author=self.me)
+        comments.append(comment)
+        return 'created', comment
+
+    NAMED_OPERATIONS = (
+        'getByUrl', 'getByEmail', 'getSeries', 'setStatus', 'createComment')
+
+
+def load_representations(wadl):
+    '''Return the fields of each representation in %wadl.
+
+    The fields of each representation are a list of pairs of the name of
+    the field, and the resource type it links to, or None.
+    '''
+    representations = {}
+    root = ElementTree.fromstring(wadl)
+    for representation in root.iter(WADL_NAMESPACE + 'representation'):
+        if not representation.get('id'):
+            continue
+        fields = representations[representation.get('id')] = []
+        for param in representation.findall(WADL_NAMESPACE + 'param'):
+            link = param.find(WADL_NAMESPACE + 'link')
+            if link is not None and link.get('resource_type'):
+                fields.append((param.get('name'),
+                               link.get('resource_type').rpartition('#')[2]))
+            else:
+                fields.append((param.get('name'), None))
+    return representations
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    '''Answer a launchpadlib request from the model of the server.'''
+
+    def log_message(self, format, *args):
+        logging.getLogger('tarmac.standin').debug(format, *args)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Every request is under a version of the API, such as /devel/.
+        version, _, path = url.path.lstrip('/').partition('/')
+        root = 'http://%s:%d/%s/' % (
+            self.headers.get('Host', 'localhost').split(':')[0],
+            server.server_port, version)
+        if method == 'POST' and body:
+            params.update(urlparse.parse_qs(body))
+        operation = params.pop('ws.op', [None])[0]
+        server.record(method, operation or path)
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            if random.random() < server.failure_rate:
+                raise StandinError(503, 'Injected failure.')
+            with server.model.lock:
+                if not path and WADL_MEDIA_TYPE in self.headers.get(
+                        'Accept', ''):
+                    self.respond(200, server.wadl.replace(WADL_BASE, root),
+                                 WADL_MEDIA_TYPE)
+                elif operation is not None:
+                    self.respond_to_operation(root, path, operation, params)
+                elif method == 'PATCH':
+                    self.respond_to_patch(root, path, body)
+                elif method == 'GET':
+                    self.respond_json(200, self.represent(
+                            root, path, params))
+                else:
+                    raise StandinError(405, 'Method not allowed.')
+        except StandinError, error:
+            self.respond(error.status, str(error), 'text/plain')
+
+    def respond(self, status, content, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def respond_json(self, status, value):
+        self.respond(status, json.dumps(value), 'application/json')
+
+    def respond_to_operation(self, root, path, operation, params):
+        '''Answer a call of the named %operation on the object at %path.'''
+        model = self.server.model
+        if operation not in model.NAMED_OPERATIONS:
+            raise StandinError(400, 'Unknown operation: %s' % operation)
+        if path not in TOP_LEVEL_COLLECTIONS:
+            model.get(path)
+        arguments = {}
+        for name, values in params.items():
+            # launchpadlib sends most arguments as JSON.
+            try:
+                arguments[str(name)] = json.loads(values[0])
+            except ValueError:
+                arguments[str(name)] = values[0]
+        try:
+            kind, result = getattr(model, operation)(path, **arguments)
+        except TypeError, error:
+            raise StandinError(400, str(error))
+        if kind == 'created':
+            self.respond(201, '', 'text/plain',
+                         headers=[('Location', root + result)])
+        elif kind == 'entry':
+            self.respond_json(200, self.represent_entry(root, result))
+        else:
+            self.respond_json(200, result)
+
+    def respond_to_patch(self, root, path, body):
+        '''Change the fields of the object at %path, as in lp_save.'''
+        entry = self.server.model.get(path)
+        for name, value in json.loads(body).items():
+            if name.endswith('_link') and value is not None:
+                entry[name[:-len('_link')]] = value[len(root):]
+            else:
+                entry[name] = value
+        self.respond_json(209, self.represent_entry(root, path))
+
+    def represent(self, root, path, params):
+        '''Return the JSON representation of what is at %path.'''
+        model = self.server.model
+        if not path:
+            return dict(
+                [(name, root + name[:-len('_collection_link')])
+                 for name, _ in self.server.representations[
+                        'service-root-json']
+                 if name.endswith('_collection_link')],
+                me_link=root + 'people/+me',
+                resource_type_link=root + '#service-root')
+        if path == 'people/+me':
+            return self.represent_entry(root, model.me)
+        if path in model.entries:
+            return self.represent_entry(root, path)
+        if path in TOP_LEVEL_COLLECTIONS:
+            members = [
+                member for member, entry in sorted(model.entries.items())
+                if entry['resource_type'] in TOP_LEVEL_COLLECTIONS[path]]
+            return self.represent_page(
+                root, path, members, params,
+                self.link_type('service-root-json', path))
+        parent, _, name = path.rpartition('/')
+        if parent in model.entries:
+            return self.represent_page(
+                root, path, model.entries[parent].get(name, []), params,
+                self.link_type(
+                    model.entries[parent]['resource_type'] + '-full', name))
+        raise StandinError(404, 'Object not found: %s' % path)
+
+    def link_type(self, representation, collection):
+        '''Return the resource type of %collection in %representation.'''
+        for name, resource_type in self.server.representations.get(
+                representation, ()):
+            if name == collection + '_collection_link':
+                return resource_type
+        raise StandinError(404, 'No such collection: %s' % collection)
+
+    def represent_entry(self, root, path):
+        '''Return the representation of the object at %path.'''
+        model = self.server.model
+        entry = model.get(path)
+        resource_type = entry['resource_type']
+        representation = {}
+        for name, _ in self.server.representations.get(
+                resource_type + '-full', ()):
+            if name == 'self_link':
+                value = root + path
+            elif name == 'resource_type_link':
+                value = root + '#' + resource_type
+            elif name == 'http_etag':
+                value = model.etag(path)
+            elif name == 'web_link':
+                value = entry.get(
+                    'web_link', 'https://launchpad.test/' + path)
+            elif name.endswith('_collection_link'):
+                value = root + path + '/' + name[:-len('_collection_link')]
+            elif name.endswith('_link') and name[:-len('_link')] in entry:
+                link = entry[name[:-len('_link')]]
+                value = root + link if link else None
+            else:
+                value = entry.get(name)
+            representation[name] = value
+        return representation
+
+    def represent_page(self, root, path, members, params, resource_type):
+        '''Return a page of the collection of %members at %path.'''
+        start = int(params.get('ws.start', [0])[0])
+        size = int(params.get('ws.size', [PAGE_SIZE])[0])
+        page = {
+            'total_size': len(members),
+            'start': start,
+            'entries': [self.represent_entry(root, member)
+                        for member in members[start:start + size]],
+            'resource_type_link': root + '#' + resource_type,
+            }
+        if start + size < len(members):
+            page['next_collection_link'] = '%s%s?ws.size=%d&ws.start=%d' % (
+                root, path, size, start + size)
+        return page
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    '''A local HTTP server standing in for the Launchpad API.
+
+    Each request waits %latency seconds, and fails with a 503 error with
+    probability %failure_rate.  The number of requests made is kept in
+    self.requests, by method and operation or path.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, model, latency=0.0, failure_rate=0.0,
+                 host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), StandinRequestHandler)
+        self.model = model
+        self.latency = latency
+        self.failure_rate = failure_rate
+        with open(WADL_PATH) as wadl:
+            self.wadl = wadl.read()
+        self.representations = load_representations(self.wadl)
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def service_root(self):
+        '''The URL to give launchpadlib as the service root.'''
+        return 'http://%s:%d/' % self.server_address
+
+    def record(self, method, target):
+        with self._lock:
+            self.requests[(method, target)] += 1
+
+    def start(self):
+        '''Serve requests in a background thread.'''
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop serving requests.'''
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Serve a stand-in for the Launchpad API.')
+    parser.add_argument('fixture', help='The JSON file of objects to serve.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request.')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='The fraction of requests to fail with a 503.')
+    options = parser.parse_args(args)
+
+    server = StandinServer(
+        Model.load(options.fixture), options.latency, options.failure_rate,
+        options.host, options.port)
+    sys.stdout.write('Serving the Launchpad API at %s\n' % (
+            server.service_root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    for (method, target), count in sorted(server.requests.items()):
+        sys.stdout.write('%6d %s %s\n' % (count, method, target))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.benchmark'''
+import os
+import shutil
+import subprocess
+import sys
+
+from tarmac.benchmark import compare, run_benchmark, run_startup_benchmark
+from tarmac.tests import TarmacTestCase
+
+
+class TestBenchmark(TarmacTestCase):
+
+    def test_run_benchmark(self):
+        """All of the proposals are landed and timed."""
+        path = os.path.join(self.TEST_ROOT, 'benchmark')
+        self.addCleanup(shutil.rmtree, path)
+        timings = run_benchmark(path, depth=3, files=2, tags=1, proposals=2)
+        self.assertEqual(2, timings['landed'])
+        self.assertEqual(2, timings['merge_tags']['count'])
+        self.assertEqual(2, timings['authors']['count'])
+        self.assertEqual(2, timings['fixed_bugs']['count'])
+        self.assertTrue(timings['cleanup']['count'] >= 2)
+
+    def test_run_startup_benchmark(self):
+        """Starting Python, importing the commands and help are timed."""
+        timings = run_startup_benchmark(self.TEST_ROOT, repeat=1)
+        self.assertEqual(['help', 'import', 'python'], sorted(timings))
+        self.assertEqual(1, timings['import']['count'])
+
+    def test_commands_import_lazily(self):
+        """Loading the commands doesn't import launchpadlib or branches."""
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))))
+        loaded = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, tarmac.bin.commands; '
+             'print sorted(set(sys.modules) & set(sys.argv[1:]))',
+             'launchpadlib.launchpad', 'tarmac.branch', 'bzrlib.help'],
+            cwd=root)
+        self.assertEqual('[]\n', loaded)
+
+    def test_compare(self):
+        """Changes are shown as percentages of the previous time."""
+        self.assertEqual(
+            ['cleanup             2.0000s     1.0000s   -50.0%',
+             'elapsed            10.0000s    11.0000s   +10.0%'],
+            compare({'elapsed': 10.0, 'landed': 2,
+                     'cleanup': {'count': 4, 'total': 2.0}},
+                    {'elapsed': 11.0, 'landed': 2, 'per_proposal': None,
+                     'cleanup': {'count': 4, 'total': 1.0}}))
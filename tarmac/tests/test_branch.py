@@ -150,6 +150,34 @@ class TestBranch(BranchTestCase):
         self.assertEqual(sorted(orig_authors),
                          sorted(self.branch1.authors))
 
+    @patch('tarmac.branch.REVISION_BATCH_SIZE', 1)
+    def test_authors_batched(self):
+        """The authors are read in batches, and each is listed once."""
+        self.branch2.commit('First', authors=['author1', 'author2'])
+        self.branch2.commit('Second', authors=['author2'])
+        self.branch2.commit('Third', authors=['author3', 'author1'])
+        repository = self.branch2.bzr_branch.repository
+        with patch.object(repository, 'get_revisions',
+                          wraps=repository.get_revisions) as get_revisions:
+            authors = self.branch2.authors
+        self.assertEqual([u'Tarmac', 'author1', 'author2', 'author3'],
+                         sorted(authors))
+        self.assertTrue(all(len(call[0][0]) == 1
+                            for call in get_revisions.call_args_list))
+
+    def test_authors_cached(self):
+        """The authors are only read again when either tip changes."""
+        self.branch2.commit('First', authors=['author1'])
+        repository = self.branch2.bzr_branch.repository
+        with patch.object(repository, 'get_revisions',
+                          wraps=repository.get_revisions) as get_revisions:
+            self.assertIn('author1', self.branch2.authors)
+            self.assertIn('author1', self.branch2.authors)
+            self.assertEqual(1, get_revisions.call_count)
+            self.branch2.commit('Second', authors=['author2'])
+            self.assertIn('author2', self.branch2.authors)
+            self.assertEqual(2, get_revisions.call_count)
+
     def test_merge_with_bugs(self):
         '''A merge from a branch with authors'''
         bugs = ['https://launchpad.net/bugs/1 fixed',
@@ -166,6 +194,24 @@ class TestBranch(BranchTestCase):
         self.branch2.commit('Landed bugs')
         self.assertEqual(self.branch2.fixed_bugs, self.branch1.fixed_bugs)
 
+    def test_fixed_bugs_indexed(self):
+        """Only revisions missing from the bug index are read."""
+        self.branch1.commit(
+            'Bugs test',
+            revprops={'bugs': 'https://launchpad.net/bugs/1 fixed'})
+        self.assertEqual(['1'], self.branch1.fixed_bugs)
+        target = branch.Branch(self.branch1.lp_branch, self.config)
+        self.branch1.commit(
+            'More bugs',
+            revprops={'bugs': 'https://launchpad.net/bugs/2 fixed'})
+        repository = target.bzr_branch.repository
+        with patch.object(repository, 'get_revisions',
+                          wraps=repository.get_revisions) as get_revisions:
+            self.assertEqual(['2', '1'], target.fixed_bugs)
+        [call] = get_revisions.call_args_list
+        self.assertEqual([self.branch1.bzr_branch.last_revision()],
+                         call[0][0])
+
     def test_merge_with_reviews(self):
         '''A merge with reviewers.'''
         reviews = ['reviewer1 Approve', 'reviewer2 Abstain']
@@ -192,6 +238,47 @@ class TestBranch(BranchTestCase):
         self.assertFalse(self.branch1.tree.changes_from(
                 self.branch1.tree.basis_tree()).has_changed())
 
+    def test_cleanup_incremental(self):
+        """Only the merged paths are reset, without updating the tree."""
+        self.branch1.config.incremental_cleanup = 'true'
+        self.branch1.merge(self.branch2)
+        readme = os.path.join(self.branch1.config.tree_dir, 'README')
+        self.assertTrue(os.path.exists(readme))
+        with patch.object(self.branch1, 'full_cleanup') as full_cleanup:
+            with patch.object(self.branch1.tree, 'update') as update:
+                self.branch1.cleanup()
+        self.assertFalse(full_cleanup.called)
+        self.assertFalse(update.called)
+        self.assertFalse(os.path.exists(readme))
+        self.assertTrue(self.branch1.is_clean())
+
+    def test_cleanup_incremental_updates(self):
+        """The tree is updated when the branch has moved."""
+        self.branch1.config.incremental_cleanup = 'true'
+        self.branch1.merge(self.branch2)
+        self.branch1.lp_branch._internal_bzr_branch.generate_revision_history(
+            self.branch2.bzr_branch.last_revision())
+        self.branch1.cleanup()
+        self.assertTrue(self.branch1.is_clean())
+        self.assertEqual(self.branch2.bzr_branch.last_revision(),
+                         self.branch1.tree.last_revision())
+
+    def test_cleanup_incremental_verify(self):
+        """Files not touched by merges are found by verify_cleanup."""
+        self.branch1.config.incremental_cleanup = 'true'
+        self.branch1.merge(self.branch2)
+        newfile = os.path.join(self.branch1.config.tree_dir, 'newfile')
+        with open(newfile, 'w') as f:
+            f.close()
+        self.branch1.cleanup()
+        self.assertTrue(os.path.exists(newfile))
+        self.assertFalse(self.branch1.is_clean())
+
+        self.branch1.config.verify_cleanup = 'true'
+        self.branch1.cleanup()
+        self.assertFalse(os.path.exists(newfile))
+        self.assertTrue(self.branch1.is_clean())
+
     def test_unmanaged_files(self):
         """Test that the unmanaged_files property returns correct lists."""
         self.branch1.merge(self.branch2)
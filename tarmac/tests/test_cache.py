@@ -0,0 +1,89 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.cache'''
+import os
+
+from mock import patch
+from tarmac.cache import PersistentCache, cached
+from tarmac.tests import TarmacTestCase
+
+
+class TestPersistentCache(TarmacTestCase):
+
+    def setUp(self):
+        super(TestPersistentCache, self).setUp()
+        self.path = os.path.join(self.config.CACHE_HOME, 'test.json')
+
+    def test_save_and_load(self):
+        cache = PersistentCache(self.path)
+        cache.set('key', [1, 2])
+        cache.set('missing', None)
+        cache.save()
+        cache = PersistentCache(self.path)
+        self.assertEqual([1, 2], cache.get('key'))
+        self.assertTrue('missing' in cache)
+        self.assertEqual(None, cache.get('missing', 'default'))
+
+    def test_save_unchanged(self):
+        cache = PersistentCache(self.path)
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_load_unreadable(self):
+        with open(self.path, 'w') as cache_file:
+            cache_file.write('not json')
+        cache = PersistentCache(self.path)
+        self.assertEqual(0, len(cache))
+
+    def test_ttl(self):
+        cache = PersistentCache(self.path, ttl=60)
+        with patch('time.time', return_value=1000.0):
+            cache.set('key', 'value')
+        with patch('time.time', return_value=1060.0):
+            self.assertEqual('value', cache.get('key'))
+        with patch('time.time', return_value=1061.0):
+            self.assertFalse('key' in cache)
+            self.assertEqual(None, cache.get('key'))
+
+    def test_lru_eviction(self):
+        cache = PersistentCache(self.path, max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(['a', 'c'], sorted(cache._entries.keys()))
+        # The usage order survives saving.
+        cache.save()
+        cache = PersistentCache(self.path, max_entries=2)
+        cache.set('d', 4)
+        self.assertEqual(['c', 'd'], sorted(cache._entries.keys()))
+
+    def test_fetch(self):
+        cache = PersistentCache(self.path)
+        calls = []
+
+        def func():
+            calls.append(None)
+            return 'value'
+
+        self.assertEqual('value', cache.fetch('key', func))
+        self.assertEqual('value', cache.fetch('key', func))
+        self.assertEqual(1, len(calls))
+
+    def test_cached_without_cache(self):
+        self.assertEqual('value', cached(None, 'key', lambda: 'value'))
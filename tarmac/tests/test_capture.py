@@ -0,0 +1,64 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.capture'''
+import gzip
+import os
+
+from tarmac.capture import OutputCapture
+from tarmac.tests import TarmacTestCase
+
+
+class TestOutputCapture(TarmacTestCase):
+
+    def test_short_output(self):
+        """Output shorter than the head and tail is kept whole."""
+        capture = OutputCapture(head_size=4, tail_size=4)
+        for chunk in ['ab', 'cd', 'ef']:
+            capture.write(chunk)
+        self.assertEqual(6, capture.size)
+        self.assertFalse(capture.truncated)
+        self.assertEqual('abcdef', capture.getvalue())
+
+    def test_long_output(self):
+        """Only the head and tail of long output are kept."""
+        capture = OutputCapture(head_size=4, tail_size=4)
+        for chunk in ['abc', 'defgh', 'ijk', 'lmn', 'op']:
+            capture.write(chunk)
+        self.assertEqual(16, capture.size)
+        self.assertTrue(capture.truncated)
+        self.assertEqual('abcd\n[... 8 bytes omitted ...]\nmnop',
+                         capture.getvalue())
+
+    def test_log_file(self):
+        """All of the output is written to the log file."""
+        log_path = os.path.join(self.TEST_ROOT, 'capture.gz')
+        self.addCleanup(os.remove, log_path)
+        capture = OutputCapture(log_path, head_size=2, tail_size=2)
+        capture.write('abc')
+        capture.write('def')
+        capture.close()
+        self.assertIn(log_path, capture.getvalue())
+        self.assertEqual('abcdef', gzip.open(log_path).read())
+
+    def test_discard(self):
+        """The log file is removed by discard()."""
+        log_path = os.path.join(self.TEST_ROOT, 'capture.gz')
+        capture = OutputCapture(log_path)
+        capture.write('abc')
+        capture.discard()
+        self.assertFalse(os.path.exists(log_path))
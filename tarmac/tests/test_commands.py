@@ -15,6 +15,7 @@
 # along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
 '''Tests for tarmac.bin.commands.py.'''
 from cStringIO import StringIO
+import json
 import os
 import shutil
 import sys
@@ -24,16 +25,22 @@ from tarmac.bin import commands
 from tarmac.bin.registry import CommandRegistry
 from tarmac.branch import Branch
 from tarmac.config import TarmacConfig
+from tarmac.connection import api_calls, parse_budget
 from tarmac.exceptions import (
     InvalidWorkingTree,
+    TarmacCommandError,
     UnapprovedChanges,
 )
+from tarmac.hooks import tarmac_hooks
+from tarmac.log import target_log_file
+from tarmac.standin import Model, StandinServer
 from tarmac.tests import (
     BranchTestCase,
     MockLPBranch,
     TarmacTestCase,
     Thing,
 )
+from tarmac.trace import tracer
 
 
 class FakeCommand(commands.TarmacCommand):
@@ -118,10 +125,11 @@ class TestHelpCommand(TarmacTestCase):
         sys.stdout = old_stdout
 
 
-class TestMergeCommand(BranchTestCase):
+class MergeCommandTestCase(BranchTestCase):
+    """Fake Launchpad branches and proposals for the merging commands."""
 
     def setUp(self):
-        super(TestMergeCommand, self).setUp()
+        super(MergeCommandTestCase, self).setUp()
 
         self.branches = [Thing(
                 bzr_identity=self.branch2.lp_branch.bzr_identity,
@@ -180,10 +188,6 @@ class TestMergeCommand(BranchTestCase):
         self.launchpad = Thing(branches=Thing(getByUrl=self.getBranchByUrl),
                                me=Thing(display_name='Tarmac'))
         self.error = None
-        registry = CommandRegistry(config=self.config)
-        registry.register_command('merge', commands.cmd_merge)
-
-        self.command = registry._get_command(commands.cmd_merge, 'merge')
 
     def addProposal(self, name, prerequisite_branch=None):
         """Create a 3rd branch with a proposal"""
@@ -236,12 +240,262 @@ class TestMergeCommand(BranchTestCase):
         except IndexError:
             return None
 
+
+class TestMergeCommand(MergeCommandTestCase):
+
+    def setUp(self):
+        super(TestMergeCommand, self).setUp()
+        registry = CommandRegistry(config=self.config)
+        registry.register_command('merge', commands.cmd_merge)
+
+        self.command = registry._get_command(commands.cmd_merge, 'merge')
+
     def test_run(self):
         """Test that the merge command merges a branch successfully."""
         self.proposals[1].reviewed_revid = \
             self.branch2.bzr_branch.last_revision()
         self.command.run(launchpad=self.launchpad)
 
+    def start_standin(self):
+        """Serve the branches and proposal from a Launchpad stand-in."""
+        model = Model(me='~tarmac')
+        model.add('~tarmac', 'person', name='tarmac', display_name='Tarmac')
+        model.add('~user/project/source', 'branch',
+                  bzr_identity=self.branch2.lp_branch.bzr_identity,
+                  revision_count=self.branch2.lp_branch.revision_count)
+        model.add('~user/project/target', 'branch',
+                  bzr_identity=self.branch1.lp_branch.bzr_identity,
+                  revision_count=self.branch1.lp_branch.revision_count,
+                  landing_candidates=['~user/project/source/+merge/1'])
+        model.add('~user/project/source/+merge/1', 'branch_merge_proposal',
+                  queue_status=u'Approved', commit_message=u'Commit this.',
+                  source_branch='~user/project/source',
+                  target_branch='~user/project/target',
+                  reviewed_revid=self.branch2.bzr_branch.last_revision())
+        server = StandinServer(model)
+        server.start()
+        self.addCleanup(server.stop)
+        self.config.set('Tarmac', 'launchpad_standin', server.service_root)
+        return server
+
+    def test_run_standin(self):
+        """Test merging with the Launchpad API served by a stand-in."""
+        server = self.start_standin()
+        self.command.run()
+        target = self.branch1.bzr_branch
+        self.assertEqual(
+            [self.branch2.bzr_branch.last_revision()],
+            target.repository.get_revision(
+                target.last_revision()).parent_ids[1:])
+        self.assertIn(('GET', '~user/project/target/landing_candidates'),
+                      server.requests)
+
+    def test_api_call_budget(self):
+        """Test that the Launchpad API calls of a run stay within budget."""
+        self.start_standin()
+        self.command.run()
+        summary = api_calls.summary()
+        self.assertTrue(summary['candidates']['calls'] > 0)
+        self.assertEqual({}, api_calls.over_budget(
+                parse_budget('10, candidates=4')))
+        self.assertEqual(
+            ['total'], api_calls.over_budget(parse_budget('1')).keys())
+
+    def test_run_parallel(self):
+        """Test that --jobs merges the configured targets in workers."""
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        for branch in self.config.branches:
+            self.config.remove_option(branch, 'log_file')
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad, jobs=2)
+        self.assertEqual(revno + 1, self.branch1.bzr_branch.revno())
+        self.assertEqual(None, commands._worker_command)
+
+        # Each worker logged to its own target's file.
+        target_log = target_log_file(
+            self.config, self.branch1.lp_branch.bzr_identity)
+        other_log = target_log_file(
+            self.config, self.branch2.lp_branch.bzr_identity)
+        self.assertNotEqual(target_log, other_log)
+        with open(target_log) as f:
+            target_output = f.read()
+        with open(other_log) as f:
+            other_output = f.read()
+        self.assertIn('Committed revision', target_output)
+        self.assertNotIn('Committed revision', other_output)
+        self.assertIn('No approved proposals found for %s' %
+                      self.branch2.lp_branch.bzr_identity, other_output)
+
+    def test_run_parallel_shared_tree_dir(self):
+        """Test that targets sharing a tree_dir are not run in parallel."""
+        self.config.set(self.branch2.lp_branch.bzr_identity, 'tree_dir',
+                        self.branch1.lp_branch.tree_dir + '/')
+        self.assertRaises(TarmacCommandError, self.command.run,
+                          launchpad=self.launchpad, jobs=2)
+
+    def test_run_merge_train(self):
+        """Test that a batch of proposals lands as separate commits."""
+        self.addProposal('train')
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'merge_batch_size', '2')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.proposals[2].reviewed_revid = \
+            self.branches[2]._internal_bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad)
+        self.assertEqual(revno + 2, self.branch1.bzr_branch.revno())
+        self.assertEqual(None, self.error)
+
+    def test_run_merge_train_bisects(self):
+        """Test that a failing batch is split to find the bad proposal."""
+        self.addProposal('train_bisect')
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'merge_batch_size', '2')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad)
+        self.assertEqual(revno + 1, self.branch1.bzr_branch.revno())
+        self.assertEqual(self.error.comment,
+                         u'No approved revision specified.')
+
+    def test_run_speculative_merge(self):
+        """Test that proposals merged speculatively land in order."""
+        self.addProposal('speculative')
+        self.addCleanup(shutil.rmtree,
+                        self.branch1.lp_branch.tree_dir + '.speculative', True)
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'speculative_merge', 'true')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.proposals[2].reviewed_revid = \
+            self.branches[2]._internal_bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        with patch.object(self.command, '_open_source',
+                          wraps=self.command._open_source) as mocked:
+            self.command.run(launchpad=self.launchpad)
+        self.assertEqual(revno + 2, self.branch1.bzr_branch.revno())
+        self.assertEqual(None, self.error)
+        # The second source was only opened by the speculative merge.
+        self.assertEqual(2, mocked.call_count)
+        self.assertTrue(os.path.exists(
+            self.branch1.lp_branch.tree_dir + '.speculative'))
+
+    def test_run_speculative_merge_own_branches(self):
+        """Test that the scratch tree never merges a source being checked."""
+        self.addProposal('speculative_own')
+        self.addCleanup(shutil.rmtree,
+                        self.branch1.lp_branch.tree_dir + '.speculative', True)
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'speculative_merge', 'true')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.proposals[2].reviewed_revid = \
+            self.branches[2]._internal_bzr_branch.last_revision()
+        checked = []
+        tarmac_hooks['tarmac_pre_commit'].hook(
+            lambda command, target, source, proposal: checked.append(source),
+            'Checked')
+        self.addCleanup(tarmac_hooks['tarmac_pre_commit'].uninstall,
+                        'Checked')
+        scratch_merged = []
+        merge = Branch.merge
+
+        def record_merge(branch, source, *args, **kwargs):
+            if branch.tree.basedir.endswith('.speculative'):
+                scratch_merged.append(source)
+            return merge(branch, source, *args, **kwargs)
+        with patch.object(Branch, 'merge', record_merge):
+            self.command.run(launchpad=self.launchpad)
+        self.assertEqual(None, self.error)
+        self.assertEqual(2, len(scratch_merged))
+        self.assertFalse(checked[0] in scratch_merged)
+
+    def test_run_speculative_merge_discarded(self):
+        """Test that a failed proposal doesn't keep the next from landing."""
+        self.addProposal('speculative_discard')
+        self.addCleanup(shutil.rmtree,
+                        self.branch1.lp_branch.tree_dir + '.speculative', True)
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'speculative_merge', 'true')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.dotted_revno_to_revision_id(
+            (self.branch2.bzr_branch.revno() - 1,))
+        self.proposals[2].reviewed_revid = \
+            self.branches[2]._internal_bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad)
+        self.assertEqual(revno + 1, self.branch1.bzr_branch.revno())
+        self.assertTrue(isinstance(self.error, UnapprovedChanges))
+
+    def test_run_mirror_branches(self):
+        """Test that proposals land from mirrors of their branches."""
+        self.config.set(self.branch1.lp_branch.bzr_identity,
+                        'mirror_branches', 'true')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad)
+        self.assertEqual(revno + 1, self.branch1.bzr_branch.revno())
+        mirrors = os.path.join(self.config.CACHE_HOME, 'mirrors')
+        self.assertEqual(
+            ['branch1', 'branch2'],
+            sorted(name.rsplit('-', 1)[-1] for name in os.listdir(mirrors)
+                   if not name.startswith('.')))
+
+    def test_identity_cache(self):
+        """Test that the identity cache is configured and saved."""
+        self.config.set('Tarmac', 'identity_cache_ttl', '60')
+        cache = self.command.identity_cache
+        self.assertTrue(cache is self.command.identity_cache)
+        self.assertEqual(60, cache.ttl)
+        self.assertEqual(10000, cache.max_entries)
+        cache.set(u'email:person@example.com', u'person')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.command.run(launchpad=self.launchpad)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.config.CACHE_HOME, 'identities.json')))
+
+    def test_hook_metrics(self):
+        """Test that the time taken by each hook is recorded."""
+        tarmac_hooks['tarmac_pre_merge'].hook(
+            lambda command, target: None, 'Timed')
+        self.addCleanup(tarmac_hooks['tarmac_pre_merge'].uninstall, 'Timed')
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.command.run(launchpad=self.launchpad)
+        with open(os.path.join(
+                self.config.CACHE_HOME, 'hook-metrics.jsonl')) as metrics:
+            [record] = [json.loads(line) for line in metrics]
+        self.assertIn(record['target'], self.config.branches)
+        self.assertEqual(
+            {'ok': 1},
+            record['hooks']['tarmac_pre_merge']['<lambda>']['outcomes'])
+
+    def test_trace(self):
+        """Test that the phases of a run are traced."""
+        trace_file = os.path.join(self.TEST_ROOT, 'trace')
+        self.addCleanup(os.remove, trace_file)
+        self.addCleanup(tracer.configure, None)
+        self.config.set('Tarmac', 'trace_file', trace_file)
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        self.command.run(launchpad=self.launchpad)
+        with open(trace_file) as trace:
+            spans = [json.loads(line) for line in trace]
+        names = [span['name'] for span in spans]
+        for name in ['launchpad_fetch', 'create_branch', 'cleanup',
+                     'open_source', 'merge', 'commit', 'merge_tags',
+                     'land_proposal', 'merge_target']:
+            self.assertIn(name, names)
+        [commit] = [span for span in spans if span['name'] == 'commit']
+        self.assertEqual(self.proposals[1].web_link,
+                         commit['attributes']['proposal'])
+        self.assertIn(commit['attributes']['target'], self.config.branches)
+
     def test_run_unapprovedchanges(self):
         """Test that a mismatch between approved and tip raises an error."""
         self.proposals[1].reviewed_revid = \
@@ -440,21 +694,6 @@ class TestMergeCommand(BranchTestCase):
 
         sys.stdout = old_stdout
 
-    def test__compare_proposals(self):
-        """
-        _compare_proposals is meant to be a sort routine comparison function
-        """
-        self.addProposal("compare_proposals", self.branches[0])
-        self.assertEqual(
-            commands._compare_proposals(self.proposals[0], self.proposals[1]),
-            0)
-        self.assertEqual(
-            commands._compare_proposals(self.proposals[0], self.proposals[2]),
-            -1)
-        self.assertEqual(
-            commands._compare_proposals(self.proposals[2], self.proposals[0]),
-            1)
-
     def test__get_mergable_proposals_for_branch_are_sorted(self):
         """
         Mergable proposals should be in sorted order (prereqs should come
@@ -491,3 +730,131 @@ class TestMergeCommand(BranchTestCase):
         self.addProposal("one_prerequisite", self.branches[0])
         proposals = self.command._get_prerequisite_proposals(self.proposals[2])
         self.assertEqual(len(proposals), 2)
+
+    def test__get_prerequisite_proposals_prefetched(self):
+        """Prerequisites are looked up once, by the prefetch."""
+        self.addProposal("prefetched", self.branches[0])
+        self.proposals[2].reviewed_revid = \
+            self.branches[2]._internal_bzr_branch.last_revision()
+        with patch.object(
+                self.command, '_find_prerequisite_proposals',
+                wraps=self.command._find_prerequisite_proposals) as mocked:
+            self.command.run(launchpad=self.launchpad)
+        self.assertEqual(
+            sorted(id(proposal) for proposal in self.proposals),
+            sorted(id(args[0]) for args, kwargs in mocked.call_args_list))
+        self.assertEqual(
+            2, len(self.command._get_prerequisite_proposals(
+                    self.proposals[2])))
+
+
+class TestQueueCommand(MergeCommandTestCase):
+
+    def setUp(self):
+        super(TestQueueCommand, self).setUp()
+        registry = CommandRegistry(config=self.config)
+        registry.register_command('queue', commands.cmd_queue)
+        self.command = registry._get_command(commands.cmd_queue, 'queue')
+        self.command.outf = StringIO()
+
+    def get_queues(self):
+        """Run the command, and return the queues by target."""
+        self.command.run(launchpad=self.launchpad)
+        return dict((queue['target'], queue) for queue in json.loads(
+                self.command.outf.getvalue()))
+
+    def test_run(self):
+        """Test that every target's candidates are listed."""
+        queues = self.get_queues()
+        self.assertEqual(sorted(self.config.branches), sorted(queues))
+        self.assertEqual(
+            [], queues[self.branches[0].bzr_identity]['candidates'])
+        needs_review, approved = queues[
+            self.branches[1].bzr_identity]['candidates']
+        self.assertEqual({
+                'proposal': self.proposals[0].web_link,
+                'source': self.branches[0].bzr_identity,
+                'status': u'Needs Review',
+                'mergeable': False,
+                'skip_reason': "status is Needs Review, not 'Approved'",
+                'prerequisites': []}, needs_review)
+        self.assertEqual(self.proposals[1].web_link, approved['proposal'])
+        self.assertTrue(approved['mergeable'])
+        self.assertEqual(None, approved['skip_reason'])
+
+    def test_run_prerequisites(self):
+        """Test that the prerequisites each candidate waits on are listed."""
+        self.addProposal('queue_prerequisite')
+        self.proposals[1].prerequisite_branch = self.branches[2]
+        candidates = self.get_queues()[
+            self.branches[1].bzr_identity]['candidates']
+        [waiting] = [candidate for candidate in candidates
+                     if candidate['proposal'] == self.proposals[1].web_link]
+        self.assertEqual('prerequisite not yet merged',
+                         waiting['skip_reason'])
+        self.assertEqual(
+            [{'proposal': self.proposals[2].web_link, 'status': u'Approved'}],
+            waiting['prerequisites'])
+        # The prerequisite comes first, as it would be merged first.
+        self.assertEqual(self.proposals[2].web_link,
+                         candidates[1]['proposal'])
+
+    def test_run_error(self):
+        """Test that an error listing one target is reported in its queue."""
+        def getByUrl(url):
+            if url == self.branches[0].bzr_identity:
+                raise Exception('Launchpad is down.')
+            return self.getBranchByUrl(url)
+        self.launchpad.branches.getByUrl = getByUrl
+        queues = self.get_queues()
+        self.assertEqual('Launchpad is down.',
+                         queues[self.branches[0].bzr_identity]['error'])
+        self.assertEqual(
+            2, len(queues[self.branches[1].bzr_identity]['candidates']))
+
+
+class TestServeCommand(MergeCommandTestCase):
+
+    def setUp(self):
+        super(TestServeCommand, self).setUp()
+        registry = CommandRegistry(config=self.config)
+        registry.register_command('serve', commands.cmd_serve)
+        self.command = registry._get_command(commands.cmd_serve, 'serve')
+        self.command._cycles = 2
+
+    def test_run(self):
+        """Test that serve merges, and keeps its target trees between runs."""
+        self.proposals[1].reviewed_revid = \
+            self.branch2.bzr_branch.last_revision()
+        revno = self.branch1.bzr_branch.revno()
+        self.command.run(launchpad=self.launchpad, interval=0)
+        self.assertEqual(revno + 1, self.branch1.bzr_branch.revno())
+        self.assertEqual([self.branch1.lp_branch.bzr_identity],
+                         self.command._targets.keys())
+        self.assertFalse(os.path.exists(self.config.PID_FILE))
+
+    def test_run_keeps_going_after_errors(self):
+        """Test that an error merging one branch doesn't stop the daemon."""
+        def fail(branch_url):
+            raise Exception('Launchpad is down.')
+        self.command._do_merges = fail
+        self.command._targets['lp:stale'] = object()
+        self.command.run(launchpad=self.launchpad, interval=0)
+        self.assertEqual({}, self.command._targets)
+
+    def test_run_already_running(self):
+        """Test that a second daemon refuses to start."""
+        with open(self.config.PID_FILE, 'w') as pid_file:
+            pid_file.write('%d\n' % os.getppid())
+        self.assertRaises(TarmacCommandError, self.command.run,
+                          launchpad=self.launchpad, interval=0)
+        self.assertTrue(os.path.exists(self.config.PID_FILE))
+
+    def test_get_interval(self):
+        """Test that --interval wins over the poll_interval setting."""
+        self.assertEqual(commands.cmd_serve.DEFAULT_INTERVAL,
+                         self.command._get_interval())
+        self.config.set('Tarmac', 'poll_interval', '60')
+        self.assertEqual(60, self.command._get_interval())
+        self.config.set('Tarmac', 'interval', 0)
+        self.assertEqual(0, self.command._get_interval())
@@ -2,6 +2,7 @@
 import os
 
 from ConfigParser import NoOptionError
+from mock import patch
 from tarmac.config import BranchConfig
 from tarmac.tests import TarmacTestCase
 
@@ -62,6 +63,34 @@ class TestTarmacConfig(TarmacTestCase):
                           self.config.get, 'test', 'test_option')
         self.config.remove_section('test')
 
+    def test_reload(self):
+        """Test that reload picks up changes made to the config file."""
+        self.config.set('Tarmac', 'debug', False)
+        with open(self.config.CONFIG_FILE, 'w') as config_file:
+            config_file.write('[Tarmac]\npoll_interval = 60\n\n'
+                              '[lp:reloaded]\ntree_dir = /tmp/reloaded\n')
+        self.config.reload()
+        self.assertEqual('60', self.config.poll_interval)
+        self.assertFalse(self.config.debug)
+        self.assertEqual('/tmp/reloaded',
+                         self.config.get('lp:reloaded', 'tree_dir'))
+        self.assertIn('lp:reloaded', self.config.branches)
+
+    def test_reload_removed_section(self):
+        """Test that sections removed from the config file are dropped."""
+        with open(self.config.CONFIG_FILE, 'w') as config_file:
+            config_file.write('[Tarmac]\npoll_interval = 60\n\n'
+                              '[lp:removed]\ntree_dir = /tmp/removed\n')
+        self.config.reload()
+        self.assertIn('lp:removed', self.config.branches)
+        self.config.add_section('lp:kept')
+        self.config.set('lp:kept', 'tree_dir', '/tmp/kept')
+        with open(self.config.CONFIG_FILE, 'w') as config_file:
+            config_file.write('[Tarmac]\n')
+        self.config.reload()
+        self.assertEqual(['lp:kept'], self.config.branches)
+        self.assertFalse(hasattr(self.config, 'poll_interval'))
+
 
 class BranchConfigTestCase(TarmacTestCase):
     '''Tests for the tarmac.config.BranchConfig object.'''
@@ -81,3 +110,26 @@ class BranchConfigTestCase(TarmacTestCase):
         config = BranchConfig('lp:test_no_keys', self.config)
         self.assertFalse(hasattr(config, 'missing_key'))
         self.assertIs(None, config.get('missing_key'))
+
+    def test_get_boolean(self):
+        self.config.add_section('lp:test_get_boolean')
+        self.config.set('lp:test_get_boolean', 'on_key', 'True')
+        self.config.set('lp:test_get_boolean', 'off_key', 'no')
+
+        config = BranchConfig('lp:test_get_boolean', self.config)
+
+        self.assertTrue(config.get_boolean('on_key'))
+        self.assertFalse(config.get_boolean('off_key'))
+        self.assertFalse(config.get_boolean('missing_key'))
+        self.assertTrue(config.get_boolean('missing_key', True))
+
+    def test_get_boolean_unknown(self):
+        self.config.add_section('lp:test_get_boolean_unknown')
+        self.config.set('lp:test_get_boolean_unknown', 'typo_key', 'ture')
+
+        config = BranchConfig('lp:test_get_boolean_unknown', self.config)
+
+        with patch('tarmac.config.logging.getLogger') as getLogger:
+            self.assertTrue(config.get_boolean('typo_key', True))
+            self.assertFalse(config.get_boolean('typo_key'))
+        self.assertEqual(2, getLogger.return_value.warning.call_count)
@@ -0,0 +1,115 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.connection'''
+import threading
+
+from tarmac.connection import (
+    APICalls, PerThreadConnection, api_calls, parse_budget,
+    share_between_threads)
+from tarmac.tests import TarmacTestCase, Thing
+
+
+class TestShareBetweenThreads(TarmacTestCase):
+
+    def setUp(self):
+        super(TestShareBetweenThreads, self).setUp()
+        self.connection = Thing(authorizer='authorizer', cache='cache',
+                                timeout=None, proxy_info='proxy_info')
+        self.launchpad = Thing(_browser=Thing(_connection=self.connection),
+                               httpFactory=self.httpFactory)
+
+    def httpFactory(self, authorizer, cache, timeout, proxy_info):
+        return Thing(authorizer=authorizer, cache=cache, timeout=timeout,
+                     proxy_info=proxy_info)
+
+    def test_share_between_threads(self):
+        share_between_threads(self.launchpad)
+        wrapped = self.launchpad._browser._connection
+        self.assertTrue(isinstance(wrapped, PerThreadConnection))
+        self.assertTrue(wrapped.connection is self.connection)
+        # Doing it again doesn't wrap it twice.
+        share_between_threads(self.launchpad)
+        self.assertTrue(self.launchpad._browser._connection is wrapped)
+
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(wrapped.connection))
+        thread.start()
+        thread.join()
+        self.assertFalse(connections[0] is self.connection)
+        self.assertEqual('cache', connections[0].cache)
+        self.assertEqual('authorizer', wrapped.authorizer)
+
+    def test_share_between_threads_fake(self):
+        launchpad = Thing()
+        self.assertTrue(share_between_threads(launchpad) is launchpad)
+
+
+class TestAPICalls(TarmacTestCase):
+
+    def setUp(self):
+        super(TestAPICalls, self).setUp()
+        self.calls = APICalls()
+
+    def test_attribute(self):
+        """Requests are attributed to the innermost owner on the thread."""
+        self.calls.record('GET', 0.5)
+        with self.calls.attribute('Votes'):
+            self.calls.record('GET', 0.25)
+            with self.calls.attribute('merge_error'):
+                self.calls.record('POST', 0.25)
+            thread = threading.Thread(
+                target=self.calls.record, args=('PATCH', 1.0))
+            thread.start()
+            thread.join()
+        summary = self.calls.summary()
+        self.assertEqual({'calls': 2, 'time': 1.5,
+                          'methods': {'GET': 1, 'PATCH': 1}},
+                         summary['tarmac'])
+        self.assertEqual({'calls': 1, 'time': 0.25, 'methods': {'GET': 1}},
+                         summary['Votes'])
+        self.assertEqual(1, summary['merge_error']['calls'])
+        self.assertEqual(4, self.calls.total())
+        self.calls.reset()
+        self.assertEqual({}, self.calls.summary())
+
+    def test_over_budget(self):
+        """Owners over their budget, or the total, are returned."""
+        for owner, count in [('Votes', 3), ('BugResolver', 1)]:
+            with self.calls.attribute(owner):
+                for call in range(count):
+                    self.calls.record('GET', 0.0)
+        self.assertEqual({'Votes': 3}, self.calls.over_budget(
+                {'Votes': 2, 'BugResolver': 1, 'total': 4}))
+        self.assertEqual({'total': 4}, self.calls.over_budget({'total': 3}))
+
+    def test_parse_budget(self):
+        self.assertEqual({'total': 100, 'Votes': 5, 'BugResolver': 20},
+                         parse_budget('100, Votes=5, BugResolver = 20'))
+        self.assertRaises(ValueError, parse_budget, 'Votes=many')
+
+    def test_request(self):
+        """Requests through the shared connection are counted."""
+        api_calls.reset()
+        self.addCleanup(api_calls.reset)
+        connection = PerThreadConnection(None, Thing(
+                request=lambda uri, method, **kwargs: (uri, method)))
+        with api_calls.attribute('Votes'):
+            self.assertEqual(('http://lp/', 'GET'),
+                             connection.request('http://lp/', headers={}))
+        self.assertEqual({'GET': 1}, api_calls.summary()['Votes']['methods'])
@@ -0,0 +1,84 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.hooks'''
+import json
+import os
+
+from tarmac.hooks import HookTimings, TarmacHookRegistry
+from tarmac.tests import TarmacTestCase
+
+
+class Passing(object):
+
+    def __call__(self, *args, **kwargs):
+        pass
+
+
+class Failing(object):
+
+    def __call__(self, *args, **kwargs):
+        raise ValueError('Failed.')
+
+
+class TestTarmacHookRegistry(TarmacTestCase):
+
+    def test_fire_timed(self):
+        """Each callback is timed, by class name and outcome."""
+        registry = TarmacHookRegistry()
+        registry['tarmac_pre_commit'].hook(Passing(), 'Passing')
+        registry['tarmac_pre_commit'].hook(Failing(), 'Failing')
+        registry.fire('tarmac_post_commit')
+        self.assertRaises(ValueError, registry.fire, 'tarmac_pre_commit')
+        registry['tarmac_pre_commit'].uninstall('Failing')
+        registry.fire('tarmac_pre_commit')
+        timings = registry.timings.summary()
+        self.assertEqual(['tarmac_pre_commit'], timings.keys())
+        self.assertEqual(2, timings['tarmac_pre_commit']['Passing']['calls'])
+        self.assertEqual({'ok': 2},
+                         timings['tarmac_pre_commit']['Passing']['outcomes'])
+        self.assertEqual({'ValueError': 1},
+                         timings['tarmac_pre_commit']['Failing']['outcomes'])
+
+
+class TestHookTimings(TarmacTestCase):
+
+    def test_record(self):
+        """Calls are added up."""
+        timings = HookTimings()
+        timings.record('hook', 'Plugin', 2.0, 1.0, 'ok')
+        timings.record('hook', 'Plugin', 1.0, 0.5, 'ok')
+        self.assertEqual(
+            {'hook': {'Plugin': {'calls': 2, 'wall': 3.0, 'max_wall': 2.0,
+                                 'cpu': 1.5, 'outcomes': {'ok': 2}}}},
+            timings.summary())
+        timings.reset()
+        self.assertEqual({}, timings.summary())
+
+    def test_write(self):
+        """Each write appends a line of JSON."""
+        path = os.path.join(self.TEST_ROOT, 'metrics', 'hooks.jsonl')
+        self.addCleanup(os.remove, path)
+        timings = HookTimings()
+        timings.record('hook', 'Plugin', 2.0, 1.0, 'ok')
+        timings.write(path, target='lp:project')
+        timings.write(path, target='lp:other')
+        with open(path) as metrics:
+            records = [json.loads(line) for line in metrics]
+        self.assertEqual(['lp:project', 'lp:other'],
+                         [record['target'] for record in records])
+        self.assertEqual(1, records[0]['hooks']['hook']['Plugin']['calls'])
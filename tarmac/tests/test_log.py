@@ -65,3 +65,14 @@ class TestSetupLogging(TarmacTestCase):
         # logging state, just assert that we are calling the function. So we
         # raise an exception to exit set_up_logging early.
         self.assertRaises(WasCalled, log.set_up_logging, {'log_file': 'foo'})
+
+    def test_target_log_file(self):
+        self.config.set('Tarmac', 'log_file', '/var/log/tarmac.log')
+        self.assertEqual('/var/log/tarmac.lp-project-trunk.log',
+                         log.target_log_file(self.config, 'lp:project/trunk'))
+
+    def test_target_log_file_configured(self):
+        self.config.add_section('lp:project')
+        self.config.set('lp:project', 'log_file', '/tmp/project.log')
+        self.assertEqual('/tmp/project.log',
+                         log.target_log_file(self.config, 'lp:project'))
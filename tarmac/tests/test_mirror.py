@@ -0,0 +1,75 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.mirror'''
+import os
+
+from bzrlib.urlutils import local_path_from_url
+from mock import patch
+from tarmac.branch import Branch
+from tarmac.mirror import BranchMirror
+from tarmac.tests import BranchTestCase
+
+
+def local_path(branch):
+    return local_path_from_url(branch.base).rstrip('/')
+
+
+class TestBranchMirror(BranchTestCase):
+
+    def setUp(self):
+        super(TestBranchMirror, self).setUp()
+        self.mirror = BranchMirror(
+            os.path.join(self.config.CACHE_HOME, 'mirrors'))
+
+    def test_update(self):
+        """Test that a mirror is made, then kept up to date."""
+        local = self.mirror.update(self.branch2.bzr_branch)
+        self.assertTrue(local.repository.is_shared())
+        self.assertEqual(self.mirror.location(self.branch2.bzr_branch),
+                         local_path(local))
+        self.assertEqual(self.branch2.bzr_branch.last_revision(),
+                         local.last_revision())
+
+        self.branch2.commit('Another revision.')
+        local = self.mirror.update(self.branch2.bzr_branch)
+        self.assertEqual(self.branch2.bzr_branch.last_revision(),
+                         local.last_revision())
+
+    def test_branch_with_mirror(self):
+        """Test that sources are read from the mirror, but not targets."""
+        target = Branch.create(self.branch1.lp_branch, self.config,
+                               mirror=self.mirror)
+        source = Branch.create(self.branch2.lp_branch, self.config,
+                               target=target, mirror=self.mirror)
+        self.assertEqual(self.branch1.bzr_branch.base, target.bzr_branch.base)
+        self.assertEqual(self.mirror.location(self.branch1.bzr_branch),
+                         local_path(target.local_branch))
+        self.assertEqual(self.mirror.location(self.branch2.bzr_branch),
+                         local_path(source.bzr_branch))
+        self.assertEqual(self.branch2.authors, source.authors)
+
+    def test_target_fixed_bugs_read_from_mirror(self):
+        """Test that a target's fixed bugs are read from its mirror."""
+        target = Branch.create(self.branch1.lp_branch, self.config,
+                               create_tree=True, mirror=self.mirror)
+        target.commit('Fixed.', revprops={
+                'bugs': 'https://launchpad.net/bugs/1 fixed'})
+        with patch.object(target.bzr_branch.repository,
+                          'get_revisions') as get_revisions:
+            self.assertEqual(['1'], target.fixed_bugs)
+        self.assertFalse(get_revisions.called)
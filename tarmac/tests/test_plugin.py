@@ -78,3 +78,72 @@ class PluginTestCase(TarmacTestCase):
 
         plugin.load_plugins()
         self.assertTrue(mocked.call_count > 0)
+
+    def write_plugin(self, name, source):
+        """Write a plug-in called %name, on the plug-in path."""
+        plugin_path = os.path.join(self.tempdir, 'plugins')
+        if not os.path.exists(plugin_path):
+            os.makedirs(plugin_path)
+        self._patch_env('TARMAC_PLUGIN_PATH', plugin_path)
+        self.addCleanup(
+            lambda: _mod_plugins.__dict__.pop(name, None))
+        plugin_file = os.path.join(plugin_path, name + '.py')
+        with open(plugin_file, 'w') as source_file:
+            source_file.write(source)
+        return plugin_file
+
+    def test_load_plugins_configured(self):
+        """Test that only plug-ins for keys in the config are loaded."""
+        self.write_plugin('keyedplugin', "CONFIG_KEYS = ('keyed_option',)\n")
+        plugin.load_plugins(load_only='keyedplugin', config=self.config)
+        self.assertEqual(None, getattr(_mod_plugins, 'keyedplugin', None))
+
+        self.config.add_section('lp:project')
+        self.config.set('lp:project', 'keyed_option', 'on')
+        plugin.load_plugins(load_only='keyedplugin', config=self.config)
+        self.assertEqual(('keyed_option',),
+                         _mod_plugins.keyedplugin.CONFIG_KEYS)
+
+    def test_load_plugins_undeclared(self):
+        """Test that plug-ins which declare no keys are always loaded."""
+        self.write_plugin('plainplugin', 'LOADED = True\n')
+        plugin.load_plugins(load_only='plainplugin', config=self.config)
+        self.assertTrue(_mod_plugins.plainplugin.LOADED)
+
+    def test_load_plugins_cached(self):
+        """Test that compiled plug-ins are cached until they change."""
+        plugin_file = self.write_plugin('cachedplugin', 'VALUE = 1\n')
+        plugin.load_plugins(load_only='cachedplugin', config=self.config)
+        del _mod_plugins.cachedplugin
+        with patch('tarmac.plugin.ast.parse') as parse:
+            plugin.load_plugins(load_only='cachedplugin', config=self.config)
+            self.assertFalse(parse.called)
+        self.assertEqual(1, _mod_plugins.cachedplugin.VALUE)
+
+        del _mod_plugins.cachedplugin
+        with open(plugin_file, 'w') as source_file:
+            source_file.write('VALUE = 22\n')
+        plugin.load_plugins(load_only='cachedplugin', config=self.config)
+        self.assertEqual(22, _mod_plugins.cachedplugin.VALUE)
+
+    def test_plugin_cache_save_atomic(self):
+        """Test that a failed save leaves the previous index in place."""
+        plugin_file = self.write_plugin('atomicplugin', 'VALUE = 1\n')
+        directory = os.path.join(self.config.CACHE_HOME, 'plugins')
+        cache = plugin.PluginCache(directory)
+        cache.config_keys(plugin_file)
+        cache.save()
+        with open(cache.index_path) as index:
+            saved = index.read()
+
+        cache = plugin.PluginCache(directory)
+        cache.index[plugin_file]['size'] = -1
+        cache._changed = True
+        with patch('tarmac.plugin.json.dump', side_effect=IOError('Full.')):
+            self.assertRaises(IOError, cache.save)
+        with open(cache.index_path) as index:
+            self.assertEqual(saved, index.read())
+        self.assertEqual(
+            sorted(['index.json', os.path.basename(
+                        cache.index[plugin_file]['code'])]),
+            sorted(os.listdir(directory)))
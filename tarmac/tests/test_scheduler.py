@@ -0,0 +1,76 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.scheduler'''
+from tarmac.scheduler import ProposalGraph
+from tarmac.tests import TarmacTestCase, Thing
+
+
+def make_proposal(source, prerequisite=None):
+    """Return a fake proposal of %source, depending on %prerequisite."""
+    if prerequisite is not None:
+        prerequisite = Thing(unique_name=prerequisite)
+    return Thing(source_branch=Thing(unique_name=source),
+                 prerequisite_branch=prerequisite)
+
+
+def names(proposals):
+    return [proposal.source_branch.unique_name for proposal in proposals]
+
+
+class TestProposalGraph(TarmacTestCase):
+
+    def test_sort_independent(self):
+        """Proposals without prerequisites keep their order."""
+        proposals = [make_proposal('a'), make_proposal('b'),
+                     make_proposal('c', 'elsewhere')]
+        ordered, cyclic = ProposalGraph(proposals).sort()
+        self.assertEqual(['a', 'b', 'c'], names(ordered))
+        self.assertEqual([], cyclic)
+
+    def test_sort_chain(self):
+        """A long prerequisite chain is landed from the bottom up."""
+        proposals = [make_proposal('d', 'c'), make_proposal('x'),
+                     make_proposal('b', 'a'), make_proposal('c', 'b'),
+                     make_proposal('a')]
+        ordered, cyclic = ProposalGraph(proposals).sort()
+        self.assertEqual(['x', 'a', 'b', 'c', 'd'], names(ordered))
+        self.assertEqual([], cyclic)
+
+    def test_sort_keeps_order(self):
+        """A proposal goes back to its place once its prerequisite lands."""
+        proposals = [make_proposal('b', 'a'), make_proposal('a'),
+                     make_proposal('c')]
+        ordered, cyclic = ProposalGraph(proposals).sort()
+        self.assertEqual(['a', 'b', 'c'], names(ordered))
+
+    def test_sort_cycle(self):
+        """Proposals in or after a cycle are returned separately."""
+        proposals = [make_proposal('a', 'b'), make_proposal('b', 'a'),
+                     make_proposal('c', 'b'), make_proposal('d')]
+        ordered, cyclic = ProposalGraph(proposals).sort()
+        self.assertEqual(['d'], names(ordered))
+        self.assertEqual(['a', 'b', 'c'], names(cyclic))
+
+    def test_chains(self):
+        """Unrelated proposals are in separate chains."""
+        proposals = [make_proposal('b', 'a'), make_proposal('x'),
+                     make_proposal('a'), make_proposal('y', 'x'),
+                     make_proposal('c', 'a'), make_proposal('z')]
+        chains = ProposalGraph(proposals).chains()
+        self.assertEqual([['x', 'y'], ['a', 'b', 'c'], ['z']],
+                         [names(chain) for chain in chains])
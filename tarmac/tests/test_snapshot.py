@@ -0,0 +1,84 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.snapshot'''
+import os
+import tempfile
+
+from mock import patch
+from tarmac import snapshot
+from tarmac.tests import BranchTestCase
+
+
+class TestSnapshotTree(BranchTestCase):
+
+    def setUp(self):
+        super(TestSnapshotTree, self).setUp()
+        tree_dir = self.branch1.config.tree_dir
+        os.mkdir(os.path.join(tree_dir, 'docs'))
+        with open(os.path.join(tree_dir, 'docs', 'unchanged'), 'w') as f:
+            f.write('Unchanged.')
+        os.symlink('docs/unchanged', os.path.join(tree_dir, 'link'))
+        self.branch1.tree.add(['docs', 'docs/unchanged', 'link'])
+        self.branch1.commit('Some files.')
+        self.branch1.merge(self.branch2)
+        self.dest = tempfile.mkdtemp(dir=os.path.dirname(tree_dir))
+
+    def assertSnapshot(self):
+        self.assertEqual(['README', 'docs', 'link'],
+                         sorted(os.listdir(self.dest)))
+        with open(os.path.join(self.dest, 'README')) as f:
+            self.assertEqual('This is a test file.', f.read())
+        self.assertEqual('docs/unchanged',
+                         os.readlink(os.path.join(self.dest, 'link')))
+
+    def test_snapshot_hardlink(self):
+        """Unchanged files are linked, and changed ones copied."""
+        self.assertEqual('hardlink', snapshot.snapshot_tree(
+                self.branch1.tree, self.dest, 'hardlink'))
+        self.assertSnapshot()
+        self.assertEqual(1, os.stat(
+                os.path.join(self.dest, 'README')).st_nlink)
+        self.assertEqual(2, os.stat(
+                os.path.join(self.dest, 'docs', 'unchanged')).st_nlink)
+
+    def test_snapshot_auto(self):
+        """Reflinks are used if possible, and hard links if not."""
+        method = snapshot.snapshot_tree(self.branch1.tree, self.dest)
+        self.assertIn(method, ['reflink', 'hardlink'])
+        self.assertSnapshot()
+
+    def test_snapshot_auto_no_reflinks(self):
+        """Hard links are used when reflinks aren't supported."""
+        with patch('tarmac.snapshot.reflink', side_effect=IOError(95, '')):
+            self.assertEqual('hardlink', snapshot.snapshot_tree(
+                    self.branch1.tree, self.dest))
+        self.assertSnapshot()
+
+    def test_snapshot_reflink_unsupported(self):
+        """Asking for reflinks fails if they aren't supported."""
+        with patch('tarmac.snapshot.reflink', side_effect=IOError(95, '')):
+            self.assertRaises(snapshot.SnapshotUnsupported,
+                              snapshot.snapshot_tree,
+                              self.branch1.tree, self.dest, 'reflink')
+
+    def test_snapshot_other_filesystem(self):
+        """Hard links across filesystems aren't supported."""
+        with patch('os.link', side_effect=OSError(18, 'EXDEV')):
+            self.assertRaises(snapshot.SnapshotUnsupported,
+                              snapshot.snapshot_tree,
+                              self.branch1.tree, self.dest, 'hardlink')
@@ -0,0 +1,129 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.standin'''
+import json
+import os
+import urllib2
+
+from launchpadlib.launchpad import Launchpad
+
+from tarmac.standin import Model, StandinServer
+from tarmac.tests import TarmacTestCase
+
+PROPOSAL = '~user/project/fix/+merge/1'
+
+
+def make_model():
+    """Return a model of a project with a proposal and a fixed bug."""
+    model = Model(me='~tarmac')
+    model.add('~tarmac', 'person', name='tarmac', display_name='Tarmac',
+              emails=['tarmac@example.com'])
+    model.add('~team', 'team', name='team', is_team=True,
+              members=['~tarmac'])
+    model.add('project', 'project', name='project',
+              development_focus='project/trunk', series=['project/trunk'])
+    model.add('project/trunk', 'project_series', name='trunk')
+    model.add('~user/project/trunk', 'branch', bzr_identity='lp:project',
+              project='project', landing_candidates=[PROPOSAL])
+    model.add('~user/project/fix', 'branch',
+              bzr_identity='lp:~user/project/fix')
+    model.add(PROPOSAL, 'branch_merge_proposal', queue_status='Approved',
+              source_branch='~user/project/fix',
+              target_branch='~user/project/trunk',
+              votes=[PROPOSAL + '/+review/1'])
+    model.add(PROPOSAL + '/+review/1', 'code_review_vote_reference',
+              reviewer='~tarmac', is_pending=False)
+    model.add('bugs/1', 'bug', id=1, bug_tasks=['bugs/1/+task/1'])
+    model.add('bugs/1/+task/1', 'bug_task', status='Triaged',
+              target='project/trunk')
+    return model
+
+
+class TestStandinServer(TarmacTestCase):
+
+    def setUp(self):
+        super(TestStandinServer, self).setUp()
+        self.model = make_model()
+        self.server = StandinServer(self.model)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.launchpad = Launchpad.login_anonymously(
+            u'Tarmac', service_root=self.server.service_root,
+            launchpadlib_dir=os.path.join(self.TEST_ROOT, 'launchpadlib'))
+
+    def test_proposals(self):
+        """Branches, their proposals and votes are served."""
+        branch = self.launchpad.branches.getByUrl(url='lp:project')
+        [proposal] = list(branch.landing_candidates)
+        self.assertEqual(u'Approved', proposal.queue_status)
+        self.assertEqual(u'lp:~user/project/fix',
+                         proposal.source_branch.bzr_identity)
+        self.assertEqual([u'tarmac'],
+                         [vote.reviewer.name for vote in proposal.votes])
+        self.assertEqual(None, self.launchpad.branches.getByUrl(url='lp:x'))
+
+    def test_update_proposal(self):
+        """Proposals are changed by named operations and lp_save."""
+        [proposal] = list(self.launchpad.branches.getByUrl(
+                url='lp:project').landing_candidates)
+        proposal.createComment(subject=u'Failed', content=u'Output')
+        proposal.setStatus(status=u'Needs review')
+        proposal.commit_message = u'Fix it.'
+        proposal.lp_save()
+        entry = self.model.entries[PROPOSAL]
+        self.assertEqual(u'Needs review', entry['queue_status'])
+        self.assertEqual(u'Fix it.', entry['commit_message'])
+        [comment] = entry['all_comments']
+        self.assertEqual(u'Failed', self.model.entries[comment]['title'])
+
+    def test_people(self):
+        """People and teams are found by name and email."""
+        self.assertEqual(u'Tarmac', self.launchpad.me.display_name)
+        self.assertEqual(u'tarmac', self.launchpad.people.getByEmail(
+                email=u'tarmac@example.com').name)
+        team = self.launchpad.people[u'team']
+        self.assertTrue(team.is_team)
+        self.assertEqual([u'tarmac'], [m.name for m in team.members])
+        self.assertRaises(KeyError, lambda: self.launchpad.people[u'nobody'])
+
+    def test_bugs(self):
+        """Bug tasks are found by their series, and updated."""
+        project = self.launchpad.branches.getByUrl(url='lp:project').project
+        series = project.getSeries(name=u'trunk')
+        self.assertEqual(project.development_focus, series)
+        [task] = list(self.launchpad.bugs[1].bug_tasks)
+        self.assertEqual(series, task.target)
+        task.status = u'Fix Committed'
+        task.lp_save()
+        self.assertEqual(u'Fix Committed',
+                         self.model.entries['bugs/1/+task/1']['status'])
+
+    def test_requests(self):
+        """The requests made are counted."""
+        self.launchpad.branches.getByUrl(url='lp:project')
+        self.assertEqual(1, self.server.requests[('GET', 'getByUrl')])
+
+    def test_failure_rate(self):
+        """Requests fail at the failure rate."""
+        self.server.failure_rate = 1.0
+        url = self.server.service_root + '1.0/' + PROPOSAL
+        error = self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url)
+        self.assertEqual(503, error.code)
+        self.server.failure_rate = 0.0
+        self.assertEqual(u'Approved',
+                         json.load(urllib2.urlopen(url))['queue_status'])
@@ -0,0 +1,90 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by
+# the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for tarmac.trace'''
+import json
+import os
+
+from tarmac.tests import TarmacTestCase
+from tarmac.trace import Tracer
+
+
+class TestTracer(TarmacTestCase):
+
+    def setUp(self):
+        super(TestTracer, self).setUp()
+        self.path = os.path.join(self.TEST_ROOT, 'trace')
+        self.tracer = Tracer()
+        self.addCleanup(self.remove_trace)
+
+    def remove_trace(self):
+        self.tracer.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def read(self):
+        with open(self.path) as trace:
+            return trace.read()
+
+    def test_span_jsonl(self):
+        """Spans are written as they end, inheriting attributes."""
+        self.tracer.configure(self.path)
+        with self.tracer.span('outer', target='lp:project'):
+            with self.tracer.span('inner', proposal='proposal'):
+                pass
+        inner, outer = [json.loads(line)
+                        for line in self.read().splitlines()]
+        self.assertEqual('inner', inner['name'])
+        self.assertEqual(1, inner['depth'])
+        self.assertEqual({'target': 'lp:project', 'proposal': 'proposal'},
+                         inner['attributes'])
+        self.assertEqual('outer', outer['name'])
+        self.assertEqual({'target': 'lp:project'}, outer['attributes'])
+        self.assertTrue(outer['duration'] >= inner['duration'])
+
+    def test_span_error(self):
+        """A span ended by an exception records it."""
+        self.tracer.configure(self.path)
+
+        def fail():
+            with self.tracer.span('failing'):
+                raise ValueError('Failed.')
+        self.assertRaises(ValueError, fail)
+        self.assertEqual({'error': 'ValueError'},
+                         json.loads(self.read())['attributes'])
+
+    def test_span_chrome(self):
+        """The chrome format is an array of complete events."""
+        self.tracer.configure(self.path, 'chrome')
+        with self.tracer.span('first'):
+            pass
+        with self.tracer.span('second', target='lp:project'):
+            pass
+        events = json.loads(self.read().rstrip(',\n') + ']')
+        self.assertEqual(['first', 'second'],
+                         [event['name'] for event in events])
+        self.assertEqual('X', events[0]['ph'])
+        self.assertEqual({'target': 'lp:project'}, events[1]['args'])
+
+    def test_span_disabled(self):
+        """Nothing is written until a path is configured."""
+        with self.tracer.span('untraced'):
+            pass
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_configure_unknown_format(self):
+        self.assertRaises(ValueError, self.tracer.configure, self.path, 'xml')
@@ -0,0 +1,133 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of Tarmac.
+#
+# Tarmac is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Tarmac is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tarmac.  If not, see <http://www.gnu.org/licenses/>.
+'''Traces of the time spent in each phase of a run.'''
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+TRACE_FORMATS = ('jsonl', 'chrome')
+
+
+class Tracer(object):
+    '''Writer of spans, the time taken by each phase of a run, to a file.
+
+    Spans nest, and inherit the attributes of the span they are in on the
+    same thread, so e.g. the spans within the landing of a proposal carry
+    the proposal.  Until a path is configured, spans cost next to nothing
+    and nothing is written.
+
+    In the 'jsonl' format, each span is a line of JSON.  The 'chrome' format
+    is the Trace Event format, which chrome://tracing and Perfetto can show.
+    '''
+
+    def __init__(self):
+        self.path = None
+        self.format = 'jsonl'
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, path, format='jsonl'):
+        '''Write spans to the file at %path, in %format, from now on.
+
+        A None %path stops tracing.
+        '''
+        if format not in TRACE_FORMATS:
+            raise ValueError('Unknown trace format: %s' % format)
+        self.close()
+        self.path = path
+        self.format = format
+
+    def close(self):
+        '''Close the trace file.'''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @contextmanager
+    def span(self, name, **attributes):
+        '''Trace the time taken by the body of the with statement.'''
+        if self.path is None:
+            yield
+            return
+        stack = self._stack()
+        if stack:
+            inherited = dict(stack[-1])
+            inherited.update(attributes)
+            attributes = inherited
+        stack.append(attributes)
+        start = time.time()
+        error = None
+        try:
+            yield
+        except Exception, e:
+            error = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            self._write(name, start, time.time() - start, attributes, error,
+                        len(stack))
+
+    def _write(self, name, start, duration, attributes, error, depth):
+        if error is not None:
+            attributes = dict(attributes, error=error)
+        if self.format == 'chrome':
+            event = {
+                'name': name, 'cat': 'tarmac', 'ph': 'X',
+                'ts': int(start * 1000000), 'dur': int(duration * 1000000),
+                'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                'args': attributes}
+            line = json.dumps(event, default=unicode) + ',\n'
+        else:
+            event = {
+                'name': name, 'start': start, 'duration': duration,
+                'pid': os.getpid(),
+                'thread': threading.current_thread().name,
+                'depth': depth, 'attributes': attributes}
+            line = json.dumps(event, default=unicode) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+                # The viewers accept a trace event array without its end.
+                if self.format == 'chrome' and self._file.tell() == 0:
+                    self._file.write('[\n')
+            self._file.write(line)
+            self._file.flush()
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    '''Decorate a function so that each call is a span called %name.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator